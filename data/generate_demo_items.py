@@ -1,90 +1,61 @@
 #!/usr/bin/env python3
+import argparse
 from datetime import datetime
-from multiprocessing import Pool
 from pathlib import Path
 
 import boto3
-import pystac
-import rasterio
-from rasterio.session import AWSSession
 
-from pystac.utils import str_to_datetime
-from rio_stac import stac
-from rasterio.session import AWSSession
+from place.common.cog_catalog import DEFAULT_SAMPLE_BLOCKS, STATS_METHODS, STATS_OVERVIEW, catalog_cogs
+from place.common.s3 import list_s3_keys
 
 
 ENDPOINT_URL="https://s3.af-south-1.amazonaws.com"
-AWS_SESSION = AWSSession(endpoint_url=ENDPOINT_URL, region_name="af-south-1")
+AWS_SESSION_KWARGS = {"endpoint_url": ENDPOINT_URL, "region_name": "af-south-1"}
 
-def create_item(
-    properties,
-    datetime,
-    cog_url,
-    collection,
-) -> pystac.Item:
-    """
-    Function to create a stac item from a COG using rio_stac
-    """
 
-    rasterio_kwargs = {}
-
-    with rasterio.Env(
-        session=AWS_SESSION,
-        options={
-            **rasterio_kwargs,
-            "GDAL_MAX_DATASET_POOL_SIZE": 1024,
-            "GDAL_DISABLE_READDIR_ON_OPEN": False,
-            "GDAL_CACHEMAX": 1024000000,
-            "GDAL_HTTP_MAX_RETRY": 4,
-            "GDAL_HTTP_RETRY_DELAY": 1,
-        },
-    ):
-        item = stac.create_stac_item(
-            id=Path(cog_url).stem,
-            source=cog_url,
-            collection=collection,
-            input_datetime=datetime,
-            properties=properties,
-            with_proj=True,
-            with_raster=True,
-            asset_name="cog",
-            asset_roles=["data", "layer"],
-            asset_media_type=(
-                "image/tiff; application=geotiff; profile=cloud-optimized"
-            ),
-        )
-        item.id = item.id.split("_")[0]
-        item.links = []
-        return item
+def describe_cog(src):
+    """Item id, datetime and camera from the COG's own tags (read from the already open dataset)"""
+    tags = src.tags()
+    return {
+        "id": Path(src.name).stem.split("_")[0],
+        "input_datetime": datetime.strptime(tags["DateTime"], "%Y:%m:%d %H:%M:%S"),
+        "properties": {"camera": tags["Model"]},
+    }
 
 
 def find_tif_keys():
-
+    """Yield the (URL-escaped) keys of every COG in the flight, across all pages of the listing"""
     client = boto3.client('s3', endpoint_url=ENDPOINT_URL, region_name="af-south-1")
-    response = client.list_objects_v2(
-        Bucket="placetrustafrica",
-        Prefix="Ivory Coast/Abidjan/Drone Imagery/Images_Drones/Drone_V-MAP/Adjame/Flight 2S/cog/"
+    keys = list_s3_keys(
+        client,
+        "placetrustafrica",
+        "Ivory Coast/Abidjan/Drone Imagery/Images_Drones/Drone_V-MAP/Adjame/Flight 2S/cog/",
+        extensions=".tif"
     )
-    keys = [obj["Key"].replace(" ", "+") for obj in response["Contents"] if obj["Key"].endswith("tif")]
-    return keys
+    for key in keys:
+        yield key.replace(" ", "+")
 
 
-def build_stac_item(key):
-    cog_url = f"https://placetrustafrica.s3.af-south-1.amazonaws.com/{key}"
-    with rasterio.Env(
-        session=AWS_SESSION,
-        GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
-    ):
-        with rasterio.open(cog_url) as src:
-            tags = src.tags()
-            dt = datetime.strptime(tags["DateTime"], "%Y:%m:%d %H:%M:%S")
-            camera = tags["Model"]
-        item = create_item(
-            properties={"camera": camera},
-            datetime=dt,
-            cog_url=cog_url,
-            collection="IvoryCoast-Abidjian-Adjame",
-        )
+def build_stac_items(processes=None, stats=STATS_OVERVIEW, sample_blocks=DEFAULT_SAMPLE_BLOCKS):
+    cog_urls = (f"https://placetrustafrica.s3.af-south-1.amazonaws.com/{key}" for key in find_tif_keys())
+    results = catalog_cogs(
+        cog_urls,
+        processes=processes,
+        describe=describe_cog,
+        aws_session_kwargs=AWS_SESSION_KWARGS,
+        collection="IvoryCoast-Abidjian-Adjame",
+        stats=stats,
+        sample_blocks=sample_blocks,
+        asset_roles=["data", "layer"],
+        asset_media_type=(
+            "image/tiff; application=geotiff; profile=cloud-optimized"
+        ),
+    )
+    for (cog_url, item, error) in results:
+        if error is not None:
+            print(f"Error cataloguing {cog_url}:\n{error}")
+            continue
+        item.links = []
         item.save_object(
             include_self_link=False,
             dest_href=f"data/items/{item.id}.json"
@@ -92,7 +63,10 @@ def build_stac_item(key):
 
 
 if __name__ == "__main__":
-    tif_keys = find_tif_keys()
-    with Pool() as p:
-        p.map(build_stac_item, tif_keys)
-
+    parser = argparse.ArgumentParser(description="Generate the demo STAC items from the Adjame flight's COGs.")
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes cataloguing COGs (default: one per CPU)")
+    parser.add_argument("--stats", choices=STATS_METHODS, default=STATS_OVERVIEW,
+                        help="Compute raster statistics from every pixel, the coarsest overview or a sample of blocks")
+    parser.add_argument("--sample_blocks", type=int, default=DEFAULT_SAMPLE_BLOCKS, help="Blocks per band read by --stats sample")
+    args = parser.parse_args()
+    build_stac_items(args.processes, args.stats, args.sample_blocks)
@@ -0,0 +1,91 @@
+"""Helpers for building STAC catalogs in a single streaming pass.
+
+Items are written to newline-delimited JSON as they are produced and the
+collection extent is accumulated alongside, so neither depends on holding
+every item in memory.
+"""
+import enum
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+import orjson
+
+
+class ExtentAccumulator(object):
+    """Running spatial and temporal extent of a collection's items, in constant memory"""
+
+    def __init__(self):
+        self.count = 0
+        self.bbox: Optional[List[float]] = None
+        self.start: Optional[datetime] = None
+        self.end: Optional[datetime] = None
+
+    def add(self, bbox: Sequence[float], start: Optional[datetime] = None, end: Optional[datetime] = None) -> None:
+        """Extend the extent by an item's [min_x, min_y, max_x, max_y] bbox and its datetime (or range)"""
+        self.count += 1
+        if self.bbox is None:
+            self.bbox = list(bbox[:4])
+        else:
+            self.bbox = [
+                min(self.bbox[0], bbox[0]),
+                min(self.bbox[1], bbox[1]),
+                max(self.bbox[2], bbox[2]),
+                max(self.bbox[3], bbox[3]),
+            ]
+
+        end = end or start
+        if start is not None and (self.start is None or start < self.start):
+            self.start = start
+        if end is not None and (self.end is None or end > self.end):
+            self.end = end
+
+
+def _default(obj: Any) -> Any:
+    # Models (e.g. stac_pydantic geometries) nested in item dicts, and enum values
+    if hasattr(obj, "dict"):
+        return obj.dict(by_alias=True, exclude_unset=True)
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def to_json_dict(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Normalize a record to plain JSON types (e.g. datetimes to strings), as it would read back from NDJSON"""
+    return orjson.loads(orjson.dumps(record, default=_default))
+
+
+class NdjsonWriter(object):
+    """Write JSON records to a newline-delimited file as they arrive.
+
+    Records go to a temporary file which replaces the destination once the
+    writer is closed without error, so a failed build never leaves a partial file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self._tmp_path = f"{path}.tmp"
+        self._f = open(self._tmp_path, "wb")
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self._f.write(orjson.dumps(record, default=_default, option=orjson.OPT_APPEND_NEWLINE))
+        self.count += 1
+
+    def close(self) -> None:
+        if not self._f.closed:
+            self._f.close()
+            os.replace(self._tmp_path, self.path)
+
+    def abort(self) -> None:
+        if not self._f.closed:
+            self._f.close()
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,218 @@
+"""Catalogue COGs as STAC items, reading as little of each file as possible.
+
+Each COG is opened once and everything an item needs (geometry, projection,
+tags and raster statistics) is read from that one dataset: the header, plus
+the coarsest overview (or a sample of blocks) for approximate statistics.
+Workers keep a single GDAL environment (and AWS session) open for their
+lifetime, so remote COGs cost a few range requests each rather than a full read.
+
+Needs rasterio and rio-stac (the "catalog" extra).
+"""
+from multiprocessing import Pool
+import math
+import os
+from pathlib import Path
+import traceback
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy
+import pystac
+import rasterio
+from rasterio.session import AWSSession
+from rio_stac import create_stac_item
+from rio_stac.stac import RASTER_EXT_VERSION
+
+# GDAL settings for reading COG headers and overviews over HTTP/S3
+GDAL_CATALOG_OPTIONS = {
+    # Don't list the COG's directory (or bucket prefix) looking for sidecar files
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.tiff",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_MAX_RETRY": 4,
+    "GDAL_HTTP_RETRY_DELAY": 1,
+    "VSI_CACHE": "TRUE",
+}
+# How raster statistics are computed: from every pixel, the coarsest overview, or a sample of full-resolution blocks
+STATS_FULL = "full"
+STATS_OVERVIEW = "overview"
+STATS_SAMPLE = "sample"
+STATS_METHODS = [STATS_FULL, STATS_OVERVIEW, STATS_SAMPLE]
+# Blocks read per band by the sample method, spread evenly through the image
+DEFAULT_SAMPLE_BLOCKS = 16
+# Item properties recording how the statistics were computed
+STATS_METHOD_PROPERTY = "place:stats_method"
+STATS_OVERVIEW_LEVEL_PROPERTY = "place:stats_overview_level"
+STATS_SAMPLE_BLOCKS_PROPERTY = "place:stats_sample_blocks"
+
+# Called with the open dataset, returning extra create_stac_item arguments (e.g. id, input_datetime, properties)
+Describe = Callable[[rasterio.io.DatasetReader], Dict[str, Any]]
+
+# Environment entered once in each worker (see _init_worker)
+_env: Optional[rasterio.Env] = None
+
+
+class CatalogResult(NamedTuple):
+    """A catalogued COG: its item, or the error that stopped it being created"""
+    href: str
+    item: Optional[pystac.Item]
+    error: Optional[str]
+
+
+def band_stats(arr: numpy.ma.MaskedArray) -> Dict[str, Any]:
+    """Statistics and histogram of a band's valid pixels, as in the raster extension (and rio-stac)"""
+    numpy.ma.fix_invalid(arr, copy=False)
+    valid = arr.compressed()
+    valid_percent = valid.size / float(arr.size) * 100 if arr.size else 0.0
+    if not valid.size:
+        return {"statistics": {"valid_percent": valid_percent}}
+    (buckets, edges) = numpy.histogram(valid)
+    return {
+        "statistics": {
+            "mean": valid.mean().item(),
+            "minimum": valid.min().item(),
+            "maximum": valid.max().item(),
+            "stddev": valid.std().item(),
+            "valid_percent": valid_percent,
+        },
+        "histogram": {
+            "count": len(edges),
+            "min": float(edges.min()),
+            "max": float(edges.max()),
+            "buckets": buckets.tolist(),
+        },
+    }
+
+
+def band_info(src: rasterio.io.DatasetReader, band: int) -> Dict[str, Any]:
+    """A band's raster extension fields, without statistics"""
+    info = {
+        "data_type": src.dtypes[band - 1],
+        "scale": src.scales[band - 1],
+        "offset": src.offsets[band - 1],
+    }
+    area_or_point = src.tags().get("AREA_OR_POINT", "").lower()
+    if area_or_point:
+        info["sampling"] = area_or_point
+    if src.nodata is not None:
+        if numpy.isnan(src.nodata):
+            info["nodata"] = "nan"
+        elif numpy.isinf(src.nodata):
+            info["nodata"] = "inf" if src.nodata > 0 else "-inf"
+        else:
+            info["nodata"] = src.nodata
+    if src.units[band - 1]:
+        info["unit"] = src.units[band - 1]
+    return info
+
+
+def read_coarsest_overview(src: rasterio.io.DatasetReader, band: int) -> numpy.ma.MaskedArray:
+    """A band read at the size of its coarsest overview, which GDAL then reads instead of the full image"""
+    factors = src.overviews(band)
+    if not factors:
+        return src.read(band, masked=True)
+    shape = (math.ceil(src.height / factors[-1]), math.ceil(src.width / factors[-1]))
+    return src.read(band, out_shape=shape, masked=True)
+
+
+def read_block_sample(src: rasterio.io.DatasetReader, band: int, blocks: int) -> numpy.ma.MaskedArray:
+    """Pixels of up to `blocks` full-resolution blocks of a band, spread evenly through the image"""
+    windows = [window for (_, window) in src.block_windows(band)]
+    step = max(1, len(windows) / blocks)
+    sample = [windows[int(i * step)] for i in range(min(blocks, len(windows)))]
+    return numpy.ma.concatenate([src.read(band, window=window, masked=True).ravel() for window in sample])
+
+
+def raster_stats(
+    src: rasterio.io.DatasetReader,
+    method: str = STATS_OVERVIEW,
+    sample_blocks: int = DEFAULT_SAMPLE_BLOCKS,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Raster extension bands for a dataset, and the item properties recording how their statistics were computed"""
+    properties: Dict[str, Any] = {STATS_METHOD_PROPERTY: method}
+    if method == STATS_OVERVIEW:
+        factors = src.overviews(1)
+        # Without overviews the "coarsest overview" is the image itself
+        properties[STATS_OVERVIEW_LEVEL_PROPERTY] = len(factors) - 1 if factors else None
+    elif method == STATS_SAMPLE:
+        properties[STATS_SAMPLE_BLOCKS_PROPERTY] = sample_blocks
+
+    bands = []
+    for band in src.indexes:
+        if method == STATS_FULL:
+            arr = src.read(band, masked=True)
+        elif method == STATS_OVERVIEW:
+            arr = read_coarsest_overview(src, band)
+        elif method == STATS_SAMPLE:
+            arr = read_block_sample(src, band, sample_blocks)
+        else:
+            raise ValueError(f"Unknown statistics method {method}, expected one of {STATS_METHODS}")
+        bands.append(dict(band_info(src, band), **band_stats(arr)))
+    return (bands, properties)
+
+
+def catalog_cog(
+    href: str,
+    describe: Optional[Describe] = None,
+    stats: Optional[str] = STATS_OVERVIEW,
+    sample_blocks: int = DEFAULT_SAMPLE_BLOCKS,
+    **item_kwargs,
+) -> pystac.Item:
+    """Create a STAC item for a COG from a single open of the file.
+
+    item_kwargs are passed to rio_stac's create_stac_item, after any returned
+    by describe. Raster statistics are computed with the given STATS_METHODS
+    method (None to leave out the raster extension)."""
+    with rasterio.open(href) as src:
+        kwargs = dict(
+            id=Path(href).stem,
+            with_proj=True,
+            asset_name="cog",
+            asset_href=href,
+        )
+        kwargs.update(item_kwargs)
+        if describe is not None:
+            kwargs.update(describe(src))
+        item = create_stac_item(src, **kwargs)
+        if stats is not None:
+            (bands, properties) = raster_stats(src, stats, sample_blocks)
+            item.stac_extensions.append(f"https://stac-extensions.github.io/raster/{RASTER_EXT_VERSION}/schema.json")
+            item.assets[kwargs["asset_name"]].extra_fields["raster:bands"] = bands
+            item.properties.update(properties)
+        return item
+
+
+def _init_worker(aws_session_kwargs: Optional[Dict[str, Any]], gdal_options: Dict[str, Any]) -> None:
+    # One GDAL environment and AWS session per worker, reused for every COG it catalogues
+    global _env
+    session = AWSSession(**aws_session_kwargs) if aws_session_kwargs is not None else None
+    _env = rasterio.Env(session=session, **gdal_options)
+    _env.__enter__()
+
+
+def _catalog_one(args) -> CatalogResult:
+    (href, describe, item_kwargs) = args
+    try:
+        return CatalogResult(href, catalog_cog(href, describe, **item_kwargs), None)
+    except Exception:
+        return CatalogResult(href, None, traceback.format_exc())
+
+
+def catalog_cogs(
+    hrefs: Iterable[str],
+    processes: Optional[int] = None,
+    describe: Optional[Describe] = None,
+    aws_session_kwargs: Optional[Dict[str, Any]] = None,
+    gdal_options: Optional[Dict[str, Any]] = None,
+    **item_kwargs,
+) -> Iterator[CatalogResult]:
+    """Catalogue COGs across a process pool, yielding a result per COG as each finishes.
+
+    aws_session_kwargs (e.g. endpoint_url, region_name) configure the AWS
+    session used for s3:// and S3-hosted https:// COGs; gdal_options are added
+    to GDAL_CATALOG_OPTIONS. describe must be picklable (a module-level function)."""
+    processes = processes or os.cpu_count()
+    options = dict(GDAL_CATALOG_OPTIONS, **(gdal_options or {}))
+    tasks = ((href, describe, item_kwargs) for href in hrefs)
+    with Pool(processes, _init_worker, (aws_session_kwargs, options)) as pool:
+        yield from pool.imap_unordered(_catalog_one, tasks, chunksize=4)
@@ -0,0 +1,417 @@
+"""Header-only EXIF/GPS reader for JPEG and TIFF based (e.g. ARW) images.
+
+Only the APP1 segment of a JPEG (or the leading IFDs of a TIFF) is read. Maker
+notes, thumbnails and tags that aren't part of ExifRecord are never decoded.
+
+GPS headers can also be written into a JPEG by splicing a new APP1 segment
+into its byte stream; the compressed image data is copied as is.
+"""
+import io
+import os
+import shutil
+import struct
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, List, NamedTuple, Optional, Tuple, Union
+
+EXIF_DATETIME_FORMAT = "%Y:%m:%d %H:%M:%S"
+
+# IFD0
+TAG_MAKE = 0x010F
+TAG_MODEL = 0x0110
+TAG_SOFTWARE = 0x0131
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+# Exif IFD
+TAG_EXPOSURE_TIME = 0x829A
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_FOCAL_LENGTH = 0x920A
+TAG_FOCAL_LENGTH_35MM = 0xA405
+# GPS IFD
+TAG_GPS_VERSION_ID = 0x0000
+TAG_GPS_LATITUDE_REF = 0x0001
+TAG_GPS_LATITUDE = 0x0002
+TAG_GPS_LONGITUDE_REF = 0x0003
+TAG_GPS_LONGITUDE = 0x0004
+TAG_GPS_ALTITUDE_REF = 0x0005
+TAG_GPS_ALTITUDE = 0x0006
+
+IFD0_TAGS = {TAG_MAKE, TAG_MODEL, TAG_SOFTWARE, TAG_DATETIME, TAG_EXIF_IFD, TAG_GPS_IFD}
+EXIF_IFD_TAGS = {TAG_EXPOSURE_TIME, TAG_DATETIME_ORIGINAL, TAG_FOCAL_LENGTH, TAG_FOCAL_LENGTH_35MM}
+GPS_IFD_TAGS = {
+    TAG_GPS_LATITUDE_REF,
+    TAG_GPS_LATITUDE,
+    TAG_GPS_LONGITUDE_REF,
+    TAG_GPS_LONGITUDE,
+    TAG_GPS_ALTITUDE_REF,
+    TAG_GPS_ALTITUDE,
+}
+
+# TIFF field type -> (struct format, size in bytes)
+FIELD_TYPES = {
+    1: ("B", 1),  # BYTE
+    2: ("s", 1),  # ASCII
+    3: ("H", 2),  # SHORT
+    4: ("L", 4),  # LONG
+    5: ("LL", 8),  # RATIONAL
+    7: ("s", 1),  # UNDEFINED
+    9: ("l", 4),  # SLONG
+    10: ("ll", 8),  # SRATIONAL
+    11: ("f", 4),  # FLOAT
+    12: ("d", 8),  # DOUBLE
+}
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_APP0 = 0xE0
+JPEG_APP1 = 0xE1
+JPEG_SOS = 0xDA
+JPEG_EOI = 0xD9
+EXIF_HEADER = b"Exif\x00\x00"
+# A segment's length field counts itself, so a segment holds at most this many bytes of data
+MAX_SEGMENT_DATA = 0xFFFF - 2
+
+GPS_VERSION = (2, 2, 0, 0)
+# Latitude/longitude seconds are written as rationals over this (about 3mm at the equator)
+GPS_SECONDS_DENOMINATOR = 10000
+GPS_ALTITUDE_DENOMINATOR = 100
+TYPE_BYTE = 1
+TYPE_ASCII = 2
+TYPE_LONG = 4
+TYPE_RATIONAL = 5
+
+
+class ExifRecord(NamedTuple):
+    """The subset of EXIF/GPS headers used when cataloguing and orthorectifying imagery"""
+
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+    alt: Optional[float] = None
+    datetime: Optional[datetime] = None
+    make: Optional[str] = None
+    model: Optional[str] = None
+    software: Optional[str] = None
+    focal_length: Optional[float] = None
+    focal_length_35mm: Optional[int] = None
+    exposure_time: Optional[float] = None
+
+
+class _TiffReader:
+    """Random access reader for the IFDs of a TIFF structure starting at `base` in `f`"""
+
+    def __init__(self, f: BinaryIO, base: int = 0):
+        self.f = f
+        self.base = base
+        byte_order = self.read(0, 2)
+        if byte_order == b"II":
+            self.endian = "<"
+        elif byte_order == b"MM":
+            self.endian = ">"
+        else:
+            raise ValueError("Not a TIFF structure")
+        (magic, self.first_ifd) = struct.unpack(self.endian + "HL", self.read(2, 6))
+        if magic != 42:
+            raise ValueError("Not a TIFF structure")
+
+    def read(self, offset: int, size: int) -> bytes:
+        self.f.seek(self.base + offset)
+        data = self.f.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated TIFF structure")
+        return data
+
+    def read_ifd(self, offset: int, wanted) -> Dict[int, Any]:
+        """Decode the wanted tags of the IFD at offset; everything else is skipped"""
+        (count,) = struct.unpack(self.endian + "H", self.read(offset, 2))
+        entries = self.read(offset + 2, count * 12)
+        values = {}
+        for idx in range(count):
+            entry = entries[idx * 12:(idx + 1) * 12]
+            (tag, field_type, value_count) = struct.unpack(self.endian + "HHL", entry[:8])
+            if tag not in wanted or field_type not in FIELD_TYPES:
+                continue
+            (fmt, size) = FIELD_TYPES[field_type]
+            length = size * value_count
+            if length <= 4:
+                raw = entry[8:8 + length]
+            else:
+                (value_offset,) = struct.unpack(self.endian + "L", entry[8:12])
+                raw = self.read(value_offset, length)
+            values[tag] = self._decode(field_type, fmt, value_count, raw)
+        return values
+
+    def _decode(self, field_type: int, fmt: str, value_count: int, raw: bytes):
+        if field_type == 2:
+            return raw.split(b"\x00", 1)[0].decode("utf-8", "replace").strip()
+        if field_type == 7:
+            return raw
+        values = struct.unpack(self.endian + fmt * value_count, raw)
+        if field_type in (5, 10):
+            values = tuple(
+                num / den if den else None
+                for num, den in zip(values[::2], values[1::2])
+            )
+        return values
+
+
+def _dms_to_decimal(dms, ref: Optional[str]) -> Optional[float]:
+    if not dms or len(dms) < 3 or None in dms[:3]:
+        return None
+    (degrees, minutes, seconds) = dms[:3]
+    decimal_degrees = degrees + minutes / 60 + seconds / 3600
+    if ref in ("S", "W"):
+        decimal_degrees = -decimal_degrees
+    return decimal_degrees
+
+
+def _first(values):
+    return values[0] if values else None
+
+
+def _parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, EXIF_DATETIME_FORMAT)
+    except ValueError:
+        return None
+
+
+def _find_jpeg_app1(f: BinaryIO) -> Optional[bytes]:
+    """Walk JPEG segment headers until the EXIF APP1 segment; stop at the image data"""
+    while True:
+        marker = f.read(2)
+        if len(marker) != 2:
+            # Every JPEG has image data, so the header was cut short
+            raise ValueError("Truncated JPEG header")
+        if marker[0] != 0xFF:
+            return None
+        # Skip fill bytes
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+        if marker[1] in (JPEG_SOS, JPEG_EOI):
+            return None
+        (length,) = struct.unpack(">H", f.read(2))
+        if marker[1] == JPEG_APP1:
+            data = f.read(length - 2)
+            if len(data) != length - 2:
+                raise ValueError("Truncated JPEG APP1 segment")
+            if data.startswith(EXIF_HEADER):
+                return data[len(EXIF_HEADER):]
+        else:
+            f.seek(length - 2, io.SEEK_CUR)
+
+
+def _read_record(reader: _TiffReader) -> ExifRecord:
+    ifd0 = reader.read_ifd(reader.first_ifd, IFD0_TAGS)
+    exif_ifd = {}
+    gps_ifd = {}
+    if TAG_EXIF_IFD in ifd0:
+        exif_ifd = reader.read_ifd(ifd0[TAG_EXIF_IFD][0], EXIF_IFD_TAGS)
+    if TAG_GPS_IFD in ifd0:
+        gps_ifd = reader.read_ifd(ifd0[TAG_GPS_IFD][0], GPS_IFD_TAGS)
+
+    alt = _first(gps_ifd.get(TAG_GPS_ALTITUDE))
+    if alt is not None and _first(gps_ifd.get(TAG_GPS_ALTITUDE_REF)) in (1, b"\x01"):
+        # Altitude reference 1 means below sea level
+        alt = -alt
+
+    return ExifRecord(
+        lat=_dms_to_decimal(gps_ifd.get(TAG_GPS_LATITUDE), gps_ifd.get(TAG_GPS_LATITUDE_REF)),
+        lng=_dms_to_decimal(gps_ifd.get(TAG_GPS_LONGITUDE), gps_ifd.get(TAG_GPS_LONGITUDE_REF)),
+        alt=alt,
+        datetime=_parse_datetime(exif_ifd.get(TAG_DATETIME_ORIGINAL) or ifd0.get(TAG_DATETIME)),
+        make=ifd0.get(TAG_MAKE),
+        model=ifd0.get(TAG_MODEL),
+        software=ifd0.get(TAG_SOFTWARE),
+        focal_length=_first(exif_ifd.get(TAG_FOCAL_LENGTH)),
+        focal_length_35mm=_first(exif_ifd.get(TAG_FOCAL_LENGTH_35MM)),
+        exposure_time=_first(exif_ifd.get(TAG_EXPOSURE_TIME)),
+    )
+
+
+def read_exif_from_file(f: BinaryIO) -> ExifRecord:
+    """Read an ExifRecord from a seekable binary file object positioned at the start of an image.
+
+    Raises ValueError for anything which isn't a readable image, including
+    headers which are corrupt or cut short (e.g. by a ranged read)."""
+    try:
+        return _read_exif_from_file(f)
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"Corrupt or truncated image headers: {e}") from e
+
+
+def _read_exif_from_file(f: BinaryIO) -> ExifRecord:
+    start = f.tell()
+    signature = f.read(4)
+    if signature.startswith(JPEG_SOI):
+        f.seek(start + len(JPEG_SOI))
+        tiff = _find_jpeg_app1(f)
+        if tiff is None:
+            return ExifRecord()
+        return _read_record(_TiffReader(io.BytesIO(tiff)))
+    elif signature in (b"II*\x00", b"MM\x00*"):
+        return _read_record(_TiffReader(f, base=start))
+    else:
+        raise ValueError("Unsupported image format; expected a JPEG or TIFF based image")
+
+
+def read_exif(source: Union[str, os.PathLike, bytes, BinaryIO]) -> ExifRecord:
+    """Read an ExifRecord from a path, an in-memory image or a binary file object.
+
+    Only header bytes are read, so the cost is independent of image size.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return read_exif_from_file(io.BytesIO(source))
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return read_exif_from_file(f)
+    return read_exif_from_file(source)
+
+
+def _split_jpeg_header(f: BinaryIO) -> Tuple[List[Tuple[int, bytes]], bytes]:
+    """The (marker, data) segments before a JPEG's image data, and the marker that ends them"""
+    if f.read(2) != JPEG_SOI:
+        raise ValueError("Not a JPEG image")
+    segments = []
+    while True:
+        marker = f.read(2)
+        if len(marker) != 2 or marker[0] != 0xFF:
+            raise ValueError("Corrupt JPEG header")
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+        if marker[1] in (JPEG_SOS, JPEG_EOI):
+            return (segments, marker)
+        (length,) = struct.unpack(">H", f.read(2))
+        data = f.read(length - 2)
+        if len(data) != length - 2:
+            raise ValueError("Truncated JPEG header")
+        segments.append((marker[1], data))
+
+
+def _pack_ifd(endian: str, entries: List[Tuple[int, int, int, bytes]], offset: int, next_ifd: int = 0) -> bytes:
+    """An IFD to be placed at offset, from (tag, type, count, value) entries.
+
+    Values of 4 bytes or fewer are stored inline; longer ones follow the IFD.
+    Inline values are used as is, so an entry can carry an existing offset."""
+    entries = sorted(entries)
+    data_offset = offset + 2 + len(entries) * 12 + 4
+    packed = struct.pack(endian + "H", len(entries))
+    data = b""
+    for (tag, field_type, count, value) in entries:
+        if len(value) <= 4:
+            packed += struct.pack(endian + "HHL", tag, field_type, count) + value.ljust(4, b"\x00")
+        else:
+            packed += struct.pack(endian + "HHLL", tag, field_type, count, data_offset + len(data))
+            data += value + b"\x00" * (len(value) % 2)
+    return packed + struct.pack(endian + "L", next_ifd) + data
+
+
+def _rationals(endian: str, values) -> bytes:
+    return b"".join(struct.pack(endian + "LL", num, den) for (num, den) in values)
+
+
+def _dms_rationals(endian: str, decimal_degrees: float) -> bytes:
+    units = round(abs(decimal_degrees) * 3600 * GPS_SECONDS_DENOMINATOR)
+    (degrees, units) = divmod(units, 3600 * GPS_SECONDS_DENOMINATOR)
+    (minutes, seconds) = divmod(units, 60 * GPS_SECONDS_DENOMINATOR)
+    return _rationals(endian, [(degrees, 1), (minutes, 1), (seconds, GPS_SECONDS_DENOMINATOR)])
+
+
+def _gps_entries(endian: str, lat: float, lng: float, alt: Optional[float]) -> List[Tuple[int, int, int, bytes]]:
+    entries = [
+        (TAG_GPS_VERSION_ID, TYPE_BYTE, 4, bytes(GPS_VERSION)),
+        (TAG_GPS_LATITUDE_REF, TYPE_ASCII, 2, b"S\x00" if lat < 0 else b"N\x00"),
+        (TAG_GPS_LATITUDE, TYPE_RATIONAL, 3, _dms_rationals(endian, lat)),
+        (TAG_GPS_LONGITUDE_REF, TYPE_ASCII, 2, b"W\x00" if lng < 0 else b"E\x00"),
+        (TAG_GPS_LONGITUDE, TYPE_RATIONAL, 3, _dms_rationals(endian, lng)),
+    ]
+    if alt is not None:
+        entries += [
+            # Altitude reference 1 means below sea level
+            (TAG_GPS_ALTITUDE_REF, TYPE_BYTE, 1, b"\x01" if alt < 0 else b"\x00"),
+            (TAG_GPS_ALTITUDE, TYPE_RATIONAL, 1,
+             _rationals(endian, [(round(abs(alt) * GPS_ALTITUDE_DENOMINATOR), GPS_ALTITUDE_DENOMINATOR)])),
+        ]
+    return entries
+
+
+def with_gps(tiff: Optional[bytes], lat: float, lng: float, alt: Optional[float] = None) -> bytes:
+    """An EXIF TIFF structure with its GPS IFD replaced, or a new one holding only GPS headers.
+
+    The existing bytes are kept as they are, so every offset in them (Exif IFD,
+    maker notes, thumbnail) stays valid: a new GPS IFD and a copy of IFD0
+    pointing at it are appended, and the header is pointed at the new IFD0."""
+    if not tiff:
+        endian = ">"
+        tiff = b"MM\x00\x2a" + struct.pack(">L", 8) + _pack_ifd(endian, [], 8)
+        ifd0_entries: List[Tuple[int, int, int, bytes]] = []
+        next_ifd = 0
+    else:
+        reader = _TiffReader(io.BytesIO(tiff))
+        endian = reader.endian
+        (count,) = struct.unpack(endian + "H", reader.read(reader.first_ifd, 2))
+        raw_entries = reader.read(reader.first_ifd + 2, count * 12)
+        (next_ifd,) = struct.unpack(endian + "L", reader.read(reader.first_ifd + 2 + count * 12, 4))
+        ifd0_entries = []
+        for idx in range(count):
+            entry = raw_entries[idx * 12:(idx + 1) * 12]
+            (tag, field_type, value_count) = struct.unpack(endian + "HHL", entry[:8])
+            if tag != TAG_GPS_IFD:
+                # The raw 4 byte value: inline data, or an offset that is still valid
+                ifd0_entries.append((tag, field_type, value_count, entry[8:12]))
+
+    gps_offset = len(tiff) + len(tiff) % 2
+    gps_ifd = _pack_ifd(endian, _gps_entries(endian, lat, lng, alt), gps_offset)
+    ifd0_offset = gps_offset + len(gps_ifd)
+    ifd0_entries.append((TAG_GPS_IFD, TYPE_LONG, 1, struct.pack(endian + "L", gps_offset)))
+    ifd0 = _pack_ifd(endian, ifd0_entries, ifd0_offset, next_ifd)
+    return (
+        tiff[:4] + struct.pack(endian + "L", ifd0_offset) + tiff[8:]
+        + b"\x00" * (len(tiff) % 2) + gps_ifd + ifd0
+    )
+
+
+def write_jpeg_gps(src: BinaryIO, dst: BinaryIO, lat: float, lng: float, alt: Optional[float] = None) -> None:
+    """Copy a JPEG from src to dst with its GPS headers set, without decoding the image.
+
+    Only the header segments are parsed; the EXIF APP1 segment is replaced (or
+    added after any JFIF APP0 segment) and the rest of the file is copied as is."""
+    (segments, end_marker) = _split_jpeg_header(src)
+    exif_idx = next(
+        (idx for (idx, (marker, data)) in enumerate(segments) if marker == JPEG_APP1 and data.startswith(EXIF_HEADER)),
+        None,
+    )
+    tiff = segments[exif_idx][1][len(EXIF_HEADER):] if exif_idx is not None else None
+    app1 = EXIF_HEADER + with_gps(tiff, lat, lng, alt)
+    if len(app1) > MAX_SEGMENT_DATA:
+        raise ValueError("EXIF headers too large for a JPEG APP1 segment")
+
+    if exif_idx is not None:
+        segments[exif_idx] = (JPEG_APP1, app1)
+    else:
+        insert_at = 0
+        while insert_at < len(segments) and segments[insert_at][0] == JPEG_APP0:
+            insert_at += 1
+        segments.insert(insert_at, (JPEG_APP1, app1))
+
+    dst.write(JPEG_SOI)
+    for (marker, data) in segments:
+        dst.write(bytes((0xFF, marker)) + struct.pack(">H", len(data) + 2) + data)
+    dst.write(end_marker)
+    shutil.copyfileobj(src, dst)
+
+
+def write_jpeg_gps_file(src_path: str, dst_path: str, lat: float, lng: float, alt: Optional[float] = None) -> None:
+    """Write a copy of a JPEG with its GPS headers set (see write_jpeg_gps), via a temporary file.
+
+    The destination only appears (by an atomic rename) once it is complete, so
+    an interrupted write never leaves a partial image behind."""
+    tmp_path = os.path.join(os.path.dirname(dst_path), f".{os.path.basename(dst_path)}.tmp")
+    try:
+        with open(src_path, "rb") as src, open(tmp_path, "wb") as dst:
+            write_jpeg_gps(src, dst, lat, lng, alt)
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,181 @@
+"""Persistent (SQLite) cache of the ExifRecords read from image files.
+
+Records are keyed by path and are only returned while the file's size and
+modification time are unchanged, so an unchanged image's headers are read at
+most once, however many times it is catalogued or converted. Lookups and
+inserts are done in bulk; a single connection may be shared between threads.
+The cache can only save work: if the database is locked or unusable, a lookup
+is a miss and an insert is skipped.
+"""
+from datetime import datetime
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import orjson
+
+from place.common.exif import ExifRecord, read_exif
+
+# Environment variable naming the cache file used by default (see default_cache)
+CACHE_PATH_ENV = "PLACE_EXIF_CACHE"
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "place", "exif.sqlite")
+# Bump when ExifRecord changes, which empties existing caches
+CACHE_VERSION = 1
+# Paths per SELECT in bulk lookups (SQLite limits the number of parameters)
+LOOKUP_CHUNK_SIZE = 500
+# How long to wait for another process (e.g. a conversion worker) to release the database
+LOCK_TIMEOUT_SECONDS = 30
+
+# (path, size, mtime_ns)
+CacheKey = Tuple[str, int, int]
+
+
+def stat_key(path: str) -> CacheKey:
+    """The cache key of a file as it is now"""
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def _dumps(record: ExifRecord) -> bytes:
+    return orjson.dumps(record._asdict())
+
+
+def _loads(data: bytes) -> ExifRecord:
+    fields = orjson.loads(data)
+    if fields.get("datetime") is not None:
+        fields["datetime"] = datetime.fromisoformat(fields["datetime"])
+    return ExifRecord(**fields)
+
+
+class ExifCache(object):
+    """ExifRecords keyed by (path, size, mtime), in a SQLite file"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        # Several processes (e.g. conversion workers) may share a cache file
+        self.conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT_SECONDS, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        (version,) = self.conn.execute("PRAGMA user_version").fetchone()
+        with self.conn:
+            if version != CACHE_VERSION:
+                self.conn.execute("DROP TABLE IF EXISTS records")
+                self.conn.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS records (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    record BLOB NOT NULL
+                )"""
+            )
+
+    def get_many(self, keys: Iterable[CacheKey]) -> Dict[str, ExifRecord]:
+        """The cached records of those keys which are cached and current, by path"""
+        wanted = {path: (size, mtime_ns) for (path, size, mtime_ns) in keys}
+        paths = list(wanted)
+        found = {}
+        with self._lock:
+            try:
+                for idx in range(0, len(paths), LOOKUP_CHUNK_SIZE):
+                    chunk = paths[idx:idx + LOOKUP_CHUNK_SIZE]
+                    rows = self.conn.execute(
+                        f"SELECT path, size, mtime_ns, record FROM records WHERE path IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    ).fetchall()
+                    for (path, size, mtime_ns, record) in rows:
+                        if wanted[path] == (size, mtime_ns):
+                            found[path] = _loads(record)
+            except sqlite3.Error:
+                # e.g. "database is locked"; whatever wasn't found is read from the files
+                pass
+        return found
+
+    def put_many(self, entries: Iterable[Tuple[CacheKey, ExifRecord]]) -> None:
+        """Cache records, replacing any cached for the same paths"""
+        rows = [(path, size, mtime_ns, _dumps(record)) for ((path, size, mtime_ns), record) in entries]
+        if not rows:
+            return
+        with self._lock:
+            try:
+                with self.conn:
+                    self.conn.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)", rows)
+            except sqlite3.Error:
+                # Not cached this time; the records are read from the files again next time
+                pass
+
+    def get(self, key: CacheKey) -> Optional[ExifRecord]:
+        return self.get_many([key]).get(key[0])
+
+    def put(self, key: CacheKey, record: ExifRecord) -> None:
+        self.put_many([(key, record)])
+
+    def read_exif(self, path: str) -> ExifRecord:
+        """read_exif for a local file, from the cache when the file is unchanged"""
+        key = stat_key(path)
+        record = self.get(key)
+        if record is None:
+            record = read_exif(path)
+            self.put(key, record)
+        return record
+
+    def read_many(self, paths: Iterable[str]) -> Dict[str, ExifRecord]:
+        """read_exif for many local files (by the paths given), with one lookup and one insert"""
+        keys = {path: stat_key(path) for path in paths}
+        cached = self.get_many(keys.values())
+        records = {}
+        misses: List[Tuple[CacheKey, ExifRecord]] = []
+        for (path, key) in keys.items():
+            record = cached.get(key[0])
+            if record is None:
+                record = read_exif(path)
+                misses.append((key, record))
+            records[path] = record
+        self.put_many(misses)
+        return records
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_default_cache: Optional[ExifCache] = None
+_default_cache_pid: Optional[int] = None
+
+
+def default_cache() -> Optional[ExifCache]:
+    """The cache named by the PLACE_EXIF_CACHE environment variable, or None when it isn't
+    set (or can't be opened).
+
+    Opened once per process, so it can be used from pool workers."""
+    global _default_cache, _default_cache_pid
+    path = os.environ.get(CACHE_PATH_ENV)
+    if not path:
+        return None
+    if _default_cache is None or _default_cache_pid != os.getpid() or _default_cache.path != path:
+        try:
+            _default_cache = ExifCache(path)
+        except (sqlite3.Error, OSError):
+            return None
+        _default_cache_pid = os.getpid()
+    return _default_cache
+
+
+def set_default_cache(path: str) -> None:
+    """Make path the default cache of this process and of the processes it starts"""
+    os.environ[CACHE_PATH_ENV] = path
+
+
+def read_exif_cached(path: str) -> ExifRecord:
+    """read_exif for a local file, through the default cache if one is configured"""
+    cache = default_cache()
+    if cache is None:
+        return read_exif(path)
+    return cache.read_exif(path)
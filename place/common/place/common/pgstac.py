@@ -0,0 +1,90 @@
+"""Batched loading of STAC records into pgstac, with throughput reporting.
+
+Needs pypgstac (the "pgstac" extra).
+"""
+import time
+from typing import Any, Dict, Iterable, List, Tuple
+
+from pypgstac.load import Loader, Methods, PgstacDB
+
+# Items sent to pgstac per load_items call (and transaction)
+DEFAULT_BATCH_SIZE = 500
+METHODS = [Methods.insert.value, Methods.upsert.value, Methods.ignore.value]
+
+
+class BatchLoader(object):
+    """Load STAC items into pgstac in batches, one transaction per batch.
+
+    Items are buffered as they are added and sent with a single bulk
+    load_items call once a batch fills up. Throughput is reported per batch
+    and for the whole load."""
+
+    def __init__(self, db: PgstacDB, method: str = Methods.upsert.value, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.db = db
+        self.loader = Loader(db=db)
+        self.method = Methods(method)
+        self.batch_size = batch_size
+        self.count = 0
+        self.load_seconds = 0.0
+        self._batch: List[Dict[str, Any]] = []
+        self._start = time.perf_counter()
+
+    def load_collections(self, collections: Iterable[Dict[str, Any]], method: str = Methods.upsert.value) -> None:
+        self.loader.load_collections(list(collections), Methods(method))
+
+    def has_collection(self, collection_id: str) -> bool:
+        return self.db.query_one("SELECT 1 FROM collections WHERE id = %s;", (collection_id,)) is not None
+
+    def add(self, item: Dict[str, Any]) -> None:
+        """Queue a (JSON-typed) item dict, loading the batch once it is full"""
+        self._batch.append(item)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def add_all(self, items: Iterable[Dict[str, Any]]) -> None:
+        for item in items:
+            self.add(item)
+
+    def flush(self) -> None:
+        if not self._batch:
+            return
+        batch = self._batch
+        self._batch = []
+        start = time.perf_counter()
+        # The loader commits per partition; the outer transaction makes the whole batch atomic
+        with self.db.connect().transaction():
+            self.loader.load_items(batch, self.method, chunksize=len(batch))
+        seconds = time.perf_counter() - start
+        self.load_seconds += seconds
+        self.count += len(batch)
+        rate = len(batch) / seconds if seconds > 0 else 0
+        print(f"Loaded {len(batch)} items in {seconds:.2f}s ({rate:.0f} items/s); {self.count} total")
+
+    def delete_items(self, keys: Iterable[Tuple[str, str]]) -> int:
+        """Delete items by (collection, id) in one transaction, returning how many were requested"""
+        params = [(item_id, collection) for (collection, item_id) in keys]
+        if params:
+            conn = self.db.connect()
+            with conn.transaction(), conn.cursor() as cursor:
+                cursor.executemany("SELECT delete_item(%s, %s);", params)
+        return len(params)
+
+    def summary(self) -> str:
+        wall_seconds = time.perf_counter() - self._start
+        return (
+            f"Loaded {self.count} items into pgstac ({self.method.value}) in {wall_seconds:.1f}s: "
+            f"{self.count / wall_seconds if wall_seconds > 0 else 0:.0f} items/s overall, "
+            f"{self.count / self.load_seconds if self.load_seconds > 0 else 0:.0f} items/s while loading"
+        )
+
+    def close(self) -> None:
+        self.flush()
+        print(self.summary())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # A failed build leaves the batches already committed, but doesn't load a partial one
+        if exc_type is None:
+            self.close()
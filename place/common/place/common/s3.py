@@ -0,0 +1,113 @@
+"""Streaming S3 listing shared by the catalog scripts.
+
+Clients are passed in (any boto3 S3 client), so this module doesn't depend on
+boto3 itself and callers keep control of credentials, endpoints and pooling.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+from typing import Any, Iterable, Iterator, List, Optional, Tuple, Union
+
+# Pages of keys buffered per listing thread when fanning out
+PAGES_PER_THREAD = 4
+_DONE = object()
+
+
+def _normalize_extensions(extensions: Optional[Union[str, Iterable[str]]]) -> Optional[Tuple[str, ...]]:
+    if extensions is None:
+        return None
+    if isinstance(extensions, str):
+        extensions = (extensions,)
+    return tuple(extension.lower() for extension in extensions)
+
+
+def _page_keys(page, extensions: Optional[Tuple[str, ...]]) -> List[str]:
+    keys = [obj["Key"] for obj in page.get("Contents", [])]
+    if extensions is None:
+        return keys
+    return [key for key in keys if key.lower().endswith(extensions)]
+
+
+def iter_s3_pages(client: Any, bucket: str, prefix: str = "", extensions=None, **list_kwargs) -> Iterator[List[str]]:
+    """Yield the keys under a prefix a page (up to 1000 keys) at a time, optionally filtered by extension"""
+    extensions = _normalize_extensions(extensions)
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, **list_kwargs):
+        yield _page_keys(page, extensions)
+
+
+def list_sub_prefixes(client: Any, bucket: str, prefix: str = "", delimiter: str = "/", extensions=None) -> Tuple[List[str], List[str]]:
+    """Split a prefix into its immediate sub-prefixes and the keys directly under it"""
+    extensions = _normalize_extensions(extensions)
+    sub_prefixes = []
+    keys = []
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter=delimiter):
+        sub_prefixes += [common["Prefix"] for common in page.get("CommonPrefixes", [])]
+        keys += _page_keys(page, extensions)
+    return (sub_prefixes, keys)
+
+
+def _list_concurrently(client, bucket, prefix, extensions, threads, delimiter) -> Iterator[str]:
+    (sub_prefixes, keys) = list_sub_prefixes(client, bucket, prefix, delimiter, extensions)
+    yield from keys
+    if not sub_prefixes:
+        return
+
+    pages: queue.Queue = queue.Queue(maxsize=threads * PAGES_PER_THREAD)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # Give up once the consumer has stopped reading, rather than blocking forever
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def list_prefix(sub_prefix):
+        try:
+            for page in iter_s3_pages(client, bucket, sub_prefix, extensions):
+                if not put(page):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(_DONE)
+
+    with ThreadPoolExecutor(threads) as executor:
+        for sub_prefix in sub_prefixes:
+            executor.submit(list_prefix, sub_prefix)
+        try:
+            remaining = len(sub_prefixes)
+            while remaining:
+                page = pages.get()
+                if page is _DONE:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield from page
+        finally:
+            stop.set()
+
+
+def list_s3_keys(
+    client: Any,
+    bucket: str,
+    prefix: str = "",
+    extensions: Optional[Union[str, Iterable[str]]] = None,
+    threads: int = 1,
+    delimiter: str = "/",
+) -> Iterator[str]:
+    """Yield the keys under an S3 prefix as pages arrive, optionally only those with given extensions.
+
+    With more than one thread, the prefix is split into its sub-prefixes (by
+    delimiter) which are listed concurrently, so keys are not in lexical order."""
+    if threads > 1:
+        yield from _list_concurrently(client, bucket, prefix, _normalize_extensions(extensions), threads, delimiter)
+    else:
+        for page in iter_s3_pages(client, bucket, prefix, extensions):
+            yield from page
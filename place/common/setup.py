@@ -7,6 +7,13 @@ install_requires = [
     "pydantic",
 ]
 
+extra_reqs = {
+    # place.common.cog_catalog
+    "catalog": ["rasterio", "rio-stac"],
+    # place.common.pgstac
+    "pgstac": ["pypgstac[psycopg]"],
+}
+
 setup(
     name="place.common",
     description="Code used in both the tiler and stac server",
@@ -21,6 +28,7 @@ setup(
     ],
     license="MIT",
     install_requires=install_requires,
+    extras_require=extra_reqs,
     packages=find_namespace_packages(exclude=["alembic", "tests", "scripts"]),
     zip_safe=False,
 )
\ No newline at end of file
@@ -0,0 +1,81 @@
+from datetime import datetime, timezone
+import enum
+
+import orjson
+import pytest
+
+from place.common.catalog import ExtentAccumulator, NdjsonWriter, to_json_dict
+
+
+def _at(day: int) -> datetime:
+    return datetime(2023, 6, day, tzinfo=timezone.utc)
+
+
+def test_empty_extent():
+    extent = ExtentAccumulator()
+    assert (extent.count, extent.bbox, extent.start, extent.end) == (0, None, None, None)
+
+
+def test_extent_accumulates_bbox_and_interval():
+    extent = ExtentAccumulator()
+    extent.add([-122.5, 45.0, -122.0, 45.5], _at(10))
+    extent.add((-123.0, 45.2, -122.2, 46.0), _at(3), _at(4))
+    extent.add([-122.4, 44.5, -121.5, 45.1, 0.0, 10.0], _at(20))
+    assert extent.count == 3
+    assert extent.bbox == [-123.0, 44.5, -121.5, 46.0]
+    assert (extent.start, extent.end) == (_at(3), _at(20))
+
+
+def test_extent_without_datetimes():
+    extent = ExtentAccumulator()
+    extent.add([0, 0, 1, 1])
+    extent.add([2, 2, 3, 3], None)
+    assert extent.bbox == [0, 0, 3, 3]
+    assert (extent.start, extent.end) == (None, None)
+    extent.add([0, 0, 1, 1], _at(5))
+    assert (extent.start, extent.end) == (_at(5), _at(5))
+
+
+def test_extent_bbox_is_a_copy():
+    bbox = [0.0, 0.0, 1.0, 1.0]
+    extent = ExtentAccumulator()
+    extent.add(bbox)
+    extent.add([-1.0, -1.0, 0.5, 0.5])
+    assert bbox == [0.0, 0.0, 1.0, 1.0]
+
+
+class Color(enum.Enum):
+    RED = "red"
+
+
+def test_ndjson_writer(tmp_path):
+    path = str(tmp_path / "items.ndjson")
+    with NdjsonWriter(path) as writer:
+        writer.write({"id": "a", "datetime": _at(1)})
+        writer.write({"id": "b", "color": Color.RED})
+    assert writer.count == 2
+    with open(path, "rb") as f:
+        assert [orjson.loads(line) for line in f] == [
+            {"id": "a", "datetime": "2023-06-01T00:00:00+00:00"},
+            {"id": "b", "color": "red"},
+        ]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["items.ndjson"]
+
+
+def test_ndjson_writer_keeps_destination_on_error(tmp_path):
+    path = tmp_path / "items.ndjson"
+    path.write_text("previous\n")
+    with pytest.raises(RuntimeError):
+        with NdjsonWriter(str(path)) as writer:
+            writer.write({"id": "a"})
+            raise RuntimeError("build failed")
+    assert path.read_text() == "previous\n"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["items.ndjson"]
+
+
+def test_to_json_dict():
+    assert to_json_dict({"datetime": _at(2), "color": Color.RED, "nested": {"n": 1}}) == {
+        "datetime": "2023-06-02T00:00:00+00:00",
+        "color": "red",
+        "nested": {"n": 1},
+    }
@@ -0,0 +1,128 @@
+import io
+import struct
+
+import pytest
+
+from place.common.exif import ExifRecord, read_exif, write_jpeg_gps, write_jpeg_gps_file
+
+JFIF_APP0 = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+# Stand-in for the scan header and entropy coded data, which are copied as they are
+IMAGE_DATA = b"\xff\xda" + struct.pack(">H", 8) + b"\x01\x01\x00\x00\x3f\x00" + bytes(range(256)) * 4 + b"\xff\xd9"
+
+
+def _ifd0_tiff(make: bytes) -> bytes:
+    """A big endian TIFF structure whose IFD0 holds only a (4 byte, inline) Make tag"""
+    return b"MM\x00\x2a" + struct.pack(">L", 8) + struct.pack(">H", 1) + struct.pack(">HHL", 0x010F, 2, 4) + make + struct.pack(">L", 0)
+
+
+def _jpeg(tiff: bytes = None) -> bytes:
+    app1 = b""
+    if tiff is not None:
+        data = b"Exif\x00\x00" + tiff
+        app1 = b"\xff\xe1" + struct.pack(">H", len(data) + 2) + data
+    return b"\xff\xd8" + JFIF_APP0 + app1 + IMAGE_DATA
+
+
+def _tag(jpeg: bytes, lat, lng, alt=None) -> bytes:
+    dst = io.BytesIO()
+    write_jpeg_gps(io.BytesIO(jpeg), dst, lat, lng, alt)
+    return dst.getvalue()
+
+
+def test_no_exif():
+    assert read_exif(_jpeg()) == ExifRecord()
+
+
+def test_read_ifd0():
+    assert read_exif(_jpeg(_ifd0_tiff(b"Son\x00"))) == ExifRecord(make="Son")
+
+
+def test_not_an_image():
+    with pytest.raises(ValueError):
+        read_exif(b"GIF89a" + bytes(100))
+
+
+def test_truncated_headers_raise_value_error():
+    jpeg = _tag(_jpeg(_ifd0_tiff(b"Son\x00")), 45.5, -122.25, 100.0)
+    # Reading stops at the end of the EXIF segment, which is followed by the image data
+    app1_end = jpeg.index(IMAGE_DATA)
+    full = read_exif(jpeg)
+    assert full.lat is not None
+    for length in range(len(jpeg)):
+        if length < app1_end:
+            # Cut anywhere in the headers (e.g. by a ranged read) is a ValueError, never a partial record
+            with pytest.raises(ValueError):
+                read_exif(jpeg[:length])
+        else:
+            assert read_exif(jpeg[:length]) == full
+
+
+def test_corrupt_ifd_offsets_raise_value_error():
+    tiff = b"MM\x00\x2a" + struct.pack(">L", 0xFFFF)
+    with pytest.raises(ValueError):
+        read_exif(_jpeg(tiff))
+
+
+def _image_data(jpeg: bytes) -> bytes:
+    return jpeg[jpeg.index(b"\xff\xda"):]
+
+
+@pytest.mark.parametrize("position", [(45.5, -122.25, 100.0), (-33.865, 151.2094, -12.5), (0.0, 0.0, None)])
+def test_write_read_round_trip(position):
+    (lat, lng, alt) = position
+    jpeg = _jpeg()
+    tagged = _tag(jpeg, lat, lng, alt)
+    record = read_exif(tagged)
+    assert record.lat == pytest.approx(lat, abs=1e-7)
+    assert record.lng == pytest.approx(lng, abs=1e-7)
+    assert record.alt == (None if alt is None else pytest.approx(alt, abs=0.01))
+    # The EXIF segment goes after JFIF APP0 and the image data is copied unchanged
+    assert tagged.startswith(b"\xff\xd8" + JFIF_APP0 + b"\xff\xe1")
+    assert _image_data(tagged) == _image_data(jpeg)
+
+
+def test_tagging_keeps_other_headers():
+    record = read_exif(_tag(_jpeg(_ifd0_tiff(b"Son\x00")), 45.5, -122.25, 100.0))
+    assert record.make == "Son"
+    assert record.lat == pytest.approx(45.5)
+
+
+def test_retagging_replaces_gps():
+    jpeg = _tag(_jpeg(_ifd0_tiff(b"Son\x00")), 45.5, -122.25, 100.0)
+    retagged = _tag(jpeg, 10.25, 20.75, 5.0)
+    record = read_exif(retagged)
+    assert (record.lat, record.lng, record.alt) == (pytest.approx(10.25), pytest.approx(20.75), pytest.approx(5.0))
+    assert record.make == "Son"
+    # Still a single EXIF segment
+    assert retagged.count(b"Exif\x00\x00") == 1
+    assert _image_data(retagged) == _image_data(jpeg)
+
+
+def test_oversize_app1():
+    # Padding after IFD0 (e.g. maker notes) leaves no room in the segment for a GPS IFD
+    tiff = _ifd0_tiff(b"Son\x00")
+    tiff += bytes(0xFFFF - 2 - len(b"Exif\x00\x00") - len(tiff) - 16)
+    jpeg = _jpeg(tiff)
+    assert read_exif(jpeg).make == "Son"
+    with pytest.raises(ValueError):
+        _tag(jpeg, 45.5, -122.25, 100.0)
+
+
+def test_write_jpeg_gps_file(tmp_path):
+    src = tmp_path / "D1.JPG"
+    src.write_bytes(_jpeg())
+    dst = tmp_path / "out" / "D1.JPG"
+    dst.parent.mkdir()
+    write_jpeg_gps_file(str(src), str(dst), 45.5, -122.25, 100.0)
+    assert read_exif(str(dst)).lat == pytest.approx(45.5)
+    assert read_exif(str(src)) == ExifRecord()
+
+
+def test_write_jpeg_gps_file_leaves_nothing_on_failure(tmp_path):
+    src = tmp_path / "D1.JPG"
+    src.write_bytes(b"not a jpeg")
+    dst = tmp_path / "out"
+    dst.mkdir()
+    with pytest.raises(ValueError):
+        write_jpeg_gps_file(str(src), str(dst / "D1.JPG"), 45.5, -122.25)
+    assert list(dst.iterdir()) == []
@@ -0,0 +1,146 @@
+from datetime import datetime
+import io
+import os
+import sqlite3
+import struct
+
+import pytest
+
+from place.common import exif_cache
+from place.common.exif import ExifRecord, read_exif, write_jpeg_gps
+from place.common.exif_cache import CACHE_PATH_ENV, ExifCache, default_cache, read_exif_cached, stat_key
+
+MINIMAL_JPEG = b"\xff\xd8\xff\xda" + struct.pack(">H", 8) + bytes(6) + b"\xff\xd9"
+
+
+def _write_image(path, lat, lng, alt=None):
+    dst = io.BytesIO()
+    write_jpeg_gps(io.BytesIO(MINIMAL_JPEG), dst, lat, lng, alt)
+    path.write_bytes(dst.getvalue())
+    return str(path)
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """Paths read from disk by the cache"""
+    paths = []
+
+    def counting_read_exif(path):
+        paths.append(path)
+        return read_exif(path)
+
+    monkeypatch.setattr(exif_cache, "read_exif", counting_read_exif)
+    return paths
+
+
+@pytest.fixture
+def images(tmp_path):
+    return [_write_image(tmp_path / f"D{idx}.JPG", 45 + idx, -122.0, 100.0 + idx) for idx in range(3)]
+
+
+def test_read_through(tmp_path, images, reads):
+    with ExifCache(str(tmp_path / "cache" / "exif.sqlite")) as cache:
+        first = cache.read_many(images)
+        assert reads == images
+        assert cache.read_many(images) == first
+        assert cache.read_exif(images[1]) == first[images[1]]
+        assert reads == images
+    assert first[images[2]].lat == pytest.approx(47.0)
+
+    # The cache persists across connections
+    with ExifCache(str(tmp_path / "cache" / "exif.sqlite")) as cache:
+        assert cache.read_many(images) == first
+    assert reads == images
+
+
+def test_changed_file_is_read_again(tmp_path, images, reads):
+    with ExifCache(str(tmp_path / "exif.sqlite")) as cache:
+        cache.read_many(images)
+        _write_image(tmp_path / "D0.JPG", 10.0, 20.0)
+        stat = os.stat(images[0])
+        os.utime(images[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert cache.read_exif(images[0]).lat == pytest.approx(10.0)
+        assert reads == images + [images[0]]
+
+
+def test_record_fields_round_trip(tmp_path, images):
+    record = ExifRecord(45.5, -122.25, 100.0, datetime(2023, 6, 1, 12, 30), "Sony", "ILCE-6000", None, 16.0, 24, 0.001)
+    with ExifCache(str(tmp_path / "exif.sqlite")) as cache:
+        key = stat_key(images[0])
+        cache.put(key, record)
+        assert cache.get(key) == record
+        # Only current keys are hits
+        assert cache.get((key[0], key[1] + 1, key[2])) is None
+
+
+class LockedConnection(object):
+    """Stands in for a connection to a database another process holds locked"""
+
+    def execute(self, *args):
+        raise sqlite3.OperationalError("database is locked")
+
+    executemany = execute
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def test_locked_database_is_a_miss(tmp_path, images, reads):
+    with ExifCache(str(tmp_path / "exif.sqlite")) as cache:
+        cache.read_many(images[:1])
+        (cache.conn, conn) = (LockedConnection(), cache.conn)
+        records = cache.read_many(images)
+        cache.conn = conn
+    # Every image was still read, from the file when the cache couldn't be used
+    assert records[images[2]].lat == pytest.approx(47.0)
+    assert reads == images[:1] + images
+
+
+def test_insert_skipped_while_another_writer_holds_the_lock(tmp_path, images, reads, monkeypatch):
+    monkeypatch.setattr(exif_cache, "LOCK_TIMEOUT_SECONDS", 0.1)
+    path = str(tmp_path / "exif.sqlite")
+    with ExifCache(path) as cache:
+        writer = sqlite3.connect(path)
+        writer.execute("BEGIN IMMEDIATE")
+        try:
+            assert cache.read_exif(images[0]).lat == pytest.approx(45.0)
+        finally:
+            writer.rollback()
+            writer.close()
+        # Not cached, so read again once the lock is released, and cached then
+        cache.read_exif(images[0])
+        cache.read_exif(images[0])
+    assert reads == [images[0], images[0]]
+
+
+def test_version_change_empties_cache(tmp_path, images, reads, monkeypatch):
+    path = str(tmp_path / "exif.sqlite")
+    with ExifCache(path) as cache:
+        cache.read_many(images)
+    monkeypatch.setattr(exif_cache, "CACHE_VERSION", exif_cache.CACHE_VERSION + 1)
+    with ExifCache(path) as cache:
+        cache.read_many(images)
+    assert reads == images + images
+
+
+def test_default_cache(tmp_path, images, monkeypatch):
+    monkeypatch.delenv(CACHE_PATH_ENV, raising=False)
+    assert default_cache() is None
+    assert read_exif_cached(images[0]) == read_exif(images[0])
+
+    monkeypatch.setenv(CACHE_PATH_ENV, str(tmp_path / "exif.sqlite"))
+    cache = default_cache()
+    assert cache is not None and cache is default_cache()
+    assert read_exif_cached(images[0]) == read_exif(images[0])
+    assert cache.get(stat_key(images[0])) is not None
+
+
+def test_unusable_default_cache(tmp_path, images, monkeypatch):
+    # A directory where the cache file should be
+    (tmp_path / "exif.sqlite").mkdir()
+    monkeypatch.setenv(CACHE_PATH_ENV, str(tmp_path / "exif.sqlite"))
+    assert default_cache() is None
+    assert read_exif_cached(images[0]) == read_exif(images[0])
@@ -0,0 +1,86 @@
+import pytest
+
+from place.common.s3 import list_s3_keys, list_sub_prefixes
+
+PAGE_SIZE = 3
+
+
+class FakePaginator(object):
+    def __init__(self, keys, fail_prefix=None):
+        self.keys = keys
+        self.fail_prefix = fail_prefix
+
+    def paginate(self, Bucket, Prefix="", Delimiter=None):
+        if self.fail_prefix is not None and Prefix.startswith(self.fail_prefix):
+            raise RuntimeError(f"listing {Prefix} failed")
+        keys = [key for key in self.keys if key.startswith(Prefix)]
+        prefixes = []
+        if Delimiter is not None:
+            direct = []
+            for key in keys:
+                rest = key[len(Prefix):]
+                if Delimiter in rest:
+                    common = Prefix + rest.split(Delimiter)[0] + Delimiter
+                    if common not in prefixes:
+                        prefixes.append(common)
+                else:
+                    direct.append(key)
+            keys = direct
+        for idx in range(0, max(len(keys), 1), PAGE_SIZE):
+            page = {"Contents": [{"Key": key} for key in keys[idx:idx + PAGE_SIZE]]}
+            if idx == 0 and prefixes:
+                page["CommonPrefixes"] = [{"Prefix": prefix} for prefix in prefixes]
+            yield page
+
+
+class FakeClient(object):
+    def __init__(self, keys, fail_prefix=None):
+        self.paginator = FakePaginator(keys, fail_prefix)
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return self.paginator
+
+
+KEYS = sorted(
+    [f"imagery/flight{flight}/D{idx}.JPG" for flight in range(4) for idx in range(7)]
+    + [f"imagery/flight{flight}/notes.txt" for flight in range(4)]
+    + ["imagery/index.jpg", "other/D0.JPG"]
+)
+
+
+def test_lists_every_page():
+    assert list(list_s3_keys(FakeClient(KEYS), "bucket", "imagery/")) == [key for key in KEYS if key.startswith("imagery/")]
+
+
+def test_filters_extensions():
+    keys = list(list_s3_keys(FakeClient(KEYS), "bucket", "imagery/", extensions=".jpg"))
+    assert keys == [key for key in KEYS if key.startswith("imagery/") and key.lower().endswith(".jpg")]
+    assert list(list_s3_keys(FakeClient(KEYS), "bucket", "imagery/", extensions=(".txt", ".TIF"))) == [
+        key for key in KEYS if key.startswith("imagery/") and key.endswith(".txt")
+    ]
+
+
+def test_list_sub_prefixes():
+    (prefixes, keys) = list_sub_prefixes(FakeClient(KEYS), "bucket", "imagery/")
+    assert prefixes == [f"imagery/flight{flight}/" for flight in range(4)]
+    assert keys == ["imagery/index.jpg"]
+
+
+@pytest.mark.parametrize("threads", [2, 8])
+def test_concurrent_listing(threads):
+    keys = list(list_s3_keys(FakeClient(KEYS), "bucket", "imagery/", extensions=".JPG", threads=threads))
+    assert sorted(keys) == [key for key in KEYS if key.startswith("imagery/") and key.lower().endswith(".jpg")]
+
+
+def test_concurrent_listing_raises_errors():
+    client = FakeClient(KEYS, fail_prefix="imagery/flight2/")
+    with pytest.raises(RuntimeError):
+        list(list_s3_keys(client, "bucket", "imagery/", threads=4))
+
+
+def test_concurrent_listing_can_stop_early():
+    keys = list_s3_keys(FakeClient(KEYS), "bucket", "imagery/", threads=2)
+    assert len([key for (key, _) in zip(keys, range(5))]) == 5
+    # Closing the generator releases the listing threads rather than leaving them blocked
+    keys.close()
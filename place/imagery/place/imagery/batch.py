@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+from functools import partial
+from multiprocessing import Pool, Value
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from rio_cogeo.cogeo import cog_validate
+
+from cogify import MemoryBudgetExceeded
+from pipeline import fetch_input, run_pipelined
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+# Errors which are not worth retrying since they will fail the same way again
+NON_RETRYABLE = (FileNotFoundError, ValueError, MemoryBudgetExceeded)
+# Seconds to wait before the first retry; doubled for each retry after that
+RETRY_DELAY = 1.0
+
+# Count of unfinished tasks in a batch, shared with (and decremented by) its workers.
+# Set in each worker by _init_worker when threads adapt to the work in flight.
+_unfinished = None
+_processes = 1
+
+
+class TaskResult(NamedTuple):
+    input_path: str
+    output_path: str
+    status: str
+    attempts: int
+    error: Optional[str] = None
+    # Whatever the process returned for the task, e.g. its profiling records
+    value: Any = None
+
+
+class Manifest(object):
+    """Persistent (SQLite) record of the status of each image in a batch conversion"""
+
+    def __init__(self, path: str):
+        self.path = path
+        # Results may be recorded from the threads of a pipelined run
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS tasks (
+                input_path TEXT PRIMARY KEY,
+                output_path TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                error TEXT,
+                updated REAL NOT NULL
+            )"""
+        )
+        self.conn.commit()
+
+    def status(self, input_path: str) -> Optional[str]:
+        row = self.conn.execute("SELECT status FROM tasks WHERE input_path = ?", (input_path,)).fetchone()
+        return row[0] if row else None
+
+    def record(self, result: TaskResult) -> None:
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?)",
+                (result.input_path, result.output_path, result.status, result.attempts, result.error, time.time())
+            )
+            self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def output_is_valid(output_path: str) -> bool:
+    """Check that an output exists and is a valid COG (only its header is read)"""
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        return False
+    try:
+        (is_valid, _, _) = cog_validate(output_path, quiet=True)
+    except Exception:
+        return False
+    return is_valid
+
+
+def is_complete(manifest: Manifest, input_path: str, output_path: str) -> bool:
+    """Whether a task can be skipped because its output already exists and is valid"""
+    if manifest.status(input_path) == STATUS_DONE and os.path.exists(output_path):
+        return True
+    if output_is_valid(output_path):
+        # Written by an earlier run which was interrupted before it was recorded
+        manifest.record(TaskResult(input_path, output_path, STATUS_DONE, 0))
+        return True
+    return False
+
+
+def _init_worker(unfinished, processes: int) -> None:
+    global _unfinished, _processes
+    _unfinished = unfinished
+    _processes = processes
+
+
+def adaptive_num_threads(unfinished: int, processes: int, cpus: Optional[int] = None) -> int:
+    """GDAL threads per image so that the images still in flight share every core"""
+    cpus = cpus or os.cpu_count() or 1
+    in_flight = max(1, min(processes, unfinished))
+    return max(1, cpus // in_flight)
+
+
+def call_with_retries(process: Callable[..., Any], retries: int, input_path: str, output_path: str, *args) -> TaskResult:
+    """Run process(input_path, output_path, *args), retrying transient failures.
+
+    Never raises, so that one failed image can't abort the rest of a batch."""
+    if _unfinished is not None:
+        # Once fewer tasks than processes remain, idle cores go to the images still running.
+        # GDAL falls back to this variable when an encoding doesn't set its thread count.
+        os.environ["GDAL_NUM_THREADS"] = str(adaptive_num_threads(_unfinished.value, _processes))
+    try:
+        return _call_with_retries(process, retries, input_path, output_path, *args)
+    finally:
+        if _unfinished is not None:
+            with _unfinished.get_lock():
+                _unfinished.value -= 1
+
+
+def retry(call: Callable[[], Any], retries: int) -> Tuple[int, Any, Optional[str]]:
+    """Call call() until it succeeds, retrying transient failures with backoff.
+
+    Returns (attempts, value, None) or, once it gives up, (attempts, None, error)."""
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            return (attempts, call(), None)
+        except Exception as e:
+            if isinstance(e, NON_RETRYABLE) or attempts > retries:
+                return (attempts, None, "".join(traceback.format_exception_only(type(e), e)).strip())
+            time.sleep(RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def _call_with_retries(process: Callable[..., Any], retries: int, input_path: str, output_path: str, *args) -> TaskResult:
+    (attempts, value, error) = retry(lambda: process(input_path, output_path, *args), retries)
+    if error is not None:
+        return TaskResult(input_path, output_path, STATUS_FAILED, attempts, error)
+    return TaskResult(input_path, output_path, STATUS_DONE, attempts, value=value)
+
+
+class FetchFailed(Exception):
+    """An input couldn't be fetched, even with retries"""
+
+
+def _run_task(payload: Tuple[Callable[..., Any], int, Tuple[Any, ...]]) -> TaskResult:
+    (process, retries, task) = payload
+    return call_with_retries(process, retries, *task)
+
+
+def pending_tasks(manifest: Manifest, tasks: Iterable[Tuple[Any, ...]]) -> Tuple[List[Tuple[Any, ...]], int]:
+    """Split (input_path, output_path, *args) tasks into those still to do and a count of skipped ones"""
+    pending = []
+    skipped = 0
+    for task in tasks:
+        if is_complete(manifest, task[0], task[1]):
+            skipped += 1
+        else:
+            pending.append(task)
+    return (pending, skipped)
+
+
+def summarize(manifest: Manifest, results: List[TaskResult], skipped: int) -> Dict[str, Any]:
+    """Print and return a summary of a batch run"""
+    done = sum(1 for result in results if result.status == STATUS_DONE)
+    failed = [result for result in results if result.status == STATUS_FAILED]
+    print(f"Converted {done}, skipped {skipped} already converted, failed {len(failed)}")
+    if failed:
+        print("Failures:")
+        for result in failed:
+            print(f"  {result.input_path} ({result.attempts} attempts): {result.error}")
+        print(f"Re-run to retry failed images; progress is recorded in {manifest.path}")
+    return {"done": done, "skipped": skipped, "failed": failed, "results": results}
+
+
+def run_batch(
+    tasks: Iterable[Tuple[Any, ...]],
+    process: Callable[..., Any],
+    manifest_path: str,
+    processes: Optional[int] = None,
+    chunksize: int = 1,
+    retries: int = 2,
+    prefetch: Optional[int] = None,
+    download_threads: Optional[int] = None,
+    tmp_dir: Optional[str] = None,
+    skip_complete: bool = True,
+    adaptive_threads: bool = True,
+    is_current: Optional[Callable[[Tuple[Any, ...]], bool]] = None
+) -> Dict[str, Any]:
+    """Run (input_path, output_path, *args) tasks with process, resuming from a manifest.
+
+    Tasks whose outputs are already recorded (or found) to be valid are skipped,
+    unless skip_complete is off, e.g. because process itself checks whether an
+    existing output is up to date.
+    Failures are retried per task and recorded rather than aborting the batch.
+    With prefetch set, inputs are fetched ahead of conversion (see run_pipelined),
+    and if is_current(task) is true (checked before fetching), the task is
+    recorded as done without running it. Without prefetch, process is
+    expected to make any such check itself.
+    With adaptive_threads, each task sets GDAL_NUM_THREADS so that as fewer tasks
+    than processes remain in flight, the spare cores go to the remaining ones."""
+    with Manifest(manifest_path) as manifest:
+        if skip_complete:
+            (pending, skipped) = pending_tasks(manifest, tasks)
+        else:
+            (pending, skipped) = (list(tasks), 0)
+        print(f"{len(pending)} images to convert, {skipped} already converted")
+
+        processes = processes or os.cpu_count()
+        unfinished = Value("i", len(pending))
+        if adaptive_threads:
+            pool_options = dict(initializer=_init_worker, initargs=(unfinished, processes))
+        else:
+            pool_options = {}
+
+        results = []
+        if prefetch:
+            # (attempts, error) of the inputs which couldn't be fetched
+            fetch_failures: Dict[str, Tuple[int, str]] = {}
+
+            def fetch(input_path, tmp_dir):
+                # Downloads are retried like conversions
+                (attempts, fetched, error) = retry(lambda: fetch_input(input_path, tmp_dir), retries)
+                if error is not None:
+                    fetch_failures[input_path] = (attempts, error)
+                    raise FetchFailed(error)
+                return fetched
+
+            def on_result(task, result, error):
+                if result is None:
+                    # Never run to the end by a worker (its input couldn't be fetched, it was
+                    # skipped as current, or its worker died), so not counted off by one either
+                    with unfinished.get_lock():
+                        unfinished.value -= 1
+                if task[0] in fetch_failures:
+                    (attempts, error) = fetch_failures[task[0]]
+                    result = TaskResult(task[0], task[1], STATUS_FAILED, attempts, error)
+                elif result is None and error is None:
+                    # Skipped as current
+                    result = TaskResult(task[0], task[1], STATUS_DONE, 0)
+                elif error is not None:
+                    result = TaskResult(task[0], task[1], STATUS_FAILED, 1, error)
+                else:
+                    # The task ran on a local copy of its input
+                    result = result._replace(input_path=task[0])
+                manifest.record(result)
+                results.append(result)
+
+            run_pipelined(
+                pending,
+                partial(call_with_retries, process, retries),
+                processes=processes,
+                prefetch=prefetch,
+                download_threads=download_threads,
+                tmp_dir=tmp_dir,
+                on_result=on_result,
+                skip=is_current,
+                fetch=fetch,
+                **pool_options
+            )
+        else:
+            with Pool(processes, **pool_options) as pool:
+                payloads = ((process, retries, task) for task in pending)
+                for result in pool.imap_unordered(_run_task, payloads, chunksize):
+                    manifest.record(result)
+                    results.append(result)
+        return summarize(manifest, results, skipped)
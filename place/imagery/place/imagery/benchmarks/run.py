@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Offline benchmarks for the imagery pipeline.
+
+Generates a synthetic flight locally (no network access needed) and times the
+table loaders (csv and xlsx), footprint computation, EXIF reads, cogify() and the batch
+runner at 1..N workers. Run from the place/imagery/place/imagery directory:
+
+    python -m benchmarks.run --output benchmark.json
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from batch import run_batch
+from cogify import cogify, compute_footprints
+from place.common.exif import read_exif
+from place.common.exif_cache import ExifCache
+from rotation import construct_rotation_matrices, construct_rotation_matrix, rotate
+from util.tabular import load_flight_table, parse_table, ROTATION_KEYS
+from version import __version__
+
+from benchmarks.synthetic import generate_flight, write_pko_table
+
+
+def result(name: str, items: int, seconds: float, workers: int = 1, nbytes: int = 0,
+           peak_rss_mb: Optional[float] = None) -> Dict[str, Any]:
+    record = {
+        "name": name,
+        "workers": workers,
+        "items": items,
+        "seconds": seconds,
+        "items_per_s": items / seconds if seconds > 0 else None,
+        "mb_per_s": nbytes / 1024 / 1024 / seconds if nbytes and seconds > 0 else None,
+        "peak_rss_mb": peak_rss_mb,
+    }
+    print(f"{name:>28} [{workers} workers]: {record['items_per_s']:.1f} items/s"
+          + (f", {record['mb_per_s']:.1f} MB/s" if record["mb_per_s"] else "")
+          + (f", peak RSS {peak_rss_mb:.0f}MB" if peak_rss_mb else ""))
+    return record
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    value = fn(*args, **kwargs)
+    return (time.perf_counter() - start, value)
+
+
+def bench_tables(directory: str, rows: int) -> List[Dict[str, Any]]:
+    table_path = os.path.join(directory, "large_pko.csv")
+    write_pko_table(table_path, rows)
+
+    results = []
+    (seconds, _) = timed(parse_table, table_path, offset=1)
+    results.append(result("parse_table (csv)", rows, seconds))
+    (seconds, _) = timed(load_flight_table, table_path, offset=1, use_cache=False)
+    results.append(result("load_flight_table (parse)", rows, seconds))
+    load_flight_table(table_path, offset=1)
+    (seconds, _) = timed(load_flight_table, table_path, offset=1)
+    results.append(result("load_flight_table (sidecar)", rows, seconds))
+    return results
+
+
+def bench_xlsx_tables(flight) -> List[Dict[str, Any]]:
+    rows = len(flight.ids)
+    (seconds, _) = timed(parse_table, flight.pko_xlsx, offset=1)
+    parse_result = result("parse_table (xlsx)", rows, seconds)
+    (seconds, _) = timed(load_flight_table, flight.pko_xlsx, offset=1, use_cache=False)
+    return [parse_result, result("load_flight_table (xlsx)", rows, seconds)]
+
+
+def bench_rotation(directory: str) -> List[Dict[str, Any]]:
+    table = load_flight_table(os.path.join(directory, "large_pko.csv"), offset=1)
+    rows = len(table.ids)
+    lookup = parse_table(os.path.join(directory, "large_pko.csv"), offset=1)
+
+    def per_image():
+        for pko_dict in lookup.values():
+            rotation_matrix = construct_rotation_matrix([float(pko_dict[key]) for key in ROTATION_KEYS])
+            rotate(float(pko_dict["Y"]), float(pko_dict["X"]), 0.0005, 0.0007, rotation_matrix)
+
+    def batched():
+        compute_footprints(table.xyz[:, 1], table.xyz[:, 0], table.xyz[:, 2], construct_rotation_matrices(table.rotations))
+
+    (seconds, _) = timed(per_image)
+    per_image_result = result("rotate (per image)", rows, seconds)
+    (seconds, _) = timed(batched)
+    return [per_image_result, result("compute_footprints (batch)", rows, seconds)]
+
+
+def bench_exif(jpg_paths: List[str]) -> Dict[str, Any]:
+    (seconds, _) = timed(lambda: [read_exif(path) for path in jpg_paths])
+    return result("read_exif", len(jpg_paths), seconds)
+
+
+def bench_exif_cache(jpg_paths: List[str], directory: str) -> List[Dict[str, Any]]:
+    with ExifCache(os.path.join(directory, "exif.sqlite")) as cache:
+        (cold, _) = timed(lambda: cache.read_many(jpg_paths))
+        (warm, _) = timed(lambda: cache.read_many(jpg_paths))
+    return [
+        result("ExifCache.read_many (cold)", len(jpg_paths), cold),
+        result("ExifCache.read_many (warm)", len(jpg_paths), warm),
+    ]
+
+
+def bench_cogify(jpg_paths: List[str], output_dir: str, options: Dict[str, Any], name: str) -> Dict[str, Any]:
+    nbytes = sum(os.path.getsize(path) for path in jpg_paths)
+    start = time.perf_counter()
+    peaks = [
+        cogify(path, os.path.join(output_dir, f"{idx}.tif"), np.eye(3), **options)
+        for idx, path in enumerate(jpg_paths)
+    ]
+    return result(name, len(jpg_paths), time.perf_counter() - start, nbytes=nbytes, peak_rss_mb=max(peaks))
+
+
+def bench_batch(flight, output_dir: str, workers: int) -> Dict[str, Any]:
+    nbytes = sum(os.path.getsize(path) for path in flight.jpg_paths)
+    table = load_flight_table(flight.pko_csv, offset=1)
+    tasks = [
+        (path, os.path.join(output_dir, f"{photo_id}.tif"), rotation_matrix)
+        for (path, photo_id, rotation_matrix)
+        in zip(flight.jpg_paths, table.ids, construct_rotation_matrices(table.rotations))
+    ]
+    (seconds, summary) = timed(
+        run_batch, tasks, cogify, os.path.join(output_dir, "manifest.sqlite"), processes=workers
+    )
+    peak = max((task_result.value for task_result in summary["results"] if task_result.value), default=None)
+    return result("run_batch (end to end)", len(tasks), seconds, workers=workers, nbytes=nbytes, peak_rss_mb=peak)
+
+
+def parse_args(args: List[str]):
+    parser = argparse.ArgumentParser(description="PLACE imagery pipeline benchmarks")
+    parser.add_argument("--images", type=int, default=16, help="Number of images in the synthetic flight")
+    parser.add_argument("--width", type=int, default=1200, help="Width of synthetic images")
+    parser.add_argument("--height", type=int, default=800, help="Height of synthetic images")
+    parser.add_argument("--table-rows", type=int, default=10000, help="Rows in the synthetic table benchmark")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count(), help="Benchmark the batch runner at 1..N workers")
+    parser.add_argument("--work-dir", help="Directory for the synthetic flight and outputs (defaults to a temp dir)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    return parser.parse_args(args)
+
+
+def main(args: List[str]) -> Dict[str, Any]:
+    options = parse_args(args)
+    with tempfile.TemporaryDirectory(dir=options.work_dir) as work_dir:
+        print(f"Generating a synthetic flight of {options.images} {options.width}x{options.height} images")
+        flight = generate_flight(os.path.join(work_dir, "flight"), options.images, options.width, options.height)
+
+        results = []
+        results += bench_tables(work_dir, options.table_rows)
+        results += bench_xlsx_tables(flight)
+        results += bench_rotation(work_dir)
+        results.append(bench_exif(flight.jpg_paths))
+        results += bench_exif_cache(flight.jpg_paths, work_dir)
+
+        cog_dir = os.path.join(work_dir, "cog")
+        os.makedirs(cog_dir)
+        results.append(bench_cogify(flight.jpg_paths, cog_dir, {}, "cogify"))
+        results.append(bench_cogify(flight.jpg_paths, cog_dir, {"streaming": True}, "cogify (streaming)"))
+        results.append(bench_cogify(flight.jpg_paths, cog_dir, {"reduction": 4}, "cogify (1/4 preview)"))
+
+        # Powers of two up to (and including) the maximum
+        worker_counts = {options.max_workers}
+        workers = 1
+        while workers < options.max_workers:
+            worker_counts.add(workers)
+            workers *= 2
+        for workers in sorted(worker_counts):
+            batch_dir = os.path.join(work_dir, f"batch_{workers}")
+            os.makedirs(batch_dir)
+            results.append(bench_batch(flight, batch_dir, workers))
+
+    report = {
+        "version": __version__,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "platform": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": vars(options),
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {options.output}")
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import csv
+import math
+import os
+from typing import List, NamedTuple
+
+import numpy as np
+import openpyxl
+from PIL import Image
+
+from rotation import construct_rotation_matrix_opk
+from util.tabular import ROTATION_KEYS, XYZ_KEYS
+
+# Roughly where the Adjame flights were flown
+ORIGIN_LAT = 5.3703
+ORIGIN_LNG = -4.0358
+ALTITUDE = 175.8
+# Spacing between neighbouring exposures, in degrees
+SPACING = 0.0005
+
+EXIF_MAKE = 0x010F
+EXIF_MODEL = 0x0110
+EXIF_DATETIME = 0x0132
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+EXIF_EXPOSURE_TIME = 0x829A
+EXIF_FOCAL_LENGTH = 0x920A
+EXIF_FOCAL_LENGTH_35MM = 0xA405
+GPS_IFD = 0x8825
+
+
+class SyntheticFlight(NamedTuple):
+    directory: str
+    ids: List[str]
+    jpg_paths: List[str]
+    pko_csv: str
+    pko_xlsx: str
+
+
+def _dms(decimal_degrees: float):
+    decimal_degrees = abs(decimal_degrees)
+    degrees = math.floor(decimal_degrees)
+    minutes = math.floor((decimal_degrees - degrees) * 60)
+    seconds = (decimal_degrees - degrees - minutes / 60) * 3600
+    return (float(degrees), float(minutes), round(seconds, 4))
+
+
+def make_exif(lat: float, lng: float, alt: float) -> Image.Exif:
+    exif = Image.Exif()
+    exif[EXIF_MAKE] = "SONY"
+    exif[EXIF_MODEL] = "ILCE-6000"
+    exif[EXIF_DATETIME] = "2023:08:01 10:00:00"
+    exif[GPS_IFD] = {
+        1: "N" if lat >= 0 else "S",
+        2: _dms(lat),
+        3: "E" if lng >= 0 else "W",
+        4: _dms(lng),
+        5: b"\x00",
+        6: alt,
+    }
+    exif_ifd = exif.get_ifd(EXIF_IFD)
+    exif_ifd[EXIF_DATETIME_ORIGINAL] = "2023:08:01 10:00:00"
+    exif_ifd[EXIF_EXPOSURE_TIME] = 1 / 1000
+    exif_ifd[EXIF_FOCAL_LENGTH] = 16.0
+    exif_ifd[EXIF_FOCAL_LENGTH_35MM] = 24
+    return exif
+
+
+def make_image(width: int, height: int, rng: np.random.Generator) -> Image.Image:
+    """An image with smooth structure plus noise, so it compresses roughly like aerial imagery"""
+    y = np.linspace(0, 4 * math.pi, height)[:, np.newaxis]
+    x = np.linspace(0, 4 * math.pi, width)[np.newaxis, :]
+    base = (np.sin(x + rng.uniform(0, math.pi)) * np.cos(y) + 1) * 100
+    rgb = np.stack([base, base * 0.8, base * 0.6], axis=-1)
+    rgb += rng.normal(0, 12, rgb.shape)
+    return Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8))
+
+
+def generate_flight(directory: str, count: int, width: int = 1200, height: int = 800, seed: int = 0) -> SyntheticFlight:
+    """Write a synthetic flight: JPEGs with EXIF GPS and matching PKO tables (csv and xlsx)"""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    columns = int(math.ceil(math.sqrt(count)))
+
+    ids = []
+    jpg_paths = []
+    rows = []
+    for idx in range(count):
+        photo_id = f"DSC{idx:05d}"
+        lat = ORIGIN_LAT + (idx // columns) * SPACING
+        lng = ORIGIN_LNG + (idx % columns) * SPACING
+        alt = ALTITUDE + rng.normal(0, 1)
+        (omega, phi, kappa) = rng.normal(0, 0.05, 3)
+        rotation = np.asarray(construct_rotation_matrix_opk(omega, phi, kappa)).ravel()
+
+        jpg_path = os.path.join(directory, f"{photo_id}.JPG")
+        make_image(width, height, rng).save(jpg_path, exif=make_exif(lat, lng, alt), quality=90)
+
+        ids.append(photo_id)
+        jpg_paths.append(jpg_path)
+        rows.append([photo_id, lng, lat, alt, omega, phi, kappa] + rotation.tolist())
+
+    headings = ["# PhotoID"] + list(XYZ_KEYS) + ["Omega", "Phi", "Kappa"] + list(ROTATION_KEYS)
+    comment = ["# Synthetic flight generated for benchmarks"]
+
+    pko_csv = os.path.join(directory, "pko.csv")
+    with open(pko_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(comment)
+        writer.writerow(headings)
+        writer.writerows(rows)
+
+    pko_xlsx = os.path.join(directory, "pko.xlsx")
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(comment)
+    ws.append(headings)
+    for row in rows:
+        ws.append(row)
+    wb.save(pko_xlsx)
+
+    return SyntheticFlight(directory, ids, jpg_paths, pko_csv, pko_xlsx)
+
+
+def write_pko_table(path: str, count: int, seed: int = 0) -> None:
+    """Write a large PKO csv without images, for table and rotation benchmarks"""
+    rng = np.random.default_rng(seed)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["# Synthetic PKO table generated for benchmarks"])
+        writer.writerow(["# PhotoID"] + list(XYZ_KEYS) + list(ROTATION_KEYS))
+        for idx in range(count):
+            rotation = np.asarray(construct_rotation_matrix_opk(*rng.normal(0, 0.05, 3))).ravel()
+            writer.writerow(
+                [f"DSC{idx:05d}", ORIGIN_LNG, ORIGIN_LAT, ALTITUDE + rng.normal(0, 1)] + rotation.tolist()
+            )
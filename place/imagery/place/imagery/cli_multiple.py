@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 import argparse
+import os
 import sys
 from typing import Any, Dict, List, Optional
 
-from cogify import cogify
-from rotation import construct_rotation_matrix
+from place.common.exif_cache import set_default_cache
+
+from cogify import ALTITUDE_ADJUSTMENT_M, add_cogify_args, cogify, cogify_options_from_args, compute_footprints
+from encoding import num_threads_arg
+from rotation import construct_rotation_matrices
 from version import __version__
-from util.tabular import parse_table
+from util.tabular import load_flight_table
 
 def parse_args(args: List[str]) -> Optional[Dict[str, Any]]:
     desc = "PLACE cog conversion CLI"
@@ -42,40 +46,56 @@ def parse_args(args: List[str]) -> Optional[Dict[str, Any]]:
         required=True
     )
 
+    add_cogify_args(parser, in_memory_input=False)
+
     parsed_args = {
         k: v for k, v in vars(parser.parse_args(args)).items() if v is not None
     }
 
     return parsed_args
 
-if __name__ == "__main__":
-    args = parse_args(sys.argv[1:])
 
-    location_lookup = parse_table(args["location_table"])
-    pko_lookup = parse_table(args["pko_table"], offset=1)
+def main(argv: List[str]):
+    """Convert every image in a location table; returns the number converted (not skipped as up to date)"""
+    args = parse_args(argv)
+    if "exif_cache" in args:
+        set_default_cache(args["exif_cache"])
 
-    success_count = 0
-    for location_id, location_dict in location_lookup.items():
-        if (location_id not in pko_lookup):
+    location_table = load_flight_table(args["location_table"])
+    pko_table = load_flight_table(args["pko_table"], offset=1)
+
+    pko_rows = {pko_id: idx for idx, pko_id in enumerate(pko_table.ids)}
+    location_rows = []
+    for idx, location_id in enumerate(location_table.ids):
+        if (location_id not in pko_rows):
             print(f"Warning: ID {location_id} not found in pko file. Unable to orthorectify; skipping...")
         else:
-            pko_dict = pko_lookup[location_id]
-
-
-            rotation_matrix = construct_rotation_matrix([
-                pko_dict["r11"],
-                pko_dict["r12"],
-                pko_dict["r13"],
-                pko_dict["r21"],
-                pko_dict["r22"],
-                pko_dict["r23"],
-                pko_dict["r31"],
-                pko_dict["r32"],
-                pko_dict["r33"]
-            ])
-            raw_path = f"{args['raw_image_dir']}/{args['# PhotoID']}.ARW"
-            output_path = f"{args['output_dir']}/{args['# PhotoID']}.tif"
-            cogify(args["raw_image"], args["output"], location_lookup["Y"], location_lookup["X"], location_lookup["Z"], rotation_matrix)
-            success_count += 1
-
-    print(f"Successfully converted {success_count}/{len(location_lookup)} images in location table")
+            location_rows.append(idx)
+    ids = location_table.ids[location_rows]
+    xyz = location_table.xyz[location_rows]
+
+    # Compute footprints for every image in the flight in one pass
+    rotation_matrices = construct_rotation_matrices(pko_table.rotations[[pko_rows[location_id] for location_id in ids]])
+    footprints = compute_footprints(xyz[:, 1], xyz[:, 0], xyz[:, 2] - ALTITUDE_ADJUSTMENT_M, rotation_matrices)
+
+    # Images are converted one at a time, so each may as well use every core, unless a runner
+    # (e.g. run_cli_from_csv.py) has shared the cores out through GDAL_NUM_THREADS
+    cogify_options = cogify_options_from_args(args, num_threads_arg(os.environ.get("GDAL_NUM_THREADS", "ALL_CPUS")))
+    (converted, skipped) = (0, 0)
+    for location_id, rotation_matrix, footprint in zip(ids, rotation_matrices, footprints):
+        raw_path = f"{args['raw_image_dir']}/{location_id}.ARW"
+        output_path = f"{args['output_dir']}/{location_id}.tif"
+        peak_mb = cogify(raw_path, output_path, rotation_matrix, footprint=footprint, **cogify_options)
+        if peak_mb is None:
+            print(f"Skipped {raw_path}; {output_path} is up to date")
+            skipped += 1
+        else:
+            print(f"Converted {raw_path} (peak RSS: {peak_mb:.0f}MB)")
+            converted += 1
+
+    print(f"Converted {converted}, skipped {skipped} already up to date, of {len(location_table.ids)} images in location table")
+    return converted
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 import argparse
+import os
 import sys
 from typing import Any, Dict, List, Optional
 
-from cogify import cogify
+from place.common.exif_cache import set_default_cache
+
+from cogify import add_cogify_args, cogify, cogify_options_from_args
+from encoding import num_threads_arg
+from profiling import ImageProfile, print_summary, write_report
 from rotation import construct_rotation_matrix
 from version import __version__
 
@@ -37,15 +42,42 @@ def parse_args(args: List[str]) -> Optional[Dict[str, Any]]:
         required=True
     )
 
+    parser.add_argument(
+        "--profile-report",
+        help="Record per-stage wall time, CPU time and peak RSS and write p50/p95 per stage to this JSON or CSV file",
+        required=False
+    )
+
+    add_cogify_args(parser)
+
     parsed_args = {
         k: v for k, v in vars(parser.parse_args(args)).items() if v is not None
     }
 
     return parsed_args
 
-if __name__ == "__main__":
-    args = parse_args(sys.argv[1:])
-    assert len(args["rotation_matrix"]) == 9, f"The rotation matrix requires 9 values, {len(args['transformation_matrix'])} values provided"
+
+def main(argv: List[str]):
+    """Convert a single image; returns its peak RSS in MB (None if it was up to date)"""
+    args = parse_args(argv)
+    assert len(args["rotation_matrix"]) == 9, f"The rotation matrix requires 9 values, {len(args['rotation_matrix'])} values provided"
+    if "exif_cache" in args:
+        set_default_cache(args["exif_cache"])
 
     rotation_matrix = construct_rotation_matrix(args["rotation_matrix"])
-    cogify(args["raw_image"], args["output"], rotation_matrix)
+    profile = ImageProfile(args["raw_image"]) if "profile_report" in args else None
+    # Only one image is converted, so it may as well use every core, unless a runner
+    # (e.g. run_cli_from_csv.py) has shared the cores out through GDAL_NUM_THREADS
+    cogify_options = cogify_options_from_args(args, num_threads_arg(os.environ.get("GDAL_NUM_THREADS", "ALL_CPUS")))
+    peak_mb = cogify(args["raw_image"], args["output"], rotation_matrix, profile=profile, **cogify_options)
+    if peak_mb is None:
+        print(f"{args['output']} is up to date")
+    else:
+        print(f"Peak RSS: {peak_mb:.0f}MB")
+    if profile is not None:
+        print_summary(write_report(profile.records, args["profile_report"]))
+    return peak_mb
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
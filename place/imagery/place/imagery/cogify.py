@@ -1,91 +1,498 @@
 #!/usr/bin/env python3
 
+import argparse
+from contextlib import contextmanager
+import hashlib
+import io
+import json
 import math
 import os
 import tempfile
+import threading
+from typing import Any, Dict, Optional, Union
 try:
     from urlparse import urlparse
 except ImportError:
     from urllib.parse import urlparse
 
 import boto3
-import exifread
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import morecantile
 import numpy as np
-from PIL import ExifTags, Image
+from PIL import Image
+import pyproj
 import rawpy
 import rasterio as rio
 from rasterio.control import GroundControlPoint
 from rasterio.crs import CRS
 from rasterio.io import MemoryFile
 from rasterio.plot import reshape_as_raster
+from rasterio.windows import Window
 from rio_cogeo.cogeo import cog_translate
-from rio_cogeo.profiles import cog_profiles
 
-from rotation import construct_rotation_matrix, rotate
+from place.common.exif import EXIF_DATETIME_FORMAT, ExifRecord, read_exif
+from place.common.exif_cache import read_exif_cached
+
+from encoding import DEFAULT_ENCODING, EncodingProfile, add_encoding_args, encoding_from_args
+from profiling import NULL_PROFILE
+from rotation import CORNERS, rotate_batch
 from S3Url import S3Url
+from util.memory import current_rss_mb, peak_rss_mb, reset_peak_rss
+from version import __version__
+
+# Supported decode reductions for preview conversions (1 is full resolution)
+REDUCTIONS = (1, 2, 4, 8)
+# Height of the tiles used for the temporary source GTiff in streaming mode
+STREAMING_BLOCK_SIZE = 512
+# Share of a memory budget handed to the GDAL block cache during translation
+GDAL_CACHE_SHARE = 0.25
+# Connections each process keeps open to S3; enough for concurrent multipart downloads from several threads
+S3_MAX_POOL_CONNECTIONS = 32
+# Objects above the threshold are downloaded as concurrent ranged GETs of chunksize each
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+)
+
+# Tile sizes (in pixels) supported for web optimized output
+WEB_TILE_SIZES = (256, 512)
+# Overview levels whose internal tiles line up with the web mercator tile grid in web optimized output.
+# Each extra level snaps the output extent to a coarser tile, padding the image with nodata.
+WEB_ALIGNED_LEVELS = 3
+# Resampling used when warping into web mercator
+WEB_RESAMPLING = "bilinear"
+# COG metadata tag holding the key of the inputs an output was converted from
+CONVERSION_KEY_TAG = "PLACE_CONVERSION_KEY"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """Raised when converting an image needs more memory than its budget allows"""
+
+
+def check_memory_budget(memory_budget_mb: Optional[float], stage: str) -> None:
+    if memory_budget_mb is not None and current_rss_mb() > memory_budget_mb:
+        raise MemoryBudgetExceeded(
+            f"RSS of {current_rss_mb():.0f}MB exceeds budget of {memory_budget_mb:.0f}MB after {stage}"
+        )
+
+def get_s3_client():
+    """Return this process's S3 client, creating it on first use.
+
+    The client (and its connection pool) is reused for every download made by a
+    process. Clients are cached by process id because they can't be shared across a fork."""
+    pid = os.getpid()
+    with _s3_clients_lock:
+        if pid not in _s3_clients:
+            _s3_clients[pid] = boto3.session.Session().client(
+                "s3",
+                config=Config(
+                    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                    retries={"max_attempts": 5, "mode": "standard"}
+                )
+            )
+        return _s3_clients[pid]
 
-GOOD_EXIF = ("DateTime", "Model", "Software")
+def download_s3_to_temp(s3_path: str, tmp_dir: Optional[str] = None) -> str:
+    """Download an S3 object to a temporary file and return its path; the caller removes it"""
+    s3url = S3Url(s3_path)
 
-def download_s3_to_temp(s3_path: str):
+    # Keep the extension so the temporary copy can be recognized as jpg or raw
+    (fd, temp_path) = tempfile.mkstemp(suffix=os.path.splitext(s3url.key)[1], dir=tmp_dir)
+    try:
+        with os.fdopen(mode="w+b", fd=fd) as f:
+            get_s3_client().download_fileobj(s3url.bucket, s3url.key, f, Config=S3_TRANSFER_CONFIG)
+    except BaseException:
+        os.remove(temp_path)
+        raise
 
-    s3 = boto3.client("s3")
+    return temp_path
+
+def download_s3_to_buffer(s3_path: str) -> io.BytesIO:
+    """Download an S3 object into memory"""
     s3url = S3Url(s3_path)
+    buffer = io.BytesIO()
+    get_s3_client().download_fileobj(s3url.bucket, s3url.key, buffer, Config=S3_TRANSFER_CONFIG)
+    buffer.seek(0)
+    return buffer
+
+def is_temp_copy(img_path: str, tmp_dir: Optional[str] = None) -> bool:
+    """Whether a path is (probably) a download_s3_to_temp copy, e.g. one fetched ahead by the pipeline"""
+    return os.path.dirname(os.path.abspath(img_path)) == os.path.abspath(tmp_dir or tempfile.gettempdir())
+
+def is_jpg(img_path: str) -> bool:
+    return img_path.lower().endswith("jpg") or img_path.lower().endswith("jpeg")
+
+@contextmanager
+def open_input(input_img_path: str, tmp_dir: Optional[str] = None, in_memory: bool = False, profile=NULL_PROFILE):
+    """Yield a local path (or in-memory buffer) from which an input image can be decoded.
+
+    S3 inputs are downloaded to a temporary file which is removed on exit. With
+    in_memory, S3 JPEGs are decoded straight from a buffer without touching disk."""
+    if not input_img_path.lower().startswith("s3"):
+        yield input_img_path
+    elif in_memory and is_jpg(input_img_path):
+        with profile.stage("download"):
+            buffer = download_s3_to_buffer(input_img_path)
+        with buffer:
+            yield buffer
+    else:
+        with profile.stage("download"):
+            temp_path = download_s3_to_temp(input_img_path, tmp_dir)
+        try:
+            yield temp_path
+        finally:
+            os.remove(temp_path)
+
+def check_reduction(reduction: int) -> None:
+    if reduction not in REDUCTIONS:
+        raise ValueError(f"Reduction must be one of {REDUCTIONS}, got {reduction}")
+
+
+def process_raw(raw_img_path: str, reduction: int = 1, profile=NULL_PROFILE, cache_exif: bool = False):
+    """Decode a raw image, optionally at 1/reduction of its full resolution.
+
+    With cache_exif, its EXIF record is read through the cache named by
+    PLACE_EXIF_CACHE (if set); only worthwhile for paths that persist."""
+    check_reduction(reduction)
+    with profile.stage("exif"):
+        exif = read_exif_cached(raw_img_path) if cache_exif else read_exif(raw_img_path)
+
+    with profile.stage("decode"):
+        with rawpy.imread(raw_img_path) as raw:
+            # Half size demosaicing skips interpolation entirely by binning each 2x2 bayer cell
+            rgb = raw.postprocess(half_size=reduction > 1)
+
+        if reduction > 2:
+            # Box-filter the half size output the rest of the way down
+            with Image.fromarray(rgb) as half:
+                rgb = np.array(half.reduce(reduction // 2))
+
+    return (rgb, exif)
+
+
+def process_jpg(jpg_img_path, reduction: int = 1, profile=NULL_PROFILE, cache_exif: bool = False):
+    """Decode a jpg image (a path or binary file object), optionally at 1/reduction of its full resolution.
+
+    With cache_exif, the EXIF record of a path is read through the cache as in process_raw."""
+    check_reduction(reduction)
+    with profile.stage("exif"):
+        if cache_exif and isinstance(jpg_img_path, str):
+            exif = read_exif_cached(jpg_img_path)
+        else:
+            exif = read_exif(jpg_img_path)
+    if hasattr(jpg_img_path, "seek"):
+        jpg_img_path.seek(0)
+    with profile.stage("decode"):
+        # Close the image once copied so the decoded pixels are not held twice
+        with Image.open(jpg_img_path) as img:
+            if reduction > 1:
+                # Draft mode has libjpeg scale the DCT while decoding, so the full size image is never built
+                img.draft("RGB", (img.width // reduction, img.height // reduction))
+            rgb = np.array(img)
+    return (rgb, exif)
+
+
+def web_mercator_tms(tile_size: int = 256) -> morecantile.TileMatrixSet:
+    """The web mercator (EPSG:3857) tile matrix set with tiles of tile_size pixels"""
+    if tile_size not in WEB_TILE_SIZES:
+        raise ValueError(f"Tile size must be one of {WEB_TILE_SIZES}, got {tile_size}")
+    tms = morecantile.tms.get("WebMercatorQuad")
+    if tile_size == 256:
+        return tms
+    # Same grid with larger tiles; zoom z of this set has the resolution of zoom z + 1 of WebMercatorQuad
+    return morecantile.TileMatrixSet.custom(
+        list(tms.xy_bbox),
+        pyproj.CRS.from_epsg(3857),
+        tile_width=tile_size,
+        tile_height=tile_size,
+        id=f"WebMercatorQuad{tile_size}",
+    )
+
+
+def translate_options(encoding: EncodingProfile = DEFAULT_ENCODING, web_optimized: bool = False, tile_size: int = 256):
+    """Destination profile and cog_translate keyword arguments for a COG output mode"""
+    dst_profile = encoding.dst_profile()
+    translate_kwargs = dict(
+        overview_resampling=encoding.overview_resampling,
+        overview_level=encoding.overview_level,
+    )
+    if not web_optimized:
+        return (dst_profile, translate_kwargs)
+
+    # Internal blocks (and so overview blocks) the size of a map tile, so each tile is a single block read
+    dst_profile.update(blockxsize=tile_size, blockysize=tile_size)
+    translate_kwargs.update(
+        web_optimized=True,
+        tms=web_mercator_tms(tile_size),
+        aligned_levels=WEB_ALIGNED_LEVELS,
+        resampling=WEB_RESAMPLING,
+    )
+    return (dst_profile, translate_kwargs)
+
+
+def hash_source(source) -> str:
+    """SHA-256 of an input image (a path or in-memory buffer)"""
+    if isinstance(source, io.BytesIO):
+        return hashlib.sha256(source.getbuffer()).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_fingerprint(input_img_path: str) -> str:
+    """Identifies the content of an input image.
+
+    S3 objects are identified by their ETag and size (from a HEAD request), so an
+    unchanged object needn't be downloaded; local files by the SHA-256 of their bytes."""
+    if input_img_path.lower().startswith("s3"):
+        s3url = S3Url(input_img_path)
+        head = get_s3_client().head_object(Bucket=s3url.bucket, Key=s3url.key)
+        return f"s3:{head['ETag'].strip(chr(34))}:{head['ContentLength']}"
+    return hash_source(input_img_path)
+
 
-    (fd, temp_path) = tempfile.mkstemp()
-    with os.fdopen(mode="w+b", fd=fd) as f:
-        s3.download_fileobj(s3url.bucket, s3url.key, f)
+def conversion_key(source_hash: str, transformation_matrix, footprint=None, **output_options) -> str:
+    """Key identifying everything an output COG depends on.
 
-    return (fd, temp_path)
+    Covers the input (see source_fingerprint), the rotation matrix, the footprint
+    (when given rather than read from EXIF), the options which change the output
+    and the code version."""
+    digest = hashlib.sha256()
+    digest.update(source_hash.encode())
+    digest.update(np.asarray(transformation_matrix, dtype=np.float64).tobytes())
+    if footprint is not None:
+        digest.update(np.asarray(footprint, dtype=np.float64).tobytes())
+    digest.update(json.dumps(output_options, sort_keys=True, default=str).encode())
+    digest.update(__version__.encode())
+    return digest.hexdigest()
 
-def process_raw(raw_img_path: str):
-    with open(raw_img_path, "rb") as raw_for_tags:
-        raw_tags = exifread.process_file(raw_for_tags)
-        tags = {tag: raw_tags[tag] for tag in raw_tags}
 
-    with rawpy.imread(raw_img_path) as raw:
-        rgb = raw.postprocess()
+def input_conversion_key(
+    input_img_path: str,
+    transformation_matrix: np.matrix,
+    footprint: Optional[np.ndarray] = None,
+    reduction: int = 1,
+    web_optimized: bool = False,
+    tile_size: int = 256,
+    encoding: EncodingProfile = DEFAULT_ENCODING
+) -> str:
+    """The conversion key of an input converted with the given cogify options"""
+    return conversion_key(
+        source_fingerprint(input_img_path),
+        transformation_matrix,
+        footprint,
+        encoding=encoding.output_options(),
+        reduction=reduction,
+        web_optimized=web_optimized,
+        tile_size=tile_size if web_optimized else None,
+    )
+
+
+def is_up_to_date(input_img_path: str, dest_tif_path: str, transformation_matrix: np.matrix, **options) -> bool:
+    """Whether an existing output was converted from the same input with the same options
+    (see input_conversion_key); S3 inputs aren't downloaded to find out"""
+    stored_key = read_conversion_key(dest_tif_path)
+    return stored_key is not None and stored_key == input_conversion_key(input_img_path, transformation_matrix, **options)
+
+
+def read_conversion_key(dest_tif_path: str) -> Optional[str]:
+    """The conversion key stored in an existing output, if there is one (only its header is read)"""
+    if not os.path.exists(dest_tif_path):
+        return None
+    try:
+        with rio.open(dest_tif_path) as dst:
+            return dst.tags().get(CONVERSION_KEY_TAG)
+    except rio.errors.RasterioIOError:
+        return None
+
+# approximate in meters
+EARTH_RADIUS_KM = 6378
+MS_PER_LAT = 111.3171 * 1000
+# Subtracted from recorded altitudes (EXIF or flight table alike) before estimating footprints
+ALTITUDE_ADJUSTMENT_M = 0.12
+
+# GSD (ground sampling distance) formula used to estimate pixel extent
+# (flight altitude x sensor height or width) / (focal length x image height or width)
+
+# magical numbers (based on the sensor dimensions for the Sony ILCE-7M2)
+# SENSOR_WIDTH_CM = 35.8 * 0.1
+# SENSOR_HEIGHT_CM = 23.9 * 0.1
+# FOCAL_LENGTH_CM = 24 * 0.1
+
+# magical numbers (based on the sensor dimensions for the Sony ILCE-6000)
+SENSOR_WIDTH_CM = 23.5 * 0.1
+SENSOR_HEIGHT_CM = 15.6 * 0.1
+FOCAL_LENGTH_CM = 16 * 0.1
+
+
+def ground_offsets(latitudes, altitudes):
+    """Estimate the lat/lng offsets from image centers to image edges.
+
+    Accepts scalars or arrays of equal length and returns (lat_offsets, lng_offsets)."""
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    altitudes_cm = np.asarray(altitudes, dtype=np.float64) * 100
+
+    # meters/longitude increases as latitude shifts away from equator
+    ms_per_lng = ((math.pi/180) * EARTH_RADIUS_KM * np.cos(latitudes*math.pi/180)) * 1000
 
-    return (rgb, tags)
+    # Offsets from the lat/lng center corresponding to image boundaries are half the
+    # image extent: (image size / 2) x GSD. Image size cancels out of that product,
+    # so the extent only depends on altitude and the camera.
+    # (division by 100 to move from cm to meters)
+    m_y_offset = (altitudes_cm * SENSOR_HEIGHT_CM) / (2 * FOCAL_LENGTH_CM) / 100
+    m_x_offset = (altitudes_cm * SENSOR_WIDTH_CM) / (2 * FOCAL_LENGTH_CM) / 100
+
+    # Here, we determine lat/lng offsets
+    lat_offsets = m_y_offset / MS_PER_LAT
+    lng_offsets = m_x_offset / ms_per_lng
+    return (lat_offsets, lng_offsets)
+
+
+def compute_footprints(latitudes, longitudes, altitudes, rotation_matrices) -> np.ndarray:
+    """Compute rotated image corners for a whole flight in one operation.
+
+    Returns an (N, 4, 3) array of (lat, lng, z) corners ordered as rotation.CORNERS."""
+    (lat_offsets, lng_offsets) = ground_offsets(latitudes, altitudes)
+    return rotate_batch(latitudes, longitudes, lat_offsets, lng_offsets, rotation_matrices)
+
+
+def corner_gcps(footprint, img_height: int, img_width: int):
+    """Construct ground control points relating image corners to a (4, 3) footprint"""
+    pixels = {
+        "TL": (0, 0),
+        "BL": (img_height, 0),
+        "TR": (0, img_width),
+        "BR": (img_height, img_width),
+    }
+    gcps = []
+    for idx, corner in enumerate(CORNERS):
+        (row, col) = pixels[corner]
+        (lat, lng, z) = footprint[idx]
+        gcps.append(GroundControlPoint(row, col, lng, lat, z))
+    return gcps
 
 
-def process_jpg(jpg_img_path: str):
-    img = Image.open(jpg_img_path)
+def cog_tags(exif: ExifRecord):
+    """Select the EXIF values carried over into COG metadata tags"""
     tags = {
-        ExifTags.TAGS[k]: v
-        for k, v in img._getexif().items()
+        "DateTime": exif.datetime.strftime(EXIF_DATETIME_FORMAT) if exif.datetime else None,
+        "Model": exif.model,
+        "Software": exif.software,
     }
-    rgb = np.array(img)
-    return (rgb, tags)
-
-def degrees_to_radians(nesw: str, degrees, minutes, seconds):
-    # Degrees + (Minutes + Seconds/60)/60.
-    radians = degrees + (minutes + seconds / 60) / 60
-    if nesw in ["N", "E"]:
-        signed_radians = radians
-    elif nesw in ["S", "W"]:
-        signed_radians = -radians
-    else:
-        raise ValueError("nesw value must be one of N, E, S, or W")
-    return signed_radians
+    return {tag: value for tag, value in tags.items() if value is not None}
+
+
+def write_source_blocks(rgb: np.ndarray, path: str, profile, block_rows: int) -> None:
+    """Write an (height, width, bands) array to a tiled GTiff a strip of rows at a time.
 
+    Only one strip is ever transposed into raster order, which avoids the full
+    copy made by reshape_as_raster."""
+    img_height = rgb.shape[0]
+    img_width = rgb.shape[1]
+    with rio.open(path, "w", **profile) as dst:
+        for row_off in range(0, img_height, block_rows):
+            rows = min(block_rows, img_height - row_off)
+            window = Window(0, row_off, img_width, rows)
+            dst.write(reshape_as_raster(rgb[row_off:row_off + rows]), window=window)
 
 
 def cogify(
     input_img_path: str,
     dest_tif_path: str,
-    transformation_matrix: np.matrix
-) -> None:
-
-    if input_img_path.lower().startswith("s3"):
-        (fd, temp_path) = download_s3_to_temp(input_img_path)
-        local_path = temp_path
-    else:
-        local_path = input_img_path
-
-    if input_img_path.lower().endswith("jpg") or input_img_path.lower().endswith("jpeg"):
-        (rgb, tags) = process_jpg(local_path)
-    else:
-        (rgb, tags) = process_raw(local_path)
+    transformation_matrix: np.matrix,
+    footprint: Optional[np.ndarray] = None,
+    streaming: bool = False,
+    memory_budget_mb: Optional[float] = None,
+    tmp_dir: Optional[str] = None,
+    reduction: int = 1,
+    in_memory_input: bool = False,
+    profile=None,
+    web_optimized: bool = False,
+    tile_size: int = 256,
+    incremental: bool = False,
+    encoding: EncodingProfile = DEFAULT_ENCODING,
+    source_path: Optional[str] = None
+) -> Optional[float]:
+    """Convert a raw or jpg image to an orthorectified COG.
+
+    A precomputed (4, 3) footprint (see compute_footprints) may be provided, in
+    which case the image position is not read from its EXIF headers.
+
+    In streaming mode the decoded image is written block by block to a temporary
+    GTiff (in tmp_dir), released, and translated to a COG from disk. If a memory
+    budget is set, the translation cache is sized to fit within it and it is
+    enforced with MemoryBudgetExceeded. Memory is checked between stages rather
+    than continuously: conversion aborts if the process is over budget after
+    decoding (or writing the streamed source), and once the COG is written, the
+    output is removed and the conversion fails if its peak RSS was over budget.
+
+    A reduction of 2, 4 or 8 decodes a preview at that fraction of full
+    resolution, which is much cheaper than a full decode.
+
+    S3 inputs are downloaded to tmp_dir and removed once decoded, or with
+    in_memory_input, JPEGs are decoded straight from memory.
+
+    With web_optimized, the image is warped once at conversion time into
+    EPSG:3857, aligned to the web mercator tile grid at its native zoom, with
+    internal blocks (and overviews) of tile_size pixels, so a tiler can serve
+    tiles as plain window reads.
+
+    If a profiling.ImageProfile is given, the time and memory used by each stage
+    of the conversion are recorded in it.
+
+    The encoding profile sets the compression, quality, internal tiling,
+    overviews and GDAL threads used to write the COG.
+
+    With incremental, outputs are tagged with a key of their inputs (see
+    conversion_key), and an image is only converted if the key of the existing
+    output differs, e.g. because its rotation matrix was revised. The check is
+    made before an S3 input is downloaded. If input_img_path is a local copy
+    (e.g. fetched ahead by the pipeline), source_path is the input it was
+    copied from, which is what the key identifies.
+
+    The EXIF records of local inputs are cached in the SQLite file named by the
+    PLACE_EXIF_CACHE environment variable, if it is set.
+
+    Returns the peak RSS (in MB) measured while converting the image, or None
+    if the existing output was up to date."""
+    if profile is None:
+        profile = NULL_PROFILE
+    check_reduction(reduction)
+    (dst_profile, translate_kwargs) = translate_options(encoding, web_optimized, tile_size)
+    # Without a per-image peak (it can only be reset on Linux), the budget is checked against current RSS
+    peak_is_per_image = reset_peak_rss()
+
+    key = None
+    if incremental:
+        with profile.stage("hash"):
+            key = input_conversion_key(
+                source_path or input_img_path,
+                transformation_matrix,
+                footprint,
+                reduction=reduction,
+                web_optimized=web_optimized,
+                tile_size=tile_size,
+                encoding=encoding,
+            )
+            if read_conversion_key(dest_tif_path) == key:
+                return None
+
+    with open_input(input_img_path, tmp_dir, in_memory_input, profile) as source:
+        # Temporary copies of S3 inputs are never seen again, so aren't worth caching
+        cache_exif = source is input_img_path and not is_temp_copy(input_img_path, tmp_dir)
+        if is_jpg(input_img_path):
+            (rgb, exif) = process_jpg(source, reduction, profile, cache_exif)
+        else:
+            (rgb, exif) = process_raw(source, reduction, profile, cache_exif)
+    check_memory_budget(memory_budget_mb, "decode")
 
     crs = CRS.from_epsg(4326)
 
@@ -93,75 +500,185 @@ def cogify(
     img_width = rgb.shape[1]
     bands = rgb.shape[2]
 
-    # get lat/lng/altitude from exif
-    position = tags["GPSInfo"]
-    latitude = degrees_to_radians(position[1], position[2][0], position[2][1], position[2][2])
-    longitude = degrees_to_radians(position[3], position[4][0], position[4][1], position[4][2])
-    altitude = position[6] - 0.12
-
-    # approximate in meters
-    earth_radius = 6378
-    # meters/longitude increases as latitude shifts away from equator
-    ms_per_lng = ((math.pi/180) * earth_radius * math.cos(latitude*math.pi/180)) * 1000
-    ms_per_lat = 111.3171 * 1000
-
-
-    # GSD (ground sampling distance) formula used to estimate pixel extent
-    # (flight altitude x sensor height or width) / (focal length x image height or width)
-    
-    # magical numbers (based on the sensor dimensions for the Sony ILCE-7M2)
-    # sensor_width_cm = 35.8 * 0.1
-    # sensor_height_cm = 23.9 * 0.1
-    # focal_length_cm = 24 * 0.1
-    # altitude_cm = altitude * 100
-
-    # magical numbers (based on the sensor dimensions for the Sony ILCE-6000)
-    sensor_width_cm = 23.5 * 0.1
-    sensor_height_cm = 15.6 * 0.1
-    focal_length_cm = 16 * 0.1
-    altitude_cm = altitude * 100
-
-    x_resolution = (altitude_cm * sensor_width_cm) / (focal_length_cm * img_width)
-    y_resolution = (altitude_cm * sensor_height_cm) / (focal_length_cm * img_height)
-    # print(f"x resolution in cm: {x_resolution}")
-    # print(f"y resolution in cm: {y_resolution}")
-
-    # Construct offsets from the lat/lng center corresponding to image boundaries
-    # (division by 100 to move from cm to meters)
-    m_y_offset = ((img_height / 2) * y_resolution) / 100
-    m_x_offset = ((img_width / 2) * x_resolution) / 100
-
-    # Here, we determine lat/lng offsets
-    lat_offset = m_y_offset / ms_per_lat
-    lng_offset = m_x_offset / ms_per_lng
-    # print(f"lat offset {lat_offset}")
-    # print(f"lng offset {lng_offset}")
-
-    # Carry out OPK based rotation
-    rotated = rotate(latitude, longitude, lat_offset, lng_offset, transformation_matrix)
-    reshaped = reshape_as_raster(rgb)
-
-    # Construct ground control points relating the corners of the image to new, rotated and offset locations
-    tl = GroundControlPoint(0, 0, rotated["TL"][1], rotated["TL"][0], rotated["TL"][2])
-    bl = GroundControlPoint(img_height, 0, rotated["BL"][1], rotated["BL"][0], rotated["BL"][2])
-    tr = GroundControlPoint(0, img_width, rotated["TR"][1], rotated["TR"][0], rotated["TR"][2])
-    br = GroundControlPoint(img_height, img_width, rotated["BR"][1], rotated["BR"][0], rotated["BR"][2])
-    transform = rio.transform.from_gcps([tl, bl, tr, br])
-    with MemoryFile() as memfile:
-        with memfile.open(
-            driver="GTiff", height=img_height, width=img_width,
-            bands=bands, count=bands, dtype=str(rgb.dtype), crs=crs,
-            transform=transform, nodata=1
-        ) as mem:
-            # Populate the input file with numpy array
-            mem.update_tags(**{tag: tags[tag] for tag in tags if tag in GOOD_EXIF})
-            mem.write(reshaped)
-
-            dst_profile = cog_profiles.get("webp")
-            cog_translate(
-                mem,
-                dest_tif_path,
-                dst_profile,
-                in_memory=True,
-                quiet=True,
-            )
+    with profile.stage("rotate"):
+        if footprint is None:
+            # get lat/lng/altitude from exif
+            if exif.lat is None or exif.lng is None or exif.alt is None:
+                raise ValueError(f"No GPS position in EXIF headers of {input_img_path}")
+            latitude = exif.lat
+            longitude = exif.lng
+            altitude = exif.alt - ALTITUDE_ADJUSTMENT_M
+
+            # Carry out OPK based rotation
+            footprint = compute_footprints(latitude, longitude, altitude, transformation_matrix)[0]
+
+        # Construct ground control points relating the corners of the image to new, rotated and offset locations.
+        # The ground footprint does not depend on resolution, so for previews the GCPs simply pin the
+        # corners of the reduced image and the pixel size grows by the reduction factor.
+        transform = rio.transform.from_gcps(corner_gcps(footprint, img_height, img_width))
+    src_profile = dict(
+        driver="GTiff", height=img_height, width=img_width,
+        count=bands, dtype=str(rgb.dtype), crs=crs,
+        transform=transform, nodata=1
+    )
+    good_tags = cog_tags(exif)
+    if key is not None:
+        good_tags[CONVERSION_KEY_TAG] = key
+
+    if streaming:
+        config = encoding.config()
+        if memory_budget_mb is not None:
+            config["GDAL_CACHEMAX"] = max(int(memory_budget_mb * GDAL_CACHE_SHARE), 16)
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+            src_path = os.path.join(tmp, "source.tif")
+            with profile.stage("write"):
+                write_source_blocks(
+                    rgb,
+                    src_path,
+                    dict(src_profile, tiled=True, blockxsize=STREAMING_BLOCK_SIZE, blockysize=STREAMING_BLOCK_SIZE),
+                    STREAMING_BLOCK_SIZE
+                )
+                with rio.open(src_path, "r+") as src:
+                    src.update_tags(**good_tags)
+            # Release the decoded pixels; everything from here on is read from disk in windows
+            del rgb
+            check_memory_budget(memory_budget_mb, "source write")
+
+            with profile.stage("translate"):
+                cog_translate(
+                    src_path,
+                    dest_tif_path,
+                    dst_profile,
+                    in_memory=False,
+                    config=config,
+                    quiet=True,
+                    **translate_kwargs
+                )
+    else:
+        reshaped = reshape_as_raster(rgb)
+        with MemoryFile() as memfile:
+            with memfile.open(**src_profile) as mem:
+                with profile.stage("write"):
+                    # Populate the input file with numpy array
+                    mem.update_tags(**good_tags)
+                    mem.write(reshaped)
+
+                with profile.stage("translate"):
+                    cog_translate(
+                        mem,
+                        dest_tif_path,
+                        dst_profile,
+                        in_memory=True,
+                        config=encoding.config(),
+                        quiet=True,
+                        **translate_kwargs
+                    )
+
+    # Profiled stages reset the peak counter as they start, so also take the highest stage peak
+    peak_mb = max(peak_rss_mb(), profile.peak_rss_mb())
+    if memory_budget_mb is not None:
+        try:
+            if peak_is_per_image and peak_mb > memory_budget_mb:
+                raise MemoryBudgetExceeded(
+                    f"Peak RSS of {peak_mb:.0f}MB exceeded budget of {memory_budget_mb:.0f}MB for {input_img_path}"
+                )
+            check_memory_budget(memory_budget_mb, "translate")
+        except MemoryBudgetExceeded:
+            # An image converted over budget fails, rather than passing for a success
+            if os.path.exists(dest_tif_path):
+                os.remove(dest_tif_path)
+            raise
+    return peak_mb
+
+
+def add_cogify_args(parser: argparse.ArgumentParser, streaming: bool = True, in_memory_input: bool = True) -> None:
+    """Add the conversion options of cogify() to a CLI (see cogify_options_from_args).
+
+    streaming adds --streaming, --memory-budget-mb and --tmp-dir, and
+    in_memory_input adds --in-memory-input. The EXIF cache and encoding options
+    are always added."""
+    if streaming:
+        parser.add_argument(
+            "--streaming",
+            help="Write the decoded image to a temporary GTiff block by block and translate it from disk",
+            action="store_true"
+        )
+
+        parser.add_argument(
+            "--memory-budget-mb",
+            type=float,
+            help="Peak RSS budget per image (in MB), checked between conversion stages; an image that goes over it fails",
+            required=False
+        )
+
+        parser.add_argument(
+            "--tmp-dir",
+            help="Directory for temporary files written in streaming mode",
+            required=False
+        )
+
+    parser.add_argument(
+        "--preview",
+        type=int,
+        choices=[2, 4, 8],
+        help="Decode a quick-look preview at 1/2, 1/4 or 1/8 of full resolution",
+        required=False
+    )
+
+    parser.add_argument(
+        "--web-optimized",
+        help="Warp to EPSG:3857 aligned to the web mercator tile grid, with internal tiles the size of map tiles",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        choices=WEB_TILE_SIZES,
+        help="Map tile size (in pixels) of web optimized output (defaults to 256)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--incremental",
+        help="Only convert images whose input, rotation matrix or output options changed since their output was written",
+        action="store_true"
+    )
+
+    if in_memory_input:
+        parser.add_argument(
+            "--in-memory-input",
+            help="Decode JPEGs downloaded from S3 straight from memory instead of a temporary file",
+            action="store_true"
+        )
+
+    parser.add_argument(
+        "--exif-cache",
+        help="SQLite file caching the EXIF records of local input images across runs "
+             "(defaults to the PLACE_EXIF_CACHE environment variable, if set)",
+        required=False
+    )
+
+    add_encoding_args(parser)
+
+
+def cogify_options_from_args(args: Dict[str, Any], num_threads: Optional[Union[int, str]] = None) -> Dict[str, Any]:
+    """cogify() keyword arguments from parsed CLI arguments (see add_cogify_args).
+
+    num_threads is the encoding's GDAL thread count unless --num-threads is given."""
+    options = {
+        "reduction": args.get("preview", 1),
+        "web_optimized": args["web_optimized"],
+        "tile_size": args.get("tile_size", 256),
+        "incremental": args["incremental"],
+        "encoding": encoding_from_args(dict({"num_threads": num_threads}, **args)),
+    }
+    if "streaming" in args:
+        options.update(
+            streaming=args["streaming"],
+            memory_budget_mb=args.get("memory_budget_mb"),
+            tmp_dir=args.get("tmp_dir"),
+        )
+    if "in_memory_input" in args:
+        options["in_memory_input"] = args["in_memory_input"]
+    return options
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import argparse
+from typing import Any, Dict, NamedTuple, Optional, Union
+
+from rio_cogeo.profiles import cog_profiles
+
+# Compressions offered by the CLIs (any rio-cogeo profile name works from code)
+COMPRESSIONS = ("webp", "jpeg", "deflate", "zstd", "lzw")
+OVERVIEW_RESAMPLINGS = ("nearest", "bilinear", "cubic", "average", "lanczos", "mode")
+# GTiff creation option controlling the quality of each lossy compression
+QUALITY_OPTIONS = {"webp": "webp_level", "jpeg": "jpeg_quality"}
+
+
+class EncodingProfile(NamedTuple):
+    """How a COG is encoded: compression, internal tiling, overviews and threads"""
+
+    # rio-cogeo profile name
+    compress: str = "webp"
+    # 1-100, for webp and jpeg; None keeps the GDAL default
+    quality: Optional[int] = None
+    # Size (in pixels) of the square internal tiles
+    blocksize: int = 512
+    overview_resampling: str = "nearest"
+    # Number of overview levels; None builds them down to a single tile
+    overview_level: Optional[int] = None
+    # GDAL threads used to compress tiles and build overviews, an int or "ALL_CPUS".
+    # None leaves it to the GDAL_NUM_THREADS environment variable (single threaded if unset).
+    num_threads: Optional[Union[int, str]] = None
+
+    def dst_profile(self) -> Dict[str, Any]:
+        """GTiff creation options for cog_translate"""
+        profile = cog_profiles.get(self.compress)
+        profile.update(blockxsize=self.blocksize, blockysize=self.blocksize)
+        if self.quality is not None:
+            if self.compress not in QUALITY_OPTIONS:
+                raise ValueError(f"Quality only applies to {tuple(QUALITY_OPTIONS)} compression, not {self.compress}")
+            profile[QUALITY_OPTIONS[self.compress]] = self.quality
+        if self.num_threads is not None:
+            profile["num_threads"] = self.num_threads
+        return profile
+
+    def config(self) -> Dict[str, str]:
+        """GDAL configuration options for cog_translate"""
+        if self.num_threads is None:
+            return {}
+        return {"GDAL_NUM_THREADS": str(self.num_threads)}
+
+    def output_options(self) -> Dict[str, Any]:
+        """The settings which change the encoded output (threads only change how fast it is written)"""
+        options = self._asdict()
+        del options["num_threads"]
+        return options
+
+
+DEFAULT_ENCODING = EncodingProfile()
+
+
+def num_threads_arg(value: str) -> Union[int, str]:
+    if value.upper() == "ALL_CPUS":
+        return "ALL_CPUS"
+    return int(value)
+
+
+def add_encoding_args(parser: argparse.ArgumentParser) -> None:
+    """Add the options of an EncodingProfile to a CLI"""
+    parser.add_argument(
+        "--compress",
+        choices=COMPRESSIONS,
+        help=f"COG compression (defaults to {DEFAULT_ENCODING.compress})",
+        required=False
+    )
+
+    parser.add_argument(
+        "--quality",
+        type=int,
+        help="Quality (1-100) of webp or jpeg compression",
+        required=False
+    )
+
+    parser.add_argument(
+        "--blocksize",
+        type=int,
+        choices=[256, 512, 1024],
+        help=f"Internal tile size of the COG (defaults to {DEFAULT_ENCODING.blocksize})",
+        required=False
+    )
+
+    parser.add_argument(
+        "--overview-resampling",
+        choices=OVERVIEW_RESAMPLINGS,
+        help=f"Resampling used to build overviews (defaults to {DEFAULT_ENCODING.overview_resampling})",
+        required=False
+    )
+
+    parser.add_argument(
+        "--overview-level",
+        type=int,
+        help="Number of overview levels (defaults to as many as fit the image)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--num-threads",
+        type=num_threads_arg,
+        help="GDAL threads used to encode each COG, a number or ALL_CPUS",
+        required=False
+    )
+
+
+def encoding_from_args(args: Dict[str, Any]) -> EncodingProfile:
+    """Build an EncodingProfile from parsed CLI arguments (see add_encoding_args)"""
+    return DEFAULT_ENCODING._replace(
+        **{field: args[field] for field in EncodingProfile._fields if args.get(field) is not None}
+    )
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+import argparse
+from contextlib import ExitStack
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pystac
+from pystac.utils import str_to_datetime
+
+from place.common.catalog import ExtentAccumulator, NdjsonWriter
+from place.common.cog_catalog import STATS_METHODS, STATS_OVERVIEW, catalog_cog
+from place.common.exif import write_jpeg_gps_file
+from place.common.exif_cache import set_default_cache
+
+from cogify import ALTITUDE_ADJUSTMENT_M, add_cogify_args, cogify, cogify_options_from_args, compute_footprints
+from pipeline import StageStats, start_process_pool
+from rotation import construct_rotation_matrices
+from version import __version__
+from util.tabular import load_flight_table
+
+# Jobs waiting between two stages; a full queue holds back the stage feeding it
+DEFAULT_QUEUE_SIZE = 8
+DEFAULT_TAG_WORKERS = 4
+DEFAULT_CATALOG_WORKERS = 4
+DEFAULT_BATCH_SIZE = 50
+# A partial batch is loaded once no item has arrived for this long, so items become searchable promptly
+LOAD_IDLE_SECONDS = 1.0
+LATENCY_PERCENTILES = (50, 95)
+# Marks the end of a stage's input
+_DONE = object()
+
+
+class Job(object):
+    """One image on its way from JPG to searchable STAC item"""
+
+    def __init__(self, image_id: str, jpg_path: str, rotation: np.ndarray, xyz: Optional[np.ndarray], footprint: Optional[np.ndarray]):
+        self.id = image_id
+        self.jpg_path = jpg_path
+        self.rotation = rotation
+        self.xyz = xyz
+        self.footprint = footprint
+        self.cog_path: Optional[str] = None
+        self.item: Optional[Dict[str, Any]] = None
+        self.started = time.perf_counter()
+
+
+class Stage(object):
+    """Worker threads taking jobs from an inbox, running work(job) on them and passing them on.
+
+    A job whose work raises is recorded as failed and goes no further. Once
+    _DONE arrives and every worker has finished, _DONE is passed on in turn."""
+
+    def __init__(self, name: str, workers: int, work: Callable[[Job], None], inbox: queue.Queue, outbox: queue.Queue, failures: List):
+        self.name = name
+        self.work = work
+        self.inbox = inbox
+        self.outbox = outbox
+        self.failures = failures
+        self.stats = StageStats(name, workers)
+        self._running = workers
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name=f"{name}-{idx}", daemon=True) for idx in range(workers)]
+
+    def start(self) -> "Stage":
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def _run(self) -> None:
+        while True:
+            job = self.inbox.get()
+            if job is _DONE:
+                # Let this stage's other workers see the end of the input too
+                self.inbox.put(_DONE)
+                break
+            start = time.perf_counter()
+            try:
+                self.work(job)
+            except Exception as e:
+                error = "".join(traceback.format_exception_only(type(e), e)).strip()
+                print(f"Failure: {self.name} failed for {job.id}: {error}")
+                self.failures.append((job.id, self.name, error))
+                continue
+            self.stats.record(time.perf_counter() - start)
+            self.outbox.put(job)
+        with self._lock:
+            self._running -= 1
+            if self._running == 0:
+                self.outbox.put(_DONE)
+
+
+def convert(jpg_path: str, cog_path: str, rotation: np.ndarray, footprint: Optional[np.ndarray], cogify_options: Dict[str, Any]) -> Optional[float]:
+    """Run in the conversion processes"""
+    return cogify(jpg_path, cog_path, rotation, footprint=footprint, **cogify_options)
+
+
+class Sink(object):
+    """The last stage: items are written to NDJSON and/or batch loaded into pgstac.
+
+    Records each job's end-to-end latency once its item is written or loaded,
+    and accumulates the extent of those items. A failed write fails its job, and a failed load every job in the batch;
+    either way the sink carries on draining its inbox."""
+
+    def __init__(self, inbox: queue.Queue, writer: Optional[NdjsonWriter], loader, batch_size: int, failures: List):
+        self.inbox = inbox
+        self.writer = writer
+        self.loader = loader
+        self.batch_size = batch_size
+        self.failures = failures
+        self.stats = StageStats("load", 1)
+        self.latencies: List[float] = []
+        self.extent = ExtentAccumulator()
+        self._unloaded: List[Job] = []
+        self.thread = threading.Thread(target=self._run, name="load", daemon=True)
+
+    def start(self) -> "Sink":
+        self.thread.start()
+        return self
+
+    def _done(self, jobs: List[Job]) -> None:
+        now = time.perf_counter()
+        self.latencies += [now - job.started for job in jobs]
+        for job in jobs:
+            properties = job.item["properties"]
+            start = properties.get("datetime") or properties.get("start_datetime")
+            end = properties.get("end_datetime")
+            self.extent.add(
+                job.item["bbox"],
+                str_to_datetime(start) if start else None,
+                str_to_datetime(end) if end else None,
+            )
+
+    def _fail(self, jobs: List[Job], stage: str, e: Exception) -> None:
+        error = "".join(traceback.format_exception_only(type(e), e)).strip()
+        print(f"Failure: {stage} failed for {len(jobs)} items: {error}")
+        self.failures.extend((job.id, stage, error) for job in jobs)
+
+    def _flush(self) -> None:
+        if self._unloaded:
+            (jobs, self._unloaded) = (self._unloaded, [])
+            try:
+                self.loader.flush()
+            except Exception as e:
+                self._fail(jobs, "load", e)
+                return
+            self._done(jobs)
+
+    def _flush_partial(self) -> None:
+        start = time.perf_counter()
+        self._flush()
+        self.stats.busy_seconds += time.perf_counter() - start
+
+    def _add(self, job: Job) -> None:
+        self._unloaded.append(job)
+        try:
+            # Loads the batch once it is full
+            self.loader.add(job.item)
+        except Exception as e:
+            (jobs, self._unloaded) = (self._unloaded, [])
+            self._fail(jobs, "load", e)
+            return
+        if len(self._unloaded) >= self.batch_size:
+            self._flush()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                job = self.inbox.get(timeout=LOAD_IDLE_SECONDS if self._unloaded else None)
+            except queue.Empty:
+                self._flush_partial()
+                continue
+            if job is _DONE:
+                break
+            start = time.perf_counter()
+            if self.writer is not None:
+                try:
+                    self.writer.write(job.item)
+                except Exception as e:
+                    self._fail([job], "write", e)
+                    continue
+            if self.loader is not None:
+                self._add(job)
+            else:
+                self._done([job])
+            self.stats.record(time.perf_counter() - start)
+        if self.loader is not None:
+            self._flush_partial()
+
+
+def build_collection(collection_id: str, description: str, extent: Optional[ExtentAccumulator] = None) -> Dict[str, Any]:
+    """A collection with the extent of its items, or a global placeholder until they are loaded"""
+    if extent is None or extent.count == 0:
+        extent = pystac.Extent(
+            pystac.SpatialExtent([[-180, -90, 180, 90]]),
+            pystac.TemporalExtent([[None, None]]),
+        )
+    else:
+        extent = pystac.Extent(
+            pystac.SpatialExtent([extent.bbox]),
+            pystac.TemporalExtent([[extent.start, extent.end]]),
+        )
+    collection = pystac.Collection(collection_id, description, extent, license="PLACE Research License")
+    collection.links = []
+    return collection.to_dict(include_self_link=False)
+
+
+def flight_jobs(args: Dict[str, Any]) -> Tuple[List[Job], int]:
+    """A job per image in the PKO table (and in the location table, if given), and the count skipped"""
+    pko_table = load_flight_table(args["pko_table"], offset=1)
+    if "location_table" not in args:
+        rotations = construct_rotation_matrices(pko_table.rotations)
+        jobs = [
+            Job(image_id, f"{args['jpg_dir']}/{image_id}.JPG", rotation, None, None)
+            for (image_id, rotation) in zip(pko_table.ids, rotations)
+        ]
+        return (jobs, 0)
+
+    location_table = load_flight_table(args["location_table"])
+    pko_rows = {pko_id: idx for idx, pko_id in enumerate(pko_table.ids)}
+    location_rows = [idx for idx, location_id in enumerate(location_table.ids) if location_id in pko_rows]
+    ids = location_table.ids[location_rows]
+    xyz = location_table.xyz[location_rows]
+    rotations = construct_rotation_matrices(pko_table.rotations[[pko_rows[image_id] for image_id in ids]])
+    footprints = compute_footprints(xyz[:, 1], xyz[:, 0], xyz[:, 2] - ALTITUDE_ADJUSTMENT_M, rotations)
+    jobs = [
+        Job(image_id, f"{args['jpg_dir']}/{image_id}.JPG", rotation, position, footprint)
+        for (image_id, rotation, position, footprint) in zip(ids, rotations, xyz, footprints)
+    ]
+    return (jobs, len(location_table.ids) - len(jobs))
+
+
+def run_pipeline(args: Dict[str, Any]) -> Dict[str, Any]:
+    (jobs, skipped) = flight_jobs(args)
+    if skipped:
+        print(f"Warning: {skipped} images in the location table are not in the PKO table; skipping them")
+    tag_gps = "location_table" in args
+    tagged_dir = args.get("tagged_dir", os.path.join(args["output_dir"], "jpg"))
+    os.makedirs(args["output_dir"], exist_ok=True)
+    if tag_gps:
+        os.makedirs(tagged_dir, exist_ok=True)
+
+    cogify_options = cogify_options_from_args(args)
+    convert_workers = args.get("convert_workers", os.cpu_count())
+    queue_size = args.get("queue_size", DEFAULT_QUEUE_SIZE)
+    failures: List[Tuple[str, str, str]] = []
+    collection_description = args.get("collection_description", args["collection_id"])
+
+    def tag(job: Job) -> None:
+        tagged_path = os.path.join(tagged_dir, os.path.basename(job.jpg_path))
+        (lng, lat, alt) = job.xyz
+        write_jpeg_gps_file(job.jpg_path, tagged_path, lat, lng, alt)
+        job.jpg_path = tagged_path
+
+    def catalog(job: Job) -> None:
+        href = job.cog_path
+        if "href_prefix" in args:
+            href = f"{args['href_prefix'].rstrip('/')}/{os.path.basename(job.cog_path)}"
+        item = catalog_cog(job.cog_path, collection=args["collection_id"], stats=args["stats"], asset_href=href)
+        item.links = []
+        job.item = item.to_dict(include_self_link=False)
+
+    with ExitStack() as stack:
+        # Started before any stage threads (see start_process_pool)
+        pool = stack.enter_context(start_process_pool(convert_workers))
+
+        def convert_job(job: Job) -> None:
+            job.cog_path = os.path.join(args["output_dir"], f"{job.id}.tif")
+            # If a worker dies (e.g. OOM killed) this raises BrokenProcessPool rather than waiting forever
+            pool.submit(convert, job.jpg_path, job.cog_path, job.rotation, job.footprint, cogify_options).result()
+
+        writer = stack.enter_context(NdjsonWriter(args["items_file"])) if "items_file" in args else None
+        loader = None
+        if args["pgstac"]:
+            # Only needed (and so only imported) when loading into pgstac
+            from place.common.pgstac import BatchLoader, PgstacDB
+            loader = stack.enter_context(BatchLoader(stack.enter_context(PgstacDB()), args["method"], args["batch_size"]))
+            # Items can only be loaded into an existing collection, so a placeholder is created
+            # if needed and given its real extent at the end. An existing collection is left as
+            # it is: this run may only add to it (e.g. one flight of several), so the extent of
+            # its items alone would shrink the collection's.
+            created_collection = not loader.has_collection(args["collection_id"])
+            if created_collection:
+                loader.load_collections([build_collection(args["collection_id"], collection_description)], "ignore")
+
+        queues = [queue.Queue(maxsize=queue_size) for _ in range(4)]
+        stage_specs = []
+        if tag_gps:
+            stage_specs.append(("tag", args.get("tag_workers", DEFAULT_TAG_WORKERS), tag))
+        stage_specs += [
+            ("convert", convert_workers, convert_job),
+            ("catalog", args.get("catalog_workers", DEFAULT_CATALOG_WORKERS), catalog),
+        ]
+        stages = [
+            Stage(name, workers, work, queues[idx], queues[idx + 1], failures).start()
+            for (idx, (name, workers, work)) in enumerate(stage_specs)
+        ]
+        sink = Sink(queues[len(stages)], writer, loader, args["batch_size"], failures).start()
+
+        start = time.perf_counter()
+        print(f"Ingesting {len(jobs)} images through {' -> '.join(name for (name, _, _) in stage_specs)} -> load")
+        for job in jobs:
+            job.started = time.perf_counter()
+            queues[0].put(job)
+        queues[0].put(_DONE)
+        sink.thread.join()
+        if loader is not None and created_collection and sink.extent.count:
+            loader.load_collections([build_collection(args["collection_id"], collection_description, sink.extent)], "upsert")
+        wall_seconds = time.perf_counter() - start
+
+    return summarize(wall_seconds, [stage.stats for stage in stages] + [sink.stats], sink.latencies, failures)
+
+
+def summarize(wall_seconds: float, stats: List[StageStats], latencies: List[float], failures: List) -> Dict[str, Any]:
+    print(f"Pipeline made {len(latencies)} items searchable in {wall_seconds:.1f}s "
+          f"({len(latencies) / wall_seconds if wall_seconds > 0 else 0:.2f} items/s)")
+    for stage in stats:
+        print(stage.summary(wall_seconds))
+    if latencies:
+        percentiles = ", ".join(f"p{p} {np.percentile(latencies, p):.1f}s" for p in LATENCY_PERCENTILES)
+        print(f"End-to-end latency: {percentiles}, max {max(latencies):.1f}s")
+    if failures:
+        print(f"{len(failures)} images failed:")
+        for (image_id, stage, error) in failures:
+            print(f"  {image_id} ({stage}): {error}")
+    return {"wall_seconds": wall_seconds, "stages": stats, "latencies": latencies, "failures": failures}
+
+
+def parse_args(args: List[str]) -> Optional[Dict[str, Any]]:
+    desc = "PLACE streaming ingest: GPS tag, convert to COG, catalogue and load into pgstac, one image at a time"
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument(
+        "--version",
+        help="Print version and exit",
+        action="version",
+        version=__version__,
+    )
+
+    parser.add_argument(
+        "--jpg-dir",
+        help="Directory of jpg images to ingest.",
+        required=True,
+    )
+
+    parser.add_argument(
+        "--output-dir",
+        help="Location to save output COGs",
+        required=True
+    )
+
+    parser.add_argument(
+        "--pko-table",
+        help="Table of phi, kappa, omega transformation values",
+        required=True
+    )
+
+    parser.add_argument(
+        "--location-table",
+        help="Table of imagery locations; when given, images are GPS tagged from it before conversion",
+        required=False
+    )
+
+    parser.add_argument(
+        "--tagged-dir",
+        help="Location to save GPS tagged jpgs (defaults to jpg/ in the output directory)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--collection-id",
+        help="STAC collection the items belong to (created in pgstac, with the extent of the items loaded, if it doesn't exist)",
+        required=True
+    )
+
+    parser.add_argument(
+        "--collection-description",
+        help="Description of the collection, if it has to be created",
+        required=False
+    )
+
+    parser.add_argument(
+        "--href-prefix",
+        help="URL or path prefix for COG assets (defaults to their local path)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--items-file",
+        help="Also write the items to this newline-delimited JSON file",
+        required=False
+    )
+
+    parser.add_argument(
+        "--pgstac",
+        help="Load items into pgstac (connection from PG* environment variables)",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--method",
+        choices=["insert", "upsert", "ignore"],
+        default="upsert",
+        help="How items are loaded into pgstac",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Most items loaded into pgstac per transaction; smaller batches are loaded when the pipeline is idle",
+    )
+
+    parser.add_argument(
+        "--stats",
+        choices=STATS_METHODS,
+        default=STATS_OVERVIEW,
+        help="How raster statistics are computed for each item",
+    )
+
+    parser.add_argument(
+        "--tag-workers",
+        type=int,
+        help=f"Threads GPS tagging images (defaults to {DEFAULT_TAG_WORKERS})",
+        required=False
+    )
+
+    parser.add_argument(
+        "--convert-workers",
+        type=int,
+        help="Number of conversion processes (defaults to the number of cores)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--catalog-workers",
+        type=int,
+        help=f"Threads creating STAC items (defaults to {DEFAULT_CATALOG_WORKERS})",
+        required=False
+    )
+
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        help=f"Images waiting between two stages at most (defaults to {DEFAULT_QUEUE_SIZE})",
+        required=False
+    )
+
+    add_cogify_args(parser, streaming=False, in_memory_input=False)
+
+    parsed = parser.parse_args(args)
+    if not parsed.pgstac and parsed.items_file is None:
+        parser.error("Nowhere to put the items: give --pgstac and/or --items-file")
+    parsed_args = {
+        k: v for k, v in vars(parsed).items() if v is not None
+    }
+
+    return parsed_args
+
+
+def main(argv: List[str]):
+    """Ingest every image in a PKO table; returns the pipeline summary"""
+    args = parse_args(argv)
+    if "exif_cache" in args:
+        set_default_cache(args["exif_cache"])
+    return run_pipeline(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
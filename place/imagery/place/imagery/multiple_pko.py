@@ -1,20 +1,38 @@
 #!/usr/bin/env python3
 import argparse
-from multiprocessing import Pool
+from functools import partial
+import os
 import sys
 from typing import Any, Dict, List, Optional
 
-import botocore
+from place.common.exif_cache import set_default_cache
 
-from cogify import cogify
-from rotation import construct_rotation_matrix
+from batch import run_batch
+from cogify import add_cogify_args, cogify, cogify_options_from_args, is_up_to_date
+from profiling import ImageProfile, print_summary, write_report
+from rotation import construct_rotation_matrices
 from version import __version__
-from util.tabular import parse_table
+from util.tabular import load_flight_table
 
-def cogify_with_status(path, output_path, rotation_matrix):
-    print(f"Processing imagery from {path}")
-    cogify(path, output_path, rotation_matrix)
-    print(f"Successfully processed; results: {output_path}")
+def cogify_with_status(path, output_path, rotation_matrix, cogify_options, profiling=False, source_path=None):
+    print(f"Processing imagery from {source_path or path}")
+    profile = ImageProfile(output_path) if profiling else None
+    peak_mb = cogify(path, output_path, rotation_matrix, profile=profile, source_path=source_path, **cogify_options)
+    if peak_mb is None:
+        print(f"Unchanged; {output_path} is up to date")
+    else:
+        print(f"Successfully processed; results: {output_path} (peak RSS: {peak_mb:.0f}MB)")
+    return profile.records if profiling else None
+
+
+def output_is_current(task, cogify_options) -> bool:
+    """Whether a task's output is up to date, checked before its input is fetched"""
+    (path, output_path, rotation_matrix) = task[:3]
+    options = {key: cogify_options[key] for key in ("reduction", "web_optimized", "tile_size", "encoding")}
+    if is_up_to_date(path, output_path, rotation_matrix, **options):
+        print(f"Unchanged; {output_path} is up to date")
+        return True
+    return False
 
 
 def parse_args(args: List[str]) -> Optional[Dict[str, Any]]:
@@ -45,35 +63,103 @@ def parse_args(args: List[str]) -> Optional[Dict[str, Any]]:
         required=True
     )
 
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="Number of conversion processes (defaults to the number of cores)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help="Run as a pipeline, fetching up to this many inputs ahead of the conversion processes",
+        required=False
+    )
+
+    parser.add_argument(
+        "--download-threads",
+        type=int,
+        help="Number of threads fetching inputs in pipeline mode (defaults to --prefetch)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--manifest",
+        help="SQLite manifest recording per-image status, used to resume interrupted runs "
+             "(defaults to manifest.sqlite in the output directory)",
+        required=False
+    )
+
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help="Number of times to retry an image after a transient failure",
+    )
+
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=1,
+        help="Number of images handed to a conversion process at a time",
+    )
+
+    parser.add_argument(
+        "--profile-report",
+        help="Record per-stage wall time, CPU time and peak RSS and write p50/p95 per stage to this JSON or CSV file",
+        required=False
+    )
+
+    add_cogify_args(parser)
+
     parsed_args = {
         k: v for k, v in vars(parser.parse_args(args)).items() if v is not None
     }
 
     return parsed_args
 
-if __name__ == "__main__":
-    args = parse_args(sys.argv[1:])
 
-    pko_lookup = parse_table(args["pko_table"], offset=1)
+def main(argv: List[str]):
+    """Convert every image in a PKO table; returns the batch summary"""
+    args = parse_args(argv)
+    if "exif_cache" in args:
+        set_default_cache(args["exif_cache"])
+
+    pko_table = load_flight_table(args["pko_table"], offset=1)
 
+    # Build the rotation stack for the whole flight at once
+    ids = pko_table.ids
+    rotation_matrices = construct_rotation_matrices(pko_table.rotations)
+
+    cogify_options = cogify_options_from_args(args)
     params = []
-    for id, pko_dict in pko_lookup.items():
-        rotation_matrix = construct_rotation_matrix([
-            float(pko_dict["r11"]),
-            float(pko_dict["r12"]),
-            float(pko_dict["r13"]),
-            float(pko_dict["r21"]),
-            float(pko_dict["r22"]),
-            float(pko_dict["r23"]),
-            float(pko_dict["r31"]),
-            float(pko_dict["r32"]),
-            float(pko_dict["r33"])
-        ])
+    for id, rotation_matrix in zip(ids, rotation_matrices):
         jpg_path = f"{args['jpg_dir']}/{id}.JPG"
         output_path = f"{args['output_dir']}/{id}.tif"
-        params.append((jpg_path, output_path, rotation_matrix))
-    try:
-        with Pool() as p:
-            p.starmap(cogify_with_status, params)
-    except botocore.exceptions.ClientError:
-        print(f"Failure: Unable to find imagery at {jpg_path}")
\ No newline at end of file
+        # The input path is passed on too, since in pipeline mode the task runs on a local copy
+        params.append((jpg_path, output_path, rotation_matrix, cogify_options, "profile_report" in args, jpg_path))
+    summary = run_batch(
+        params,
+        cogify_with_status,
+        args.get("manifest", os.path.join(args["output_dir"], "manifest.sqlite")),
+        processes=args.get("processes"),
+        chunksize=args["chunksize"],
+        retries=args["retries"],
+        prefetch=args.get("prefetch"),
+        download_threads=args.get("download_threads"),
+        tmp_dir=args.get("tmp_dir"),
+        # Incremental runs check each output's conversion key instead of trusting the manifest
+        skip_complete=not args["incremental"],
+        is_current=partial(output_is_current, cogify_options=cogify_options) if args["incremental"] else None
+    )
+
+    if "profile_report" in args:
+        records = [record for result in summary["results"] if result.value for record in result.value]
+        print(f"Writing stage profile to {args['profile_report']}")
+        print_summary(write_report(records, args["profile_report"]))
+    return summary
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
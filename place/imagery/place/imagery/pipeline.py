@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from cogify import download_s3_to_temp
+
+
+class StageStats(object):
+    """Thread-safe accumulator of the work done by one pipeline stage"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.count = 0
+        self.busy_seconds = 0.0
+        self.nbytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, nbytes: int = 0) -> None:
+        with self._lock:
+            self.count += 1
+            self.busy_seconds += seconds
+            self.nbytes += nbytes
+
+    def utilization(self, wall_seconds: float) -> float:
+        """Share of the stage's worker capacity spent busy over the run"""
+        if wall_seconds <= 0:
+            return 0.0
+        return self.busy_seconds / (wall_seconds * self.workers)
+
+    def summary(self, wall_seconds: float) -> str:
+        per_item = self.busy_seconds / self.count if self.count else 0.0
+        rate = self.count / wall_seconds if wall_seconds > 0 else 0.0
+        line = (
+            f"{self.name:>10}: {self.count} items, {rate:.2f} items/s, "
+            f"{per_item:.2f}s/item, {self.workers} workers {self.utilization(wall_seconds):.0%} busy"
+        )
+        if self.nbytes:
+            line += f", {self.nbytes / 1024 / 1024 / wall_seconds:.1f} MB/s"
+        return line
+
+
+def fetch_input(path: str, tmp_dir: Optional[str] = None) -> Tuple[str, bool]:
+    """Make an input available on local disk.
+
+    Returns the local path and whether it is a temporary copy to be removed after use.
+    S3 inputs are downloaded; local inputs are read ahead into the page cache."""
+    if path.lower().startswith("s3"):
+        return (download_s3_to_temp(path, tmp_dir=tmp_dir), True)
+
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    return (path, False)
+
+
+def start_process_pool(processes: int, initializer: Optional[Callable[..., None]] = None, initargs: Tuple[Any, ...] = ()) -> ProcessPoolExecutor:
+    """A ProcessPoolExecutor whose worker processes are already running.
+
+    With the fork start method, the workers are forked on the first submit.
+    Submitting here, before the caller starts any threads, keeps the workers
+    from inheriting a lock another thread happened to hold at that moment (e.g.
+    in boto3, or cogify's S3 client cache) and deadlocking on it."""
+    pool = ProcessPoolExecutor(processes, initializer=initializer, initargs=initargs)
+    try:
+        pool.submit(_noop).result()
+    except BaseException:
+        pool.shutdown()
+        raise
+    return pool
+
+
+def run_pipelined(
+    tasks: Iterable[Tuple[Any, ...]],
+    process: Callable[..., Any],
+    processes: Optional[int] = None,
+    prefetch: int = 4,
+    download_threads: Optional[int] = None,
+    tmp_dir: Optional[str] = None,
+    on_result: Optional[Callable[[Tuple[Any, ...], Any, Optional[str]], None]] = None,
+    initializer: Optional[Callable[..., None]] = None,
+    initargs: Tuple[Any, ...] = (),
+    skip: Optional[Callable[[Tuple[Any, ...]], bool]] = None,
+    fetch: Callable[[str, Optional[str]], Tuple[str, bool]] = fetch_input
+) -> Dict[str, Any]:
+    """Run (input_path, *args) tasks through download and process stages concurrently.
+
+    A thread pool fetches inputs ahead of the process pool, which calls
+    process(local_path, *args) for each of them. At most `processes + prefetch`
+    inputs are fetched but unfinished at any time, which bounds temp-disk and
+    memory use. If given, on_result(task, return_value, error) is called as each
+    task finishes. initializer(*initargs) is run in each worker process as it
+    starts. If skip(task) is true (checked before fetching), the task finishes
+    at once with no return value. Inputs are fetched with fetch(input_path,
+    tmp_dir) (see fetch_input), e.g. to retry failed downloads.
+
+    Every task finishes exactly once, whatever fails: if a worker process dies,
+    the pool is broken and its outstanding (and any later) tasks fail rather
+    than leaving the run waiting for them. Returns per-stage statistics and the
+    failed tasks."""
+    processes = processes or os.cpu_count()
+    download_threads = download_threads or prefetch
+    slots = threading.BoundedSemaphore(processes + prefetch)
+    stats = {
+        "download": StageStats("download", download_threads),
+        "convert": StageStats("convert", processes),
+    }
+    failures: List[Tuple[Tuple[Any, ...], str]] = []
+    submitted = 0
+    finished = threading.Condition()
+    finished_count = [0]
+
+    def finish(task, local_path, is_temp, value=None, error=None):
+        try:
+            if is_temp and os.path.exists(local_path):
+                os.remove(local_path)
+            if error is not None:
+                print(f"Failure: Unable to process imagery at {task[0]}: {error}")
+                failures.append((task, error))
+            if on_result is not None:
+                on_result(task, value, error)
+        finally:
+            slots.release()
+            with finished:
+                finished_count[0] += 1
+                finished.notify_all()
+
+    def on_done(task, local_path, is_temp, future):
+        try:
+            (seconds, value) = future.result()
+        except BaseException as e:
+            finish(task, local_path, is_temp, error=repr(e))
+            return
+        stats["convert"].record(seconds)
+        finish(task, local_path, is_temp, value)
+
+    def is_skipped(task):
+        try:
+            return skip is not None and skip(task)
+        except Exception:
+            # Processing the task will find out properly
+            return False
+
+    def download_and_submit(pool, task):
+        if is_skipped(task):
+            finish(task, task[0], False)
+            return
+        (local_path, is_temp) = (task[0], False)
+        start = time.perf_counter()
+        try:
+            (local_path, is_temp) = fetch(task[0], tmp_dir)
+            stats["download"].record(time.perf_counter() - start, os.path.getsize(local_path))
+            future = pool.submit(_timed_call, process, local_path, *task[1:])
+        except Exception as e:
+            # Nothing was submitted, so this is the task's only chance to finish
+            finish(task, local_path, is_temp, error=repr(e))
+            return
+        future.add_done_callback(lambda future: on_done(task, local_path, is_temp, future))
+
+    start = time.perf_counter()
+    # The workers are started before the download threads, which submit to them
+    with start_process_pool(processes, initializer, initargs) as pool, \
+            ThreadPoolExecutor(download_threads) as downloader:
+        for task in tasks:
+            # Backpressure: wait for a slot before fetching another input
+            slots.acquire()
+            submitted += 1
+            downloader.submit(download_and_submit, pool, task)
+        with finished:
+            finished.wait_for(lambda: finished_count[0] == submitted)
+    wall_seconds = time.perf_counter() - start
+
+    print(f"Pipeline finished {submitted} tasks in {wall_seconds:.1f}s")
+    for stage in stats.values():
+        print(stage.summary(wall_seconds))
+    bottleneck = max(stats.values(), key=lambda stage: stage.utilization(wall_seconds))
+    print(f"Bottleneck stage: {bottleneck.name}")
+
+    return {"wall_seconds": wall_seconds, "stages": stats, "failures": failures}
+
+
+def _noop() -> None:
+    pass
+
+
+def _timed_call(process: Callable[..., Any], *args) -> Tuple[float, Any]:
+    start = time.perf_counter()
+    value = process(*args)
+    return (time.perf_counter() - start, value)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+from contextlib import contextmanager
+import csv
+import json
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple
+
+import numpy as np
+
+from util.memory import peak_rss_mb, reset_peak_rss
+
+# Stages of cogify(), in the order they run
+STAGES = ("download", "hash", "exif", "decode", "rotate", "write", "translate")
+PERCENTILES = (50, 95)
+
+
+class StageRecord(NamedTuple):
+    image: str
+    stage: str
+    wall_seconds: float
+    cpu_seconds: float
+    peak_rss_mb: float
+
+
+class NullProfile(object):
+    """Profile that records nothing; used when profiling is off"""
+
+    @contextmanager
+    def stage(self, name: str):
+        yield
+
+    def peak_rss_mb(self) -> float:
+        return 0.0
+
+
+NULL_PROFILE = NullProfile()
+
+
+class ImageProfile(object):
+    """Wall time, CPU time and peak RSS of each stage of converting one image"""
+
+    def __init__(self, image: str):
+        self.image = image
+        self.records: List[StageRecord] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        reset_peak_rss()
+        wall_start = time.perf_counter()
+        # Process CPU time includes the threads GDAL and rawpy spin up
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.records.append(StageRecord(
+                self.image,
+                name,
+                time.perf_counter() - wall_start,
+                time.process_time() - cpu_start,
+                peak_rss_mb()
+            ))
+
+    def peak_rss_mb(self) -> float:
+        """Highest peak RSS over all recorded stages"""
+        return max((record.peak_rss_mb for record in self.records), default=0.0)
+
+
+def summarize_stages(records: Iterable[StageRecord]) -> Dict[str, Dict[str, float]]:
+    """Aggregate stage records (from any number of images and workers) into per-stage percentiles"""
+    by_stage: Dict[str, List[StageRecord]] = {}
+    for record in records:
+        by_stage.setdefault(record.stage, []).append(record)
+
+    ordered = [stage for stage in STAGES if stage in by_stage]
+    ordered += sorted(stage for stage in by_stage if stage not in STAGES)
+    summary = {}
+    for stage in ordered:
+        values = np.array([record[2:] for record in by_stage[stage]], dtype=np.float64)
+        stage_summary = {"count": len(values), "wall_seconds_total": float(values[:, 0].sum())}
+        for (column, name) in enumerate(("wall_seconds", "cpu_seconds", "peak_rss_mb")):
+            for percentile in PERCENTILES:
+                stage_summary[f"{name}_p{percentile}"] = float(np.percentile(values[:, column], percentile))
+        summary[stage] = stage_summary
+    return summary
+
+
+def write_report(records: List[StageRecord], report_path: str) -> Dict[str, Dict[str, float]]:
+    """Write per-stage percentiles to a CSV report, or percentiles plus every record to a JSON report"""
+    summary = summarize_stages(records)
+    if report_path.lower().endswith(".csv"):
+        with open(report_path, "w", newline="") as f:
+            fields = ["stage"] + list(next(iter(summary.values()), {}).keys())
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            for stage, stage_summary in summary.items():
+                writer.writerow({"stage": stage, **stage_summary})
+    else:
+        with open(report_path, "w") as f:
+            json.dump(
+                {"stages": summary, "records": [record._asdict() for record in records]},
+                f,
+                indent=2
+            )
+    return summary
+
+
+def print_summary(summary: Dict[str, Dict[str, Any]]) -> None:
+    for stage, stage_summary in summary.items():
+        print(
+            f"{stage:>10}: wall p50 {stage_summary['wall_seconds_p50']:.3f}s p95 {stage_summary['wall_seconds_p95']:.3f}s, "
+            f"cpu p50 {stage_summary['cpu_seconds_p50']:.3f}s, peak RSS p95 {stage_summary['peak_rss_mb_p95']:.0f}MB"
+        )
@@ -4,10 +4,16 @@ import math
 
 import numpy as np
 
+# Order in which image corners are reported by the rotation helpers
+CORNERS = ("TR", "BR", "TL", "BL")
+# Signs applied to the (lat, lng) offsets from the image center for each corner, in CORNERS order
+_CORNER_SIGNS = np.array([
+    [1, 1],
+    [-1, 1],
+    [1, -1],
+    [-1, -1]
+], dtype=np.float64)
 
-def flatten(xss):
-    """Efficiently flatten a python list."""
-    return [x for xs in xss for x in xs]
 
 def construct_rotation_matrix(matrix_elements) -> np.matrix:
     """Construct rotation matrix from matrix elements"""
@@ -17,6 +23,10 @@ def construct_rotation_matrix(matrix_elements) -> np.matrix:
         [matrix_elements[6], matrix_elements[7], matrix_elements[8]]
     ])
 
+def construct_rotation_matrices(matrix_elements) -> np.ndarray:
+    """Construct an (N, 3, 3) rotation stack from an (N, 9) block of row-major matrix elements"""
+    return np.asarray(matrix_elements, dtype=np.float64).reshape((-1, 3, 3))
+
 def construct_rotation_matrix_opk(omega, phi, kappa) -> np.matrix:
     """Construct rotation matrix with omega, phi, kappa values.
     
@@ -40,40 +50,45 @@ def construct_rotation_matrix_opk(omega, phi, kappa) -> np.matrix:
     # Construct the full, 3d rotation matrix 
     return np.matmul(np.matmul(rotation_x, rotation_y), rotation_z)
 
-def _rotate_point(point, rotation_matrix, latitude, longitude) -> np.ndarray:
-    """Apply rotation matrix to a point"""
+def rotate_batch(latitudes, longitudes, lat_offsets, lng_offsets, rotation_matrices) -> np.ndarray:
+    """Rotate the extents of N images around their centers in a single operation.
+
+    Centers and offsets may be scalars or length N sequences; rotation_matrices
+    is an (N, 3, 3) stack (a single 3x3 matrix is treated as N=1). Returns an
+    (N, 4, 3) array of (lat, lng, z) corners ordered as CORNERS."""
 
     # TODO: We need to verify whether the lat offset should be reflected across the y-axis. See note:
-    '''Note that the x/y axes of this (3D) image coordinate system are not
-    aligned with the standard (2D) image coordinate system that is used to
-    describe (pixel) positions on an image: The y-axis is flipped.'''
-    rotated = rotation_matrix.dot(point)
-    reshaped = rotated.reshape((3,1))
-    reshaped[0] = latitude + reshaped[0]
-    reshaped[1] = longitude + reshaped[1]
-    return reshaped
+    # Note that the x/y axes of this (3D) image coordinate system are not
+    # aligned with the standard (2D) image coordinate system that is used to
+    # describe (pixel) positions on an image: The y-axis is flipped.
+    rotation_matrices = construct_rotation_matrices(rotation_matrices)
+    count = rotation_matrices.shape[0]
+    latitudes = np.broadcast_to(np.asarray(latitudes, dtype=np.float64), (count,))
+    longitudes = np.broadcast_to(np.asarray(longitudes, dtype=np.float64), (count,))
+    lat_offsets = np.broadcast_to(np.asarray(lat_offsets, dtype=np.float64), (count,))
+    lng_offsets = np.broadcast_to(np.asarray(lng_offsets, dtype=np.float64), (count,))
+
+    # Construct lat/lng offsets from the image center for every corner of every image
+    offsets = np.zeros((count, len(CORNERS), 3))
+    offsets[:, :, 0] = lat_offsets[:, np.newaxis] * _CORNER_SIGNS[:, 0]
+    offsets[:, :, 1] = lng_offsets[:, np.newaxis] * _CORNER_SIGNS[:, 1]
+
+    # Rotate all extent points around the center of their image, then move them to that center
+    rotated = np.einsum("nij,nkj->nki", rotation_matrices, offsets)
+    rotated[:, :, 0] += latitudes[:, np.newaxis]
+    rotated[:, :, 1] += longitudes[:, np.newaxis]
+    return rotated
 
 def rotate(latitude, longitude, lat_offset, lng_offset, rotation_matrix, debug=False):
     """Construct an omega-phi-kappa transformation matrix to rotate extent around image center"""
 
-    # Construct lat/lng offsets from the image center
-    IMG_TR = np.array((lat_offset, lng_offset, 0))
-    IMG_BR = np.array((-lat_offset, lng_offset, 0))
-    IMG_TL = np.array((lat_offset, -lng_offset, 0))
-    IMG_BL = np.array((-lat_offset, -lng_offset, 0))
-    # Rotate all extent points around center of image
-    TR_ROTATED = _rotate_point(IMG_TR, rotation_matrix, latitude, longitude)
-    BR_ROTATED = _rotate_point(IMG_BR, rotation_matrix, latitude, longitude)
-    TL_ROTATED = _rotate_point(IMG_TL, rotation_matrix, latitude, longitude)
-    BL_ROTATED = _rotate_point(IMG_BL, rotation_matrix, latitude, longitude)
+    rotated = rotate_batch(latitude, longitude, lat_offset, lng_offset, rotation_matrix)[0]
 
-    results = {
-        "TR": flatten(TR_ROTATED.tolist()),
-        "BR": flatten(BR_ROTATED.tolist()),
-        "TL": flatten(TL_ROTATED.tolist()),
-        "BL": flatten(BL_ROTATED.tolist()),
-    }
+    results = {corner: rotated[idx].tolist() for idx, corner in enumerate(CORNERS)}
     if debug:
-        results["INPUTS"] = [IMG_TR, IMG_BR, IMG_TL, IMG_BL],
-        results["OUTPUTS"] = [TR_ROTATED, BR_ROTATED, TL_ROTATED, BL_ROTATED]
-    return results
\ No newline at end of file
+        results["INPUTS"] = [
+            np.array((lat_offset * lat_sign, lng_offset * lng_sign, 0))
+            for lat_sign, lng_sign in _CORNER_SIGNS
+        ]
+        results["OUTPUTS"] = [rotated[idx].reshape((3, 1)) for idx in range(len(CORNERS))]
+    return results
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import resource
+import sys
+
+
+def _read_status_kb(field):
+    """Read a memory field (in kB) from /proc/self/status, if available"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak RSS counter of this process so it can be measured per image.
+
+    Only supported on Linux; returns False when the counter could not be reset."""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def current_rss_mb() -> float:
+    """Resident set size of this process in MB"""
+    rss_kb = _read_status_kb("VmRSS")
+    if rss_kb is None:
+        return peak_rss_mb()
+    return rss_kb / 1024
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB (since the last reset_peak_rss)"""
+    peak_kb = _read_status_kb("VmHWM")
+    if peak_kb is None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is reported in bytes on macOS and in kB elsewhere
+        peak_kb = max_rss / 1024 if sys.platform == "darwin" else max_rss
+    return peak_kb / 1024
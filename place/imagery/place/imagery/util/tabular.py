@@ -1,65 +1,164 @@
 #!/usr/bin/env python3
 
-import openpyxl
 import csv
+import os
+import tempfile
+from typing import NamedTuple, Optional
+
+import numpy as np
+import openpyxl
+
+# Column headings of the row-major rotation matrix elements in PKO tables
+ROTATION_KEYS = ("r11", "r12", "r13", "r21", "r22", "r23", "r31", "r32", "r33")
+# Column headings of image positions (longitude, latitude, altitude) in location and PKO tables
+XYZ_KEYS = ("X", "Y", "Z")
+# Bump when the layout of cached sidecars changes
+SIDECAR_VERSION = 1
+
+
+class FlightTable(NamedTuple):
+    """Columnar view of a location or PKO table"""
+
+    ids: np.ndarray
+    # (N, 9) row-major rotation matrix elements, if the table has them
+    rotations: Optional[np.ndarray] = None
+    # (N, 3) X/Y/Z positions, if the table has them
+    xyz: Optional[np.ndarray] = None
+
 
+def _iter_xlsx_rows(xlsx_path):
+    # Read only mode streams rows rather than building the whole workbook in memory
+    wb = openpyxl.load_workbook(xlsx_path, read_only=True)
+    try:
+        yield from wb.active.iter_rows(values_only=True)
+    finally:
+        wb.close()
 
-def _construct_lookup_from_xlsx(xlsx_path, offset):
-    """Parse xlsx data format to lookup table"""
-    wb = openpyxl.load_workbook(xlsx_path)
-    ws = wb.active
-
-    records = {}
-    header_row = 0 + offset
-    for idx, row in enumerate(ws.iter_rows(values_only=True)):
-        if idx < header_row:
-            pass
-        elif idx == header_row:
-            row_length = len(row)
-            column_headings = row
-            def parse_row(new_row):
-                row_dict = {}
-                for col_idx in range(row_length):
-                    row_dict[column_headings[col_idx]] = new_row[col_idx]
-                records[new_row[0]] = row_dict
-        else:
-            parse_row(row)
-
-    return records
-
-
-def _construct_lookup_from_csv(csv_path, offset, delimiter=","):
-    """Parse csv data format to lookup table"""
-    records = {}
-    header_row = 0 + offset
+
+def _iter_csv_rows(csv_path, delimiter=","):
     with open(csv_path, newline='') as csvfile:
-        reader = csv.reader(csvfile, delimiter=delimiter, quotechar='|')
-        for idx, row in enumerate(reader):
-            if idx < header_row:
-                pass
-            elif idx == header_row:
-                row_length = len(row)
-                column_headings = row
-                def parse_row(new_row):
-                    row_dict = {}
-                    for col_idx in range(row_length):
-                        row_dict[column_headings[col_idx]] = new_row[col_idx]
-                    records[new_row[0]] = row_dict
-            else:
-                parse_row(row)
-
-    return records
+        yield from csv.reader(csvfile, delimiter=delimiter, quotechar='|')
 
 
-def parse_table(tabular_data_path, offset=0):
-    """Parse tabular data format to lookup table"""
+def _iter_rows(tabular_data_path):
+    """Iterate over the rows of a tabular data file"""
     extension = tabular_data_path.split(".")[-1]
     if (extension == "xlsx"):
-        records = _construct_lookup_from_xlsx(tabular_data_path, offset)
+        return _iter_xlsx_rows(tabular_data_path)
     elif (extension == "csv"):
-        records = _construct_lookup_from_csv(tabular_data_path, offset)
+        return _iter_csv_rows(tabular_data_path)
     elif (extension == "txt"):
-        records = _construct_lookup_from_csv(tabular_data_path, offset, "\t")
+        return _iter_csv_rows(tabular_data_path, "\t")
     else:
         raise ValueError(f"Currently supported extensions: xlsx and csv. Unable to process {extension}.")
-    return records
+
+
+def _iter_records(tabular_data_path, offset):
+    """Yield the column headings, then each (non-empty) data row"""
+    rows = _iter_rows(tabular_data_path)
+    for _ in range(offset):
+        next(rows, None)
+    yield next(rows, ())
+    for row in rows:
+        if row and row[0] is not None and row[0] != "":
+            yield row
+
+
+def parse_table(tabular_data_path, offset=0):
+    """Parse tabular data format to lookup table"""
+    records = _iter_records(tabular_data_path, offset)
+    column_headings = next(records)
+    return {row[0]: dict(zip(column_headings, row)) for row in records}
+
+
+def _sidecar_path(tabular_data_path):
+    return f"{tabular_data_path}.npz"
+
+
+def _read_sidecar(tabular_data_path, offset) -> Optional[FlightTable]:
+    """Read a cached table, unless it is stale or was parsed differently"""
+    sidecar_path = _sidecar_path(tabular_data_path)
+    try:
+        with np.load(sidecar_path, allow_pickle=False) as cached:
+            if (
+                int(cached["version"]) != SIDECAR_VERSION
+                or int(cached["source_mtime_ns"]) != os.stat(tabular_data_path).st_mtime_ns
+                or int(cached["offset"]) != offset
+            ):
+                return None
+            return FlightTable(
+                ids=cached["ids"],
+                rotations=cached["rotations"] if "rotations" in cached else None,
+                xyz=cached["xyz"] if "xyz" in cached else None,
+            )
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _write_sidecar(tabular_data_path, offset, table: FlightTable) -> None:
+    arrays = {name: value for name, value in table._asdict().items() if value is not None}
+    sidecar_path = _sidecar_path(tabular_data_path)
+    tmp_path = None
+    try:
+        # Write under a unique temporary name and rename, so readers never see a partial
+        # sidecar and concurrent writers (e.g. several runs on one table) don't clobber each other
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(sidecar_path)),
+            prefix=f".{os.path.basename(sidecar_path)}.",
+            suffix=".tmp",
+            delete=False,
+        ) as f:
+            tmp_path = f.name
+            np.savez(
+                f,
+                version=SIDECAR_VERSION,
+                source_mtime_ns=os.stat(tabular_data_path).st_mtime_ns,
+                offset=offset,
+                **arrays
+            )
+        os.replace(tmp_path, sidecar_path)
+    except OSError:
+        # The cache is only an optimization; tables in read-only locations are parsed every time
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _parse_flight_table(tabular_data_path, offset) -> FlightTable:
+    records = _iter_records(tabular_data_path, offset)
+    column_headings = list(next(records))
+    rotation_idxs = [column_headings.index(key) for key in ROTATION_KEYS if key in column_headings]
+    xyz_idxs = [column_headings.index(key) for key in XYZ_KEYS if key in column_headings]
+    has_rotations = len(rotation_idxs) == len(ROTATION_KEYS)
+    has_xyz = len(xyz_idxs) == len(XYZ_KEYS)
+
+    ids = []
+    values = []
+    value_idxs = (rotation_idxs if has_rotations else []) + (xyz_idxs if has_xyz else [])
+    for row in records:
+        ids.append(str(row[0]))
+        values.append([row[idx] for idx in value_idxs])
+
+    # A single conversion of the whole block replaces per-value float() calls
+    block = np.array(values, dtype=np.float64).reshape((len(ids), len(value_idxs)))
+    rotation_count = len(ROTATION_KEYS) if has_rotations else 0
+    return FlightTable(
+        ids=np.array(ids, dtype=str),
+        rotations=block[:, :rotation_count] if has_rotations else None,
+        xyz=block[:, rotation_count:] if has_xyz else None,
+    )
+
+
+def load_flight_table(tabular_data_path, offset=0, use_cache=True) -> FlightTable:
+    """Load a location or PKO table as NumPy arrays.
+
+    The parsed arrays are cached in a .npz sidecar next to the table, which is
+    used for as long as the table's modification time is unchanged."""
+    if use_cache:
+        cached = _read_sidecar(tabular_data_path, offset)
+        if cached is not None:
+            return cached
+
+    table = _parse_flight_table(tabular_data_path, offset)
+    if use_cache:
+        _write_sidecar(tabular_data_path, offset, table)
+    return table
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The imagery modules import each other as siblings (they are run as scripts from their directory)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "place", "imagery"))
@@ -0,0 +1,192 @@
+from multiprocessing import Value
+import os
+
+import pytest
+
+import batch
+from batch import STATUS_DONE, STATUS_FAILED, Manifest, TaskResult, adaptive_num_threads, is_complete, retry, run_batch
+
+
+def convert(input_path, output_path):
+    """Stands in for a conversion: copies the input, or raises the error it names"""
+    with open(input_path) as f:
+        content = f.read()
+    if content == "ValueError":
+        raise ValueError("corrupt input")
+    if content == "OSError":
+        raise OSError("transient failure")
+    if content == "crash":
+        # Dies without raising, like an OOM killed worker
+        os._exit(1)
+    with open(output_path, "w") as f:
+        f.write(content)
+    return content
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(batch, "RETRY_DELAY", 0)
+
+
+@pytest.fixture
+def unfinished(monkeypatch):
+    """The count of unfinished tasks of each run_batch call"""
+    counts = []
+
+    def shared_value(*args):
+        counts.append(Value(*args))
+        return counts[-1]
+
+    monkeypatch.setattr(batch, "Value", shared_value)
+    return counts
+
+
+def _tasks(tmp_path, contents):
+    (tmp_path / "in").mkdir(exist_ok=True)
+    (tmp_path / "out").mkdir(exist_ok=True)
+    tasks = []
+    for (idx, content) in enumerate(contents):
+        input_path = tmp_path / "in" / f"D{idx}.JPG"
+        if content is not None:
+            input_path.write_text(content)
+        tasks.append((str(input_path), str(tmp_path / "out" / f"D{idx}.tif")))
+    return tasks
+
+
+def _by_input(summary):
+    return {os.path.basename(result.input_path): result for result in summary["results"]}
+
+
+def test_retry():
+    calls = []
+
+    def flaky():
+        calls.append(None)
+        if len(calls) < 3:
+            raise OSError("try again")
+        return "ok"
+
+    assert retry(flaky, 2) == (3, "ok", None)
+    calls.clear()
+    (attempts, value, error) = retry(flaky, 1)
+    assert (attempts, value) == (2, None)
+    assert error == "OSError: try again"
+
+
+def test_retry_gives_up_on_non_retryable_errors():
+    calls = []
+
+    def corrupt():
+        calls.append(None)
+        raise ValueError("corrupt input")
+
+    assert retry(corrupt, 5) == (1, None, "ValueError: corrupt input")
+    assert len(calls) == 1
+
+
+def test_is_complete(tmp_path):
+    with Manifest(str(tmp_path / "manifest.sqlite")) as manifest:
+        output = tmp_path / "out.tif"
+        assert not is_complete(manifest, "in.JPG", str(output))
+        manifest.record(TaskResult("in.JPG", str(output), STATUS_DONE, 1))
+        # Recorded as done, but the output has since gone
+        assert not is_complete(manifest, "in.JPG", str(output))
+        output.write_text("converted")
+        assert is_complete(manifest, "in.JPG", str(output))
+        manifest.record(TaskResult("in.JPG", str(output), STATUS_FAILED, 3, "error"))
+        # Recorded as failed, and the output isn't a valid COG
+        assert not is_complete(manifest, "in.JPG", str(output))
+
+
+@pytest.mark.parametrize("prefetch", [None, 2])
+def test_resume_skips_completed_tasks(tmp_path, prefetch):
+    tasks = _tasks(tmp_path, ["a", "ValueError", "c"])
+    manifest_path = str(tmp_path / "manifest.sqlite")
+    summary = run_batch(tasks, convert, manifest_path, processes=2, prefetch=prefetch)
+    assert (summary["done"], summary["skipped"], len(summary["failed"])) == (2, 0, 1)
+
+    # Only the failed task is run again, and it succeeds once its input is fixed
+    (tmp_path / "in" / "D1.JPG").write_text("b")
+    summary = run_batch(tasks, convert, manifest_path, processes=2, prefetch=prefetch)
+    assert (summary["done"], summary["skipped"], len(summary["failed"])) == (1, 2, 0)
+    assert _by_input(summary)["D1.JPG"].value == "b"
+
+    summary = run_batch(tasks, convert, manifest_path, processes=2, prefetch=prefetch)
+    assert (summary["done"], summary["skipped"], summary["results"]) == (0, 3, [])
+    with Manifest(manifest_path) as manifest:
+        assert [manifest.status(input_path) for (input_path, _) in tasks] == [STATUS_DONE] * 3
+
+
+@pytest.mark.parametrize("prefetch", [None, 2])
+def test_retries(tmp_path, prefetch):
+    tasks = _tasks(tmp_path, ["a", "ValueError", "OSError"])
+    results = _by_input(run_batch(tasks, convert, str(tmp_path / "manifest.sqlite"), processes=2, retries=2, prefetch=prefetch))
+    assert (results["D0.JPG"].status, results["D0.JPG"].attempts) == (STATUS_DONE, 1)
+    # Not worth retrying
+    assert (results["D1.JPG"].status, results["D1.JPG"].attempts) == (STATUS_FAILED, 1)
+    assert results["D1.JPG"].error == "ValueError: corrupt input"
+    # Retried, then given up on
+    assert (results["D2.JPG"].status, results["D2.JPG"].attempts) == (STATUS_FAILED, 3)
+
+
+def test_fetch_failures(tmp_path, unfinished, monkeypatch):
+    fetches = []
+
+    def fetch_input(input_path, tmp_dir=None):
+        fetches.append(input_path)
+        if input_path.endswith("D1.JPG"):
+            raise OSError("connection reset")
+        if not os.path.exists(input_path):
+            raise FileNotFoundError(input_path)
+        return (input_path, False)
+
+    monkeypatch.setattr(batch, "fetch_input", fetch_input)
+    tasks = _tasks(tmp_path, ["a", "b", None])
+    summary = run_batch(tasks, convert, str(tmp_path / "manifest.sqlite"), processes=2, retries=2, prefetch=2)
+    results = _by_input(summary)
+    assert results["D0.JPG"].status == STATUS_DONE
+    # Fetches are retried like conversions, and recorded against the task when they give up
+    assert (results["D1.JPG"].status, results["D1.JPG"].attempts) == (STATUS_FAILED, 3)
+    assert results["D1.JPG"].error == "OSError: connection reset"
+    assert (results["D2.JPG"].status, results["D2.JPG"].attempts) == (STATUS_FAILED, 1)
+    assert fetches.count(tasks[1][0]) == 3
+    # Tasks which never reached a worker are counted off too
+    assert unfinished[0].value == 0
+
+
+def test_skipped_as_current(tmp_path, unfinished):
+    tasks = _tasks(tmp_path, ["a", "b"])
+    summary = run_batch(
+        tasks, convert, str(tmp_path / "manifest.sqlite"), processes=2, prefetch=2,
+        skip_complete=False, is_current=lambda task: task[0].endswith("D1.JPG")
+    )
+    results = _by_input(summary)
+    assert (results["D0.JPG"].status, results["D0.JPG"].attempts) == (STATUS_DONE, 1)
+    assert (results["D1.JPG"].status, results["D1.JPG"].attempts) == (STATUS_DONE, 0)
+    assert not os.path.exists(tasks[1][1])
+    assert unfinished[0].value == 0
+
+
+def test_worker_crash(tmp_path, unfinished):
+    tasks = _tasks(tmp_path, ["a", "crash", "c", "d"])
+    summary = run_batch(tasks, convert, str(tmp_path / "manifest.sqlite"), processes=1, prefetch=1)
+    results = _by_input(summary)
+    # Every task finishes; the crashed one (and any the broken pool had yet to run) as failed
+    assert len(results) == 4
+    assert results["D1.JPG"].status == STATUS_FAILED
+    assert "BrokenProcessPool" in results["D1.JPG"].error
+    with Manifest(str(tmp_path / "manifest.sqlite")) as manifest:
+        assert manifest.status(tasks[1][0]) == STATUS_FAILED
+    # Whether or not a worker got to count a task off, every task is counted off once
+    assert unfinished[0].value == 0
+
+
+def test_adaptive_num_threads():
+    # Every process busy: the cores are shared between them
+    assert adaptive_num_threads(100, 4, cpus=16) == 4
+    # Fewer images left than processes: the idle cores go to those still running
+    assert adaptive_num_threads(2, 4, cpus=16) == 8
+    assert adaptive_num_threads(1, 4, cpus=16) == 16
+    assert adaptive_num_threads(0, 4, cpus=16) == 16
+    # Never less than one thread
+    assert adaptive_num_threads(100, 32, cpus=16) == 1
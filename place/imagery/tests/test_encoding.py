@@ -0,0 +1,49 @@
+import argparse
+
+import pytest
+
+from encoding import DEFAULT_ENCODING, EncodingProfile, add_encoding_args, encoding_from_args, num_threads_arg
+
+
+def _parse(argv):
+    parser = argparse.ArgumentParser()
+    add_encoding_args(parser)
+    return {k: v for k, v in vars(parser.parse_args(argv)).items() if v is not None}
+
+
+def test_defaults():
+    assert encoding_from_args(_parse([])) == DEFAULT_ENCODING
+    assert DEFAULT_ENCODING.config() == {}
+    assert "num_threads" not in DEFAULT_ENCODING.dst_profile()
+
+
+def test_from_args():
+    encoding = encoding_from_args(_parse([
+        "--compress", "jpeg", "--quality", "85", "--blocksize", "256",
+        "--overview-resampling", "average", "--overview-level", "3", "--num-threads", "all_cpus",
+    ]))
+    assert encoding == EncodingProfile("jpeg", 85, 256, "average", 3, "ALL_CPUS")
+    profile = encoding.dst_profile()
+    assert (profile["blockxsize"], profile["blockysize"]) == (256, 256)
+    assert profile["jpeg_quality"] == 85
+    assert profile["num_threads"] == "ALL_CPUS"
+    assert encoding.config() == {"GDAL_NUM_THREADS": "ALL_CPUS"}
+
+
+def test_quality_needs_lossy_compression():
+    with pytest.raises(ValueError):
+        EncodingProfile(compress="deflate", quality=90).dst_profile()
+
+
+def test_threads_dont_change_output_options():
+    assert EncodingProfile(num_threads=4).output_options() == DEFAULT_ENCODING.output_options()
+    assert "num_threads" not in DEFAULT_ENCODING.output_options()
+    assert EncodingProfile(compress="zstd").output_options() != DEFAULT_ENCODING.output_options()
+
+
+def test_num_threads_arg():
+    assert num_threads_arg("ALL_CPUS") == "ALL_CPUS"
+    assert num_threads_arg("all_cpus") == "ALL_CPUS"
+    assert num_threads_arg("6") == 6
+    with pytest.raises(ValueError):
+        num_threads_arg("many")
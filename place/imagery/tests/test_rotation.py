@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from rotation import CORNERS, construct_rotation_matrices, construct_rotation_matrix, construct_rotation_matrix_opk, rotate, rotate_batch
+
+
+def _flight(count, seed=0):
+    rng = np.random.default_rng(seed)
+    latitudes = rng.uniform(-60, 60, count)
+    longitudes = rng.uniform(-180, 180, count)
+    lat_offsets = rng.uniform(1e-4, 1e-3, count)
+    lng_offsets = rng.uniform(1e-4, 1e-3, count)
+    matrices = np.stack([
+        np.asarray(construct_rotation_matrix_opk(*rng.uniform(-np.pi, np.pi, 3))) for _ in range(count)
+    ])
+    return (latitudes, longitudes, lat_offsets, lng_offsets, matrices)
+
+
+def test_rotate_batch_matches_rotate():
+    (latitudes, longitudes, lat_offsets, lng_offsets, matrices) = _flight(50)
+    corners = rotate_batch(latitudes, longitudes, lat_offsets, lng_offsets, matrices)
+    assert corners.shape == (50, len(CORNERS), 3)
+    for idx in range(50):
+        single = rotate(latitudes[idx], longitudes[idx], lat_offsets[idx], lng_offsets[idx], construct_rotation_matrix(matrices[idx].ravel()))
+        np.testing.assert_allclose(corners[idx], [single[corner] for corner in CORNERS])
+
+
+def test_rotate_batch_flat_matrix_elements():
+    (latitudes, longitudes, lat_offsets, lng_offsets, matrices) = _flight(5)
+    np.testing.assert_array_equal(
+        rotate_batch(latitudes, longitudes, lat_offsets, lng_offsets, matrices.reshape((5, 9))),
+        rotate_batch(latitudes, longitudes, lat_offsets, lng_offsets, matrices),
+    )
+
+
+def test_rotate_batch_broadcasts_scalars():
+    (_, _, _, _, matrices) = _flight(3)
+    corners = rotate_batch(45.0, -122.0, 1e-3, 2e-3, matrices)
+    for idx in range(3):
+        np.testing.assert_allclose(corners[idx], rotate_batch(45.0, -122.0, 1e-3, 2e-3, matrices[idx])[0])
+
+
+def test_identity_rotation_offsets_corners():
+    corners = rotate(45.0, -122.0, 1.0, 2.0, construct_rotation_matrix([1, 0, 0, 0, 1, 0, 0, 0, 1]))
+    assert corners == {
+        "TR": [46.0, -120.0, 0.0],
+        "BR": [44.0, -120.0, 0.0],
+        "TL": [46.0, -124.0, 0.0],
+        "BL": [44.0, -124.0, 0.0],
+    }
+
+
+def test_construct_rotation_matrices_shape():
+    assert construct_rotation_matrices(np.arange(18)).shape == (2, 3, 3)
+    with pytest.raises(ValueError):
+        construct_rotation_matrices(np.arange(10))
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+
+from util.tabular import ROTATION_KEYS, XYZ_KEYS, load_flight_table, parse_table
+
+IDENTITY = [1, 0, 0, 0, 1, 0, 0, 0, 1]
+
+
+def _write_table(path, rows, header_rows=()):
+    with open(path, "w") as f:
+        for row in list(header_rows) + [("id",) + ROTATION_KEYS + XYZ_KEYS] + rows:
+            f.write(",".join(str(value) for value in row) + "\n")
+
+
+def _rows(count, scale=1):
+    return [(f"D{idx}", *[value * scale for value in IDENTITY], idx * 0.5, -idx * 0.25, 100 + idx) for idx in range(count)]
+
+
+def test_load_flight_table(tmp_path):
+    path = str(tmp_path / "pko.csv")
+    _write_table(path, _rows(3), header_rows=[("exported",)])
+    table = load_flight_table(path, offset=1, use_cache=False)
+    assert table.ids.tolist() == ["D0", "D1", "D2"]
+    np.testing.assert_array_equal(table.rotations, np.tile(IDENTITY, (3, 1)))
+    np.testing.assert_array_equal(table.xyz, [[0, 0, 100], [0.5, -0.25, 101], [1, -0.5, 102]])
+    assert not os.path.exists(path + ".npz")
+
+
+def test_matches_parse_table(tmp_path):
+    path = str(tmp_path / "pko.csv")
+    _write_table(path, _rows(4))
+    records = parse_table(path)
+    table = load_flight_table(path, use_cache=False)
+    for (idx, image_id) in enumerate(table.ids):
+        assert table.rotations[idx].tolist() == [float(records[image_id][key]) for key in ROTATION_KEYS]
+        assert table.xyz[idx].tolist() == [float(records[image_id][key]) for key in XYZ_KEYS]
+
+
+def test_missing_columns(tmp_path):
+    path = str(tmp_path / "locations.txt")
+    with open(path, "w") as f:
+        f.write("id\tX\tY\tZ\nD0\t1\t2\t3\n")
+    table = load_flight_table(path, use_cache=False)
+    assert table.rotations is None
+    assert table.xyz.tolist() == [[1, 2, 3]]
+
+
+def test_sidecar_is_used_while_unchanged(tmp_path):
+    path = str(tmp_path / "pko.csv")
+    _write_table(path, _rows(3))
+    first = load_flight_table(path)
+    assert os.path.exists(path + ".npz")
+    # Leftover temporary files would show up next to the sidecar
+    assert sorted(os.listdir(tmp_path)) == ["pko.csv", "pko.csv.npz"]
+
+    # Change the table without changing its mtime: the sidecar is still trusted
+    stat = os.stat(path)
+    _write_table(path, _rows(3, scale=2))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    cached = load_flight_table(path)
+    np.testing.assert_array_equal(cached.rotations, first.rotations)
+    np.testing.assert_array_equal(cached.ids, first.ids)
+
+    # Without the cache the table is parsed again
+    np.testing.assert_array_equal(load_flight_table(path, use_cache=False).rotations, first.rotations * 2)
+
+
+def test_sidecar_is_replaced_after_mtime_change(tmp_path):
+    path = str(tmp_path / "pko.csv")
+    _write_table(path, _rows(3))
+    load_flight_table(path)
+
+    _write_table(path, _rows(5, scale=2))
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    table = load_flight_table(path)
+    assert len(table.ids) == 5
+    np.testing.assert_array_equal(table.rotations, np.tile(IDENTITY, (5, 1)) * 2)
+    # And the refreshed sidecar is used from then on
+    assert load_flight_table(path).ids.tolist() == table.ids.tolist()
+
+
+def test_sidecar_records_offset(tmp_path):
+    path = str(tmp_path / "pko.csv")
+    _write_table(path, _rows(2), header_rows=[("exported",)])
+    assert load_flight_table(path, offset=1).ids.tolist() == ["D0", "D1"]
+    # The sidecar written for offset 1 isn't used for a different offset
+    table = load_flight_table(path, offset=0)
+    assert table.ids.tolist() == ["id", "D0", "D1"]
+    assert table.rotations is None
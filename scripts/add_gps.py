@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 import glob
 import os
 
-from GPSPhoto import gpsphoto
+from place.common.exif import write_jpeg_gps_file
+
+# Images tagged concurrently; tagging is a header splice plus a file copy, so this is I/O bound
+DEFAULT_THREADS = 16
+# Images queued per thread, so a large reference file isn't submitted all at once
+TAG_QUEUE_DEPTH = 4
+
 
 def make_label_geotags(prefix, item):
     return {
@@ -30,15 +37,6 @@ def make_label_nonstandard(prefix, item):
             "altitude": int(round(float(item[2])))
         }
 
-def make_gps(label):
-    return (
-        label["input_file"],
-        gpsphoto.GPSInfo(
-            (float(label["latitude"]), float(label["longitude"])),
-            alt=int(round(float(label["altitude"]), 0))
-        )
-    )
-
 
 def find_csv_files(directory):
     csv_files = []
@@ -51,26 +49,48 @@ def find_csv_files(directory):
 
 
 def run_dir(dir_path):
-    res = []
+    """Yield a label per image as the Geotags.txt (or CSV) reference file is read"""
     if os.path.exists(f"{dir_path}/Geotags.txt"):
         with open(f"{dir_path}/Geotags.txt") as f:
             for line in f:
                 result = line.strip("\n")
                 result = result.split("\t")
-                label = make_label_geotags(dir_path, result)
-                gps = make_gps(label)
-                res.append(gps)
+                yield make_label_geotags(dir_path, result)
     else: # Heuristic to find CSV file if no geotags is found
         csv_file = find_csv_files(dir_path)[0]
         with open(csv_file) as f:
-            lines = f.readlines()[1:]
-        for line in lines:
-            result = line.strip("\n")
-            result = result.split(",")
-            label = make_label_nonstandard(dir_path, result)
-            gps = make_gps(label)
-            res.append(gps)
-    return res
+            next(f)
+            for line in f:
+                result = line.strip("\n")
+                result = result.split(",")
+                yield make_label_nonstandard(dir_path, result)
+
+
+def tag_label(label, output_path):
+    """Tag one image, returning an error message instead of raising"""
+    try:
+        write_jpeg_gps_file(label["input_file"], output_path, label["latitude"], label["longitude"], label["altitude"])
+    except FileNotFoundError:
+        return f"did not find file at {label['input_file']}"
+    except (OSError, ValueError) as e:
+        return f"could not tag {label['input_file']}: {e}"
+    print(f"Writing updated files to {output_path}")
+    return None
+
+
+def tag_all(labels, tag, threads):
+    """Tag the images as their labels are read, with at most a few queued per thread;
+    returns the error messages"""
+    errors = []
+    with ThreadPoolExecutor(threads) as executor:
+        in_flight = set()
+        for label in labels:
+            if len(in_flight) >= threads * TAG_QUEUE_DEPTH:
+                (done, in_flight) = wait(in_flight, return_when=FIRST_COMPLETED)
+                errors.extend(future.result() for future in done)
+            in_flight.add(executor.submit(tag, label))
+        errors.extend(future.result() for future in as_completed(in_flight))
+    return [error for error in errors if error is not None]
 
 
 if __name__ == "__main__":
@@ -83,23 +103,26 @@ if __name__ == "__main__":
                         help='path to the output directory')
     parser.add_argument('-p', '--output_prefix', metavar='OUT_DIRECTORY', type=str,
                         help='path to the output directory', default="")
-    
+    parser.add_argument('-t', '--threads', metavar='THREADS', type=int,
+                        help='images tagged concurrently', default=DEFAULT_THREADS)
+
     args = parser.parse_args()
 
     os.makedirs(args.output_directory, exist_ok=True)
-    errored = []
-    for record in run_dir(args.input_directory):
-        output_filename = f"{args.output_prefix}{os.path.basename(record[0])}"
+    # One listing up front rather than a stat per record
+    existing = set(os.listdir(args.output_directory))
+
+    def tag(label):
+        output_filename = f"{args.output_prefix}{os.path.basename(label['input_file'])}"
         output_path = f"{args.output_directory}/{output_filename}"
         # Skip if the file already exists
-        if os.path.exists(output_path):
+        if output_filename in existing:
             print(f"File {output_path} already exists. Skipping.")
-            continue
-        try:
-            gpsphoto.GPSPhoto(record[0]).modGPSData(record[1], output_path)
-        except FileNotFoundError as e:
-            errored.append(record)
-            print(f"WARNING: did not find file at {record[0]}. Skipping.")
-        print(f"Writing updated files to {output_path}")
-    if len(errored) > 0:
-        print(f"WARNING: {len(errored)} files were not found. See errors above for details.")
\ No newline at end of file
+            return None
+        return tag_label(label, output_path)
+
+    errors = tag_all(run_dir(args.input_directory), tag, args.threads)
+    for error in errors:
+        print(f"WARNING: {error}. Skipping.")
+    if len(errors) > 0:
+        print(f"WARNING: {len(errors)} files could not be tagged. See errors above for details.")
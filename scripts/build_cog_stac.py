@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
-import json
+import argparse
+from contextlib import ExitStack
 import pprint
 import traceback
-from typing import List
 
 import boto3
-from rio_stac import create_stac_item
+from place.common.catalog import NdjsonWriter, to_json_dict
+from place.common.cog_catalog import DEFAULT_SAMPLE_BLOCKS, STATS_METHODS, catalog_cogs
+from place.common.pgstac import BatchLoader, DEFAULT_BATCH_SIZE, METHODS, PgstacDB
+from place.common.s3 import list_s3_keys
 from stac_pydantic.collection import Collection, Extent, SpatialExtent, TimeInterval
-from stac_pydantic.item import Item
 from stac_pydantic.shared import Asset, Provider, ProviderRoles
 
 # Initialize a session with your AWS credentials
@@ -15,17 +17,12 @@ session = boto3.Session()
 
 # Create an S3 client
 s3 = session.client('s3')
-paginator = s3.get_paginator('list_objects_v2')
 
-def list_s3_objects(bucket_name: str, prefix: str):
-    """List all objects in an S3 bucket with a given prefix."""
-    keys = []
-    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-        keys = keys + [obj['Key'] for obj in page.get('Contents', [])]
-    return keys
+# Threads listing the sub-prefixes of the COG prefix concurrently
+LIST_THREADS = 8
 
-def build_stac_collection(collection_id: str, description: str, title: str, items: List[Item]) -> Collection:
-    # global extent
+def build_stac_collection(collection_id: str, description: str, title: str) -> Collection:
+    # global extent; mosaic previews are meant to cover everywhere
     collection_bbox = [-180, -90, 180, 90]
     collection_interval = ["2020-01-01T00:00:00.00Z", None]
     collection_extent = Extent(
@@ -51,47 +48,85 @@ def build_stac_collection(collection_id: str, description: str, title: str, item
     )
     return collection
 
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Catalogue the preview mosaic COGs in S3.')
+    parser.add_argument('--pgstac', action='store_true', help='Load items straight into pgstac (connection from PG* environment variables)')
+    parser.add_argument('--no_files', action='store_true', help='Skip writing the item and collection files (with --pgstac)')
+    parser.add_argument('--method', choices=METHODS, default='upsert', help='How items are loaded into pgstac')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes cataloguing COGs (default: one per CPU)')
+    parser.add_argument('--stats', choices=STATS_METHODS, default=None,
+                        help='Add raster statistics, computed from every pixel, the coarsest overview or a sample of blocks (default: none)')
+    parser.add_argument('--sample_blocks', type=int, default=DEFAULT_SAMPLE_BLOCKS, help='Blocks per band read by --stats sample')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE, help='Items loaded into pgstac per transaction')
+    args = parser.parse_args()
+    if args.no_files and not args.pgstac:
+        parser.error("--no_files requires --pgstac")
+    return args
+
+
 if __name__ == "__main__":
+    args = parse_arguments()
     collection_file = "/home/storage/stac/aerial/cog/collection.json"
     item_file = "/home/storage/stac/aerial/cog/items.json"
     bucket_name = "place-data"
     prefix = "aerial/cog/"
 
-    tif_keys = [key for key in list_s3_objects(bucket_name=bucket_name, prefix=prefix) if key.lower().endswith(".tif") or key.lower().endswith(".tiff")]
-    tif_paths = [f"s3://{bucket_name}/{key}" for key in tif_keys]
+    tif_keys = list_s3_keys(s3, bucket_name, prefix, (".tif", ".tiff"), threads=LIST_THREADS)
+    tif_paths = (f"s3://{bucket_name}/{key}" for key in tif_keys)
+
+    # Build STAC Items, streaming each to file and/or pgstac as it is created
+    item_count = 0
+    with ExitStack() as stack:
+        writer = None
+        if not args.no_files:
+            print(f"Writing items to file: {item_file}")
+            writer = stack.enter_context(NdjsonWriter(item_file))
+        loader = None
+        if args.pgstac:
+            print(f"Loading items into pgstac in batches of {args.batch_size}")
+            loader = stack.enter_context(BatchLoader(stack.enter_context(PgstacDB()), args.method, args.batch_size))
+            # The collection's extent is global, so it can be loaded ahead of its items
+            loader.load_collections([to_json_dict(build_stac_collection(
+                collection_id="mosaic_preview",
+                description="Preview Mosaics generated from PLACE drone flight imagery",
+                title="PLACE Mosaic Previews"
+            ).to_dict())])
 
-    # Build STAC Items
-    items = []
-    for path in tif_paths:
-        item = create_stac_item(
-            source=path,
+        # Each COG is opened once, by a pool of workers that each reuse one GDAL environment and AWS session
+        results = catalog_cogs(
+            tif_paths,
+            processes=args.processes,
+            aws_session_kwargs={},
             collection="mosaic_preview",
-            with_proj=True,
-            asset_name="cog"
+            stats=args.stats,
+            sample_blocks=args.sample_blocks,
         )
-        items.append(item)
-
-    # Build STAC Collection
-    collection = build_stac_collection(
-        collection_id="mosaic_preview",
-        description="Preview Mosaics generated from PLACE drone flight imagery",
-        title="PLACE Mosaic Previews",
-        items=items
-    )
-
-    ### Write STAC Items and Collection to file
-    print(f"Writing collection to file: {collection_file}")
-    with open(collection_file, 'w') as f:
-        f.write(collection.to_json())
-
-    print(f"Writing items to file: {item_file}")
-    with open(item_file, 'w') as f:
-        for item in items:
+        for (path, item, error) in results:
+            if error is not None:
+                print(f"Error cataloguing COG: {path}")
+                print(error)
+                continue
             try:
                 item_dict = item.to_dict()
-                item_json = json.dumps(item_dict)
-                f.write(item_json + '\n')
+                if writer is not None:
+                    writer.write(item_dict)
+                if loader is not None:
+                    loader.add(item_dict)
             except Exception:
-                print(f"Error writing item to file: {item.id}")
+                print(f"Error writing item: {item.id}")
                 pprint.pprint(item)
-                print(traceback.format_exc())
\ No newline at end of file
+                print(traceback.format_exc())
+                continue
+            item_count += 1
+
+    if writer is not None:
+        # Build and write the STAC Collection last, so it only exists once every item has been written
+        collection = build_stac_collection(
+            collection_id="mosaic_preview",
+            description="Preview Mosaics generated from PLACE drone flight imagery",
+            title="PLACE Mosaic Previews"
+        )
+        print(f"Writing collection to file: {collection_file}")
+        with open(collection_file, 'w') as f:
+            f.write(collection.to_json())
+    print(f"Items successfully created: {item_count}")
@@ -1,26 +1,49 @@
 #!/usr/bin/env python3
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import ExitStack
 from datetime import datetime
+from itertools import islice
 import math
 import os
 import pprint
 import sys
-from typing import List
 import traceback
+from typing import Optional
 from urllib.parse import urlparse
 
 import boto3
-import exifread
+from botocore.config import Config
+from place.common.catalog import ExtentAccumulator, NdjsonWriter, to_json_dict
+from place.common.exif import ExifRecord, read_exif
+from place.common.exif_cache import DEFAULT_CACHE_PATH, ExifCache, stat_key
+from place.common.pgstac import BatchLoader, DEFAULT_BATCH_SIZE, METHODS, PgstacDB
+from place.common.s3 import list_s3_keys
+from pypgstac.load import Methods
 from stac_pydantic.collection import Collection, Extent, SpatialExtent, TimeInterval
 from stac_pydantic.item import Item
 from stac_pydantic.shared import Asset, Provider, ProviderRoles
 
+# Threads reading image headers concurrently
+DEFAULT_SCAN_THREADS = 32
+# Threads listing the sub-prefixes (e.g. flights) of an S3 prefix concurrently
+LIST_THREADS = 8
+JPG_EXTENSIONS = (".jpg", ".jpeg")
+# Header reads in flight per scan thread; bounds memory while the listing streams
+SCAN_QUEUE_DEPTH = 4
+# Bytes fetched from S3 to read a JPEG's headers; the EXIF APP1 segment is at most 64KB
+HEADER_RANGE_BYTES = 128 * 1024
+# Imagery in S3 is mirrored on local storage, which is read in preference to S3
+S3_MIRROR_PREFIX = "s3://place-data"
+LOCAL_MIRROR_ROOT = "/home/storage/imagery"
+# Images looked up in the EXIF cache at once, and records read before they are cached
+CACHE_BATCH_SIZE = 500
+
 # Initialize a session with your AWS credentials
 session = boto3.Session()
 
-# Create an S3 client
-s3 = session.client('s3')
-paginator = s3.get_paginator('list_objects_v2')
+# Create an S3 client, with a connection for each scan thread
+s3 = session.client('s3', config=Config(max_pool_connections=DEFAULT_SCAN_THREADS))
 
 
 def serialize_dt_rfc3339(dt) -> str:
@@ -30,17 +53,6 @@ def serialize_dt_rfc3339(dt) -> str:
     return rfc3339_string
 
 
-def dms_to_decimal(dms_list, direction):
-    """Convert a string of degrees, minutes, seconds to decimal degrees."""
-    d, m, s = dms_list
-    decimal_degrees = d + m / 60 + s / 3600
-
-    if direction in ('W', 'S'):
-        decimal_degrees = -decimal_degrees
-
-    return decimal_degrees
-
-
 def create_geojson_point(lat, lon):
     """Create a GeoJSON Point object from a latitude and longitude."""
     return {
@@ -59,13 +71,46 @@ def parse_s3uri(s3uri: str):
     return (bucket_name, prefix)
 
 
-def get_metadata(s3uri: str):
-    """Get the metadata from a jpg image stored in S3."""
-    file_path = s3uri.replace("s3://place-data", "/home/storage/imagery")
+def to_local_path(s3uri: str) -> str:
+    """Path of an S3 object's copy on the local mirror"""
+    return s3uri.replace(S3_MIRROR_PREFIX, LOCAL_MIRROR_ROOT, 1)
+
+
+def to_s3uri(local_path: str) -> str:
+    """S3 URI of a file on the local mirror"""
+    return local_path.replace(LOCAL_MIRROR_ROOT, S3_MIRROR_PREFIX, 1)
+
+
+def is_jpg(name: str) -> bool:
+    return name.lower().endswith(JPG_EXTENSIONS)
+
+
+def read_s3_header(s3uri: str) -> ExifRecord:
+    """Read EXIF metadata from the first bytes of an S3 object, falling back to the whole object"""
+    bucket_name, key = parse_s3uri(s3uri)
+    header = s3.get_object(Bucket=bucket_name, Key=key, Range=f"bytes=0-{HEADER_RANGE_BYTES - 1}")["Body"].read()
+    try:
+        return read_exif(header)
+    except ValueError:
+        # Headers larger than the range (e.g. with a big embedded preview) are truncated
+        return read_exif(s3.get_object(Bucket=bucket_name, Key=key)["Body"].read())
+
+
+def mirror_key(s3uri: str):
+    """EXIF cache key of an S3 object's copy on the local mirror, or None without a copy"""
+    try:
+        return stat_key(to_local_path(s3uri))
+    except OSError:
+        return None
+
+
+def get_metadata(s3uri: str) -> ExifRecord:
+    """Get the header metadata from a jpg image stored in S3 (via its local mirror when present)."""
+    file_path = to_local_path(s3uri)
     try:
-        with open(file_path, 'rb') as f:
-            tags = exifread.process_file(f)
-        return tags
+        if os.path.exists(file_path):
+            return read_exif(file_path)
+        return read_s3_header(s3uri)
     except Exception:
         print(f"Error encountered while retrieving metadata for {s3uri}")
         print(traceback.format_exc())
@@ -92,16 +137,6 @@ def get_bounding_box(lat, lon):
     return [min_lat, min_lon, max_lat, max_lon]
 
 
-def list_s3_objects(s3uri: str):
-    """List all objects in an S3 bucket with a given prefix."""
-    bucket_name, prefix = parse_s3uri(s3uri)
-
-    keys = []
-    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-        keys = keys + [obj['Key'] for obj in page.get('Contents', [])]
-    return keys
-
-
 def s3uri_to_id(key: str):
     """Convert an S3 URI to a STAC Item ID."""
     split = key.split("/")
@@ -113,54 +148,109 @@ def s3uri_to_id(key: str):
         return f"{location}_{filename}"
 
 
-def read_all_metadata(s3uri: str):
-    """Read all metadata from jpg images in an S3 bucket."""
-    bucket_name, prefix = parse_s3uri(s3uri)
-    obj_keys = [key for key in list_s3_objects(s3uri) if key.lower().endswith(".jpg") or key.lower().endswith(".jpeg")]
-    obj_paths = [f"s3://{bucket_name}/{key}" for key in obj_keys]
-    all_metadata = [get_metadata(obj_path) for obj_path in obj_paths]
-    processed = []
-    for idx, md in enumerate(all_metadata):
-        try:
-            img_lat = dms_to_decimal([ratio.decimal() for ratio in md['GPS GPSLatitude'].values], md['GPS GPSLatitudeRef'].values)
-            img_lng =  dms_to_decimal([ratio.decimal() for ratio in md['GPS GPSLongitude'].values], md['GPS GPSLongitudeRef'].values)
-            img_datetime = datetime.strptime(md['EXIF DateTimeOriginal'].values, '%Y:%m:%d %H:%M:%S')
-        except KeyError:
-            print(f"Key Error while reading metadata for {obj_paths[idx]}. Continuing...")
-            print(traceback.format_exc())
-
-        try:
-            processed_metadata = {
-                "path": obj_paths[idx],
-                "lat": img_lat,
-                "lng": img_lng,
-                "datetime": img_datetime,
-                "make": md['Image Make'].values,
-                "model": md['Image Model'].values,
-                "focal_length": md['EXIF FocalLengthIn35mmFilm'].values[0],
-                "exposure_time": md['EXIF ExposureTime'].values[0].decimal()
-            }
-            if "GPS GPSAltitude" in md:
-                altitude = md['GPS GPSAltitude'].values[0].decimal()
-                processed_metadata["altitude"] = altitude
-            processed.append(processed_metadata)
-        except TypeError:
-            print(f"Error processing metadata for {obj_paths[idx]}. Continuing...")
-            print(traceback.format_exc())
-        except KeyError:
-            print(f"Error processing metadata for {obj_paths[idx]}. Continuing...")
-            pprint.pprint(md)
-            print(traceback.format_exc())
-    return processed
-
-
-def merge_bboxes(bboxes):
-    min_longitude = min(box[0] for box in bboxes)
-    min_latitude = min(box[1] for box in bboxes)
-    max_longitude = max(box[2] for box in bboxes)
-    max_latitude = max(box[3] for box in bboxes)
-
-    return [min_longitude, min_latitude, max_longitude, max_latitude]
+def walk_jpgs(directory: str):
+    """Yield the paths of jpgs under a local directory, recursively"""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_jpgs(entry.path)
+            elif is_jpg(entry.name):
+                yield entry.path
+
+
+def find_jpgs(s3uri: str):
+    """Yield the S3 URIs of jpgs under an S3 prefix.
+
+    The local mirror is walked when it has a copy of the prefix, which avoids listing S3."""
+    local_directory = to_local_path(s3uri)
+    if os.path.isdir(local_directory):
+        for path in walk_jpgs(local_directory):
+            yield to_s3uri(path)
+    else:
+        bucket_name, prefix = parse_s3uri(s3uri)
+        for key in list_s3_keys(s3, bucket_name, prefix, JPG_EXTENSIONS, threads=LIST_THREADS):
+            yield f"s3://{bucket_name}/{key}"
+
+
+def process_metadata(obj_path: str, md: ExifRecord):
+    """Select the metadata used to build an item, or None if an image can't be located"""
+    if md.lat is None or md.lng is None or md.datetime is None:
+        print(f"Missing GPS position or capture time in metadata for {obj_path}. Continuing...")
+        pprint.pprint(md)
+        return None
+
+    processed_metadata = {
+        "path": obj_path,
+        "lat": md.lat,
+        "lng": md.lng,
+        "datetime": md.datetime,
+        "make": md.make,
+        "model": md.model,
+        "focal_length": md.focal_length_35mm,
+        "exposure_time": md.exposure_time
+    }
+    if md.alt is not None:
+        processed_metadata["altitude"] = md.alt
+    return processed_metadata
+
+
+def chunked(iterable, size: int):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def read_all_metadata(s3uri: str, threads: int = DEFAULT_SCAN_THREADS, ordered: bool = False, cache: Optional[ExifCache] = None):
+    """Read all metadata from jpg images in an S3 bucket.
+
+    Headers are read by a pool of threads while the listing is still streaming in,
+    and records are yielded as they complete. With ordered, they are yielded
+    sorted by path once the whole scan has finished.
+
+    With a cache, images on the local mirror are looked up in batches and only
+    those new or changed since they were cached are read (and then cached)."""
+    def read(obj_path, key):
+        return (obj_path, key, get_metadata(obj_path))
+
+    def scan():
+        uncached = []
+
+        def completed(futures):
+            for future in futures:
+                (obj_path, key, md) = future.result()
+                if key is not None and md is not None:
+                    uncached.append((key, md))
+                yield (obj_path, md)
+            if len(uncached) >= CACHE_BATCH_SIZE:
+                cache.put_many(uncached)
+                uncached.clear()
+
+        with ThreadPoolExecutor(threads) as executor:
+            in_flight = set()
+            for obj_paths in chunked(find_jpgs(s3uri), CACHE_BATCH_SIZE if cache is not None else 1):
+                keys = {}
+                cached = {}
+                if cache is not None:
+                    keys = {obj_path: mirror_key(obj_path) for obj_path in obj_paths}
+                    cached = cache.get_many(key for key in keys.values() if key is not None)
+                for obj_path in obj_paths:
+                    key = keys.get(obj_path)
+                    if key is not None and key[0] in cached:
+                        yield (obj_path, cached[key[0]])
+                        continue
+                    if len(in_flight) >= threads * SCAN_QUEUE_DEPTH:
+                        (done, in_flight) = wait(in_flight, return_when=FIRST_COMPLETED)
+                        yield from completed(done)
+                    in_flight.add(executor.submit(read, obj_path, key))
+            yield from completed(as_completed(in_flight))
+        if cache is not None:
+            cache.put_many(uncached)
+
+    records = (process_metadata(obj_path, md) for (obj_path, md) in scan() if md is not None)
+    records = (record for record in records if record is not None)
+    if ordered:
+        return iter(sorted(records, key=lambda record: record["path"]))
+    return records
 
 
 def build_stac_item(md, collection_id: str) -> Item:
@@ -201,19 +291,16 @@ def build_stac_item(md, collection_id: str) -> Item:
             "model": md['model'],
             "focal_length": md['focal_length'],
             "exposure_time": md['exposure_time'],
-            "altitude": md['altitude']
+            "altitude": md.get('altitude')
         },
         assets=assets,
         links=[],
     )
 
-def build_stac_collection(collection_id: str, description: str, title: str, items: List[Item]) -> Collection:
-    collection_bbox = merge_bboxes([item.bbox for item in items])
-    min_dt = min(item.properties.datetime for item in items)
-    max_dt = max(item.properties.datetime for item in items)
-    collection_interval = [serialize_dt_rfc3339(min_dt), serialize_dt_rfc3339(max_dt)]
+def build_stac_collection(collection_id: str, description: str, title: str, extent: ExtentAccumulator) -> Collection:
+    collection_interval = [serialize_dt_rfc3339(extent.start), serialize_dt_rfc3339(extent.end)]
     collection_extent = Extent(
-        spatial=SpatialExtent(bbox=[collection_bbox]),
+        spatial=SpatialExtent(bbox=[extent.bbox]),
         temporal=TimeInterval(interval=[collection_interval])
     )
     place_provider = Provider(
@@ -236,55 +323,98 @@ def build_stac_collection(collection_id: str, description: str, title: str, item
     return collection
 
 
+def provisional_extent() -> ExtentAccumulator:
+    """A global extent for a collection whose items are yet to be built"""
+    extent = ExtentAccumulator()
+    extent.add([-180, -90, 180, 90], datetime.utcnow())
+    return extent
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Process S3 URI and collection ID.')
     parser.add_argument('--collection_id', type=str, help='Collection ID', required=True)
     parser.add_argument('--collection_description', type=str, help='Collection Description', required=True)
     parser.add_argument('--collection_title', type=str, help='Collection Title', required=True)
     parser.add_argument('--input_directory', type=str, help='Directory which contains JPGs to be catalogued', required=True)
-    parser.add_argument('--output_directory', type=str, help='Dir to write STAC Items to', required=True)
+    parser.add_argument('--output_directory', type=str, help='Dir to write STAC Items to (optional with --pgstac)', required=False)
     parser.add_argument('--output_s3_backup', type=str, help='Optional backup output location as s3 uri', required=False)
-    return parser.parse_args()
+    parser.add_argument('--scan_threads', type=int, help='Threads reading image metadata concurrently', default=DEFAULT_SCAN_THREADS)
+    parser.add_argument('--ordered', action='store_true', help='Write items sorted by image path rather than in the order they are read')
+    parser.add_argument('--pgstac', action='store_true', help='Load items straight into pgstac (connection from PG* environment variables)')
+    parser.add_argument('--method', choices=METHODS, default='upsert', help='How items are loaded into pgstac')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE, help='Items loaded into pgstac per transaction')
+    parser.add_argument('--exif_cache', type=str, default=DEFAULT_CACHE_PATH, help='SQLite file caching the metadata of images on the local mirror')
+    parser.add_argument('--no_exif_cache', action='store_true', help='Read every image, without using or updating the metadata cache')
+    args = parser.parse_args()
+    if args.output_directory is None and not args.pgstac:
+        parser.error("at least one of --output_directory and --pgstac is required")
+    return args
 
 
 if __name__ == '__main__':
     args = parse_arguments()
 
-    item_file = os.path.join(args.output_directory, args.collection_id + "_items.json")
-    collection_file = os.path.join(args.output_directory, args.collection_id + "_collection.json")
-    if os.path.exists(collection_file):
-        print(f"Collection file already exists: {collection_file}")
-        sys.exit(0)
+    if args.output_directory:
+        item_file = os.path.join(args.output_directory, args.collection_id + "_items.json")
+        collection_file = os.path.join(args.output_directory, args.collection_id + "_collection.json")
+        if os.path.exists(collection_file):
+            print(f"Collection file already exists: {collection_file}")
+            sys.exit(0)
 
-    ### Build STAC Items and Collection
-    item_count = 0
+    ### Build STAC Items, streaming each to file and/or pgstac as it is read
     print(f"Constructing items from {args.input_directory}")
-    items: List[Item] = []
-    for item_metadata in read_all_metadata(args.input_directory):
-        item_count += 1
-        item = build_stac_item(item_metadata, args.collection_id)
-        items.append(item)
-
-    print("Constructing collection")
-    collection = build_stac_collection(args.collection_id, args.collection_description, args.collection_title, items)
-
-
-    ### Write STAC Items and Collection to file
-    print(f"Writing collection to file: {collection_file}")
-    with open(collection_file, 'w') as f:
-        f.write(collection.to_json())
-
-    print(f"Writing items to file: {item_file}")
-    with open(item_file, 'w') as f:
-        for item in items:
+    extent = ExtentAccumulator()
+    item_count = 0
+    with ExitStack() as stack:
+        writer = None
+        if args.output_directory:
+            print(f"Writing items to file: {item_file}")
+            writer = stack.enter_context(NdjsonWriter(item_file))
+        loader = None
+        if args.pgstac:
+            print(f"Loading items into pgstac in batches of {args.batch_size}")
+            loader = stack.enter_context(BatchLoader(stack.enter_context(PgstacDB()), args.method, args.batch_size))
+            # Items can only be loaded into an existing collection. A provisional one is only
+            # inserted if the collection doesn't exist yet (so a failed build never replaces the
+            # extent of an existing one), and it is upserted with its real extent at the end.
+            provisional = build_stac_collection(args.collection_id, args.collection_description, args.collection_title, provisional_extent())
+            loader.load_collections([to_json_dict(provisional.to_dict())], Methods.ignore.value)
+        cache = None
+        if not args.no_exif_cache:
+            cache = stack.enter_context(ExifCache(args.exif_cache))
+
+        for item_metadata in read_all_metadata(args.input_directory, args.scan_threads, args.ordered, cache):
+            item = build_stac_item(item_metadata, args.collection_id)
             try:
-                f.write(item.to_json() + '\n')
+                item_dict = item.to_dict()
+                if writer is not None:
+                    writer.write(item_dict)
+                if loader is not None:
+                    loader.add(to_json_dict(item_dict))
             except Exception:
-                print(f"Error writing item to file: {item.id}")
+                print(f"Error writing item: {item.id}")
                 pprint.pprint(item)
                 print(traceback.format_exc())
-
-    if args.output_s3_backup:
+                continue
+            extent.add(item.bbox, item.properties.datetime)
+            item_count += 1
+
+        if item_count == 0:
+            print(f"No items could be constructed from {args.input_directory}")
+            sys.exit(1)
+
+        ### Build the STAC Collection and write it last, so it only exists once every item has been written
+        print("Constructing collection")
+        collection = build_stac_collection(args.collection_id, args.collection_description, args.collection_title, extent)
+        if loader is not None:
+            loader.load_collections([to_json_dict(collection.to_dict())])
+
+    if args.output_directory:
+        print(f"Writing collection to file: {collection_file}")
+        with open(collection_file, 'w') as f:
+            f.write(collection.to_json())
+
+    if args.output_directory and args.output_s3_backup:
         item_file_s3 = os.path.join(args.output_s3_backup, args.collection_id + "_items.json")
         collection_file_s3 = os.path.join(args.output_s3_backup, args.collection_id + "_collection.json")
         print(f"Uploading item file to S3: {item_file_s3}")
@@ -1,24 +1,138 @@
+import argparse
 import os
-import sys
+from typing import Optional
 
-from pypgstac.load import Loader, Methods, PgstacDB
+from place.common.pgstac import BatchLoader, DEFAULT_BATCH_SIZE, PgstacDB
+from pypgstac.load import Methods, read_json
 
+from ingest_ledger import INCOMPLETE_SHA, IngestLedger, hash_file, hash_record, stat_file
 
-# Read directory path from command-line argument
-directory = sys.argv[1]
-# Get all relevant files in directory
-items_files = [file for file in os.listdir(directory) if file.endswith('items.json')]
-collection_files = [file for file in os.listdir(directory) if file.endswith('collection.json')]
+# Ledger file kept in the ingested directory unless --ledger says otherwise
+LEDGER_FILE = ".ingest_ledger.sqlite"
 
 
+def changed_sha(ledger: IngestLedger, directory: str, name: str, full: bool):
+    """The content hash of a file if it needs ingesting, otherwise None.
 
-def load_test_data() -> None:
-    with PgstacDB() as conn:
-        loader = Loader(db=conn)
-        for collection_file in collection_files:
-            loader.load_collections(os.path.join(directory, collection_file), Methods.upsert)
-        for items_file in items_files:
-            loader.load_items(os.path.join(directory, items_file), Methods.upsert)
+    Unchanged size and mtime skip the file without reading it; a touched file
+    with the same content is re-recorded and skipped. A file some of whose
+    items were skipped last time is always read again."""
+    (size, mtime_ns) = stat_file(os.path.join(directory, name))
+    state = ledger.file_state(name)
+    if state is not None and state[2] == INCOMPLETE_SHA:
+        state = None
+    if not full and state is not None and state[:2] == (size, mtime_ns):
+        return None
+    sha = hash_file(os.path.join(directory, name))
+    if not full and state is not None and state[2] == sha:
+        ledger.record_file(name, size, mtime_ns, sha)
+        return None
+    return sha
 
 
-load_test_data()
\ No newline at end of file
+def ingest_collections(ledger, loader, directory, collection_file, full):
+    sha = changed_sha(ledger, directory, collection_file, full)
+    if sha is None:
+        return False
+    path = os.path.join(directory, collection_file)
+    loader.load_collections(read_json(path), Methods.upsert.value)
+    (size, mtime_ns) = stat_file(path)
+    ledger.record_file(collection_file, size, mtime_ns, sha)
+    return True
+
+
+def ingest_items(ledger, loader, directory, items_file, full, default_collection=None):
+    """Load the new and changed items of a file, returning (loaded, removed, skipped) counts.
+
+    Items without a collection are put in default_collection, or skipped
+    without one, in which case the file is read again on the next run (e.g.
+    with --collection_id) rather than passed over as unchanged. Removed items
+    are left stale in the ledger (see prune_stale)."""
+    sha = changed_sha(ledger, directory, items_file, full)
+    if sha is None:
+        return (0, 0, 0)
+    path = os.path.join(directory, items_file)
+    (size, mtime_ns) = stat_file(path)
+    previous = ledger.item_hashes(items_file)
+    current = {}
+    loaded = 0
+    skipped = 0
+    for item in read_json(path):
+        if not item.get("collection"):
+            if default_collection is None:
+                print(f"{items_file}: item {item.get('id')} has no collection; skipping (see --collection_id)")
+                skipped += 1
+                continue
+            item["collection"] = default_collection
+        key = (item["collection"], item["id"])
+        current[key] = hash_record(item)
+        if full or previous.get(key) != current[key]:
+            loader.add(item)
+            loaded += 1
+    loader.flush()
+
+    removed = [key for key in previous if key not in current]
+    # Items were recorded as they were loaded, but the file isn't done until none are skipped
+    ledger.record_file(items_file, size, mtime_ns, INCOMPLETE_SHA if skipped else sha, current)
+    return (loaded, len(removed), skipped)
+
+
+def prune_stale(ledger, loader):
+    """Delete the items no longer in any file from pgstac, then forget them"""
+    stale = ledger.stale_items()
+    loader.delete_items(stale)
+    ledger.forget_items(stale)
+    return len(stale)
+
+
+def load_test_data(directory: str, ledger_path: str, full: bool, prune: bool, batch_size: int,
+                   default_collection: Optional[str] = None) -> None:
+    # Get all relevant files in directory
+    items_files = sorted(file for file in os.listdir(directory) if file.endswith('items.json'))
+    collection_files = sorted(file for file in os.listdir(directory) if file.endswith('collection.json'))
+
+    with IngestLedger(ledger_path) as ledger, PgstacDB() as conn:
+        with BatchLoader(conn, Methods.upsert.value, batch_size) as loader:
+            collections = sum(ingest_collections(ledger, loader, directory, file, full) for file in collection_files)
+            print(f"Loaded {collections} of {len(collection_files)} collection files (others unchanged)")
+
+            (loaded, skipped) = (0, 0)
+            for items_file in items_files:
+                (file_loaded, file_removed, file_skipped) = ingest_items(ledger, loader, directory, items_file, full, default_collection)
+                if file_loaded or file_removed:
+                    print(f"{items_file}: {file_loaded} new or changed items, {file_removed} removed")
+                loaded += file_loaded
+                skipped += file_skipped
+
+            # Files ingested before but since deleted
+            for missing_file in sorted(set(ledger.files()) - set(items_files) - set(collection_files)):
+                print(f"{missing_file}: deleted, with {len(ledger.item_hashes(missing_file))} items")
+                ledger.forget_file(missing_file)
+
+            # Everything removed since the last prune, not just in this run
+            loader.flush()
+            if prune:
+                stale = prune_stale(ledger, loader)
+            else:
+                stale = len(ledger.stale_items())
+
+    print(f"Loaded {loaded} new or changed items ({skipped} skipped); {stale} items no longer in any file were "
+          f"{'deleted from pgstac' if prune else 'left in pgstac (use --prune to delete them)'}")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Ingest the *collection.json and *items.json files in a directory into pgstac, '
+                                                 'loading only what changed since the last ingest.')
+    parser.add_argument('directory', help='Directory of STAC collection and item files')
+    parser.add_argument('--ledger', help=f'SQLite file recording what was ingested (default: {LEDGER_FILE} in the directory)')
+    parser.add_argument('--full', action='store_true', help='Reload every collection and item, whether changed or not')
+    parser.add_argument('--prune', action='store_true', help='Delete items from pgstac that are no longer in any file')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE, help='Items loaded into pgstac per transaction')
+    parser.add_argument('--collection_id', help='Collection of items which have none (they are skipped otherwise)')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    ledger_path = args.ledger or os.path.join(args.directory, LEDGER_FILE)
+    load_test_data(args.directory, ledger_path, args.full, args.prune, args.batch_size, args.collection_id)
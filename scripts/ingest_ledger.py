@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+
+# Read size when hashing a file's contents
+HASH_CHUNK_SIZE = 1024 * 1024
+
+ItemKey = Tuple[str, str]
+# Recorded in place of a file's content hash when some of its items were skipped,
+# so the file is read again on the next run rather than passed over as unchanged
+INCOMPLETE_SHA = ""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    ingested_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    stale INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (collection, id)
+);
+CREATE INDEX IF NOT EXISTS items_path ON items (path);
+"""
+
+
+def hash_file(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_record(record: Dict[str, Any]) -> str:
+    """Hash of a record's content, independent of key order and formatting"""
+    return hashlib.sha256(orjson.dumps(record, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+class IngestLedger(object):
+    """What has been ingested into pgstac from which files, kept in a SQLite file.
+
+    Files are recorded by path, size, mtime and content hash, and the items
+    loaded from each by (collection, id) and content hash, so a re-ingest only
+    needs to send new and changed items.
+
+    Items which are no longer in their file (or whose file was deleted) are
+    kept as stale until they are deleted from pgstac and forgotten, so they
+    can still be pruned by a later run."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+        # Ledgers written before items were marked stale
+        if "stale" not in [row[1] for row in self.conn.execute("PRAGMA table_info(items)")]:
+            with self.conn:
+                self.conn.execute("ALTER TABLE items ADD COLUMN stale INTEGER NOT NULL DEFAULT 0")
+
+    def file_state(self, path: str) -> Optional[Tuple[int, int, str]]:
+        """Recorded (size, mtime_ns, sha256) of a file, or None if it was never ingested"""
+        return self.conn.execute("SELECT size, mtime_ns, sha256 FROM files WHERE path = ?", (path,)).fetchone()
+
+    def files(self) -> List[str]:
+        return [row[0] for row in self.conn.execute("SELECT path FROM files")]
+
+    def item_hashes(self, path: str) -> Dict[ItemKey, str]:
+        """The current (not stale) items of a file"""
+        rows = self.conn.execute("SELECT collection, id, sha256 FROM items WHERE path = ? AND stale = 0", (path,))
+        return {(collection, item_id): sha for (collection, item_id, sha) in rows}
+
+    def record_file(self, path: str, size: int, mtime_ns: int, sha256: str, item_hashes: Optional[Dict[ItemKey, str]] = None) -> None:
+        """Record a file as ingested, and commit.
+
+        If item_hashes are given, they become the file's items and any others
+        it had are marked stale."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256, ingested_at) VALUES (?, ?, ?, ?, ?)",
+                (path, size, mtime_ns, sha256, time.time()),
+            )
+            if item_hashes is not None:
+                self.conn.execute("UPDATE items SET stale = 1 WHERE path = ?", (path,))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO items (collection, id, path, sha256, stale) VALUES (?, ?, ?, ?, 0)",
+                    [(collection, item_id, path, sha) for ((collection, item_id), sha) in item_hashes.items()],
+                )
+
+    def forget_file(self, path: str) -> None:
+        """Forget a deleted file, marking its items stale"""
+        with self.conn:
+            self.conn.execute("UPDATE items SET stale = 1 WHERE path = ?", (path,))
+            self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def stale_items(self) -> List[ItemKey]:
+        """Items ingested before but no longer in any file"""
+        return [tuple(row) for row in self.conn.execute("SELECT collection, id FROM items WHERE stale = 1 ORDER BY collection, id")]
+
+    def forget_items(self, keys: List[ItemKey]) -> None:
+        """Forget items, e.g. once they have been deleted from pgstac"""
+        with self.conn:
+            self.conn.executemany("DELETE FROM items WHERE collection = ? AND id = ?", keys)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def stat_file(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
@@ -1,24 +1,60 @@
+#!/usr/bin/env python3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import os
 from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List
 
 import orjson
-from pypgstac.load import Loader, Methods, PgstacDB
+from place.common.pgstac import BatchLoader, DEFAULT_BATCH_SIZE, METHODS, PgstacDB
 
 collection = "/app/data/collections/abidjian.json"
 items = "/app/data/items"
 
+# Threads reading and parsing item files
+DEFAULT_PARSE_THREADS = min(32, (os.cpu_count() or 1) * 4)
 
-def load_test_data() -> None:
+
+def read_json(path: str) -> Dict[str, Any]:
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+
+def chunked(iterable: Iterable[str], size: int) -> Iterator[List[str]]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def load_test_data(collection_path: str, items_dir: str, method: str, batch_size: int, threads: int) -> None:
     with PgstacDB() as conn:
-        loader = Loader(db=conn)
-        with open(collection, "rb") as f:
-            c = orjson.loads(f.read())
-            loader.load_collections([c], Methods.upsert)
-        item_paths = Path(items).glob("*.json")
-        for path in item_paths:
-            with open(str(path), "rb") as f:
-                i = orjson.loads(f.read())
-                loader.load_items([i], Methods.upsert)
-
-
-load_test_data()
\ No newline at end of file
+        with BatchLoader(conn, method, batch_size) as loader:
+            loader.load_collections([read_json(collection_path)])
+            item_paths = (str(path) for path in Path(items_dir).glob("*.json"))
+            with ThreadPoolExecutor(threads) as executor:
+                # Parse the next batch in the pool while the current one is loading
+                parsing = None
+                for chunk in chunked(item_paths, batch_size):
+                    next_parsing = [executor.submit(read_json, path) for path in chunk]
+                    if parsing is not None:
+                        loader.add_all(future.result() for future in parsing)
+                    parsing = next_parsing
+                if parsing is not None:
+                    loader.add_all(future.result() for future in parsing)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Load the demo collection and its item files into pgstac.')
+    parser.add_argument('wait_for', nargs='?', help='host:port waited for before starting (ignored)')
+    parser.add_argument('--collection', default=collection, help='Collection JSON file')
+    parser.add_argument('--items', default=items, help='Directory of item JSON files')
+    parser.add_argument('--method', choices=METHODS, default='upsert', help='How items are loaded into pgstac')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE, help='Items loaded into pgstac per transaction')
+    parser.add_argument('--threads', type=int, default=DEFAULT_PARSE_THREADS, help='Threads reading and parsing item files')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    load_test_data(args.collection, args.items, args.method, args.batch_size, args.threads)
@@ -1,9 +1,36 @@
 #!/usr/bin/env python3
 import argparse
+import ast
 import csv
+import importlib.util
 import multiprocess
 import os
+import shlex
 import subprocess
+import sys
+import time
+import traceback
+
+MODE_AUTO = "auto"
+MODE_IN_PROCESS = "in-process"
+MODE_SUBPROCESS = "subprocess"
+# Name of the entry function called with a list of CLI arguments in in-process mode
+ENTRY_FUNCTION = "main"
+# Modules whose import means a script may start a process pool of its own, which a
+# (daemonic) worker can't do
+POOL_MODULES = ("multiprocessing", "multiprocess")
+
+# The target CLI's entry function, loaded once in each worker (see load_entry_function)
+_entry_function = None
+
+
+def build_argv(arg_set):
+    """CLI arguments for one CSV row, one --field value pair per column"""
+    argv = []
+    for field, value in arg_set.items():
+        argv += [f"--{field.strip()}", value]
+    return argv
+
 
 def execute_cli_command(cli, arg_set):
 
@@ -21,6 +48,111 @@ def execute_cli_command(cli, arg_set):
         raise
 
 
+def script_path(cli):
+    """The python script a CLI command runs, e.g. "python cli_single.py" -> "cli_single.py" """
+    tokens = shlex.split(cli)
+    if tokens and tokens[-1].endswith(".py") and os.path.isfile(tokens[-1]):
+        return tokens[-1]
+    return None
+
+
+def has_entry_function(path):
+    """Whether a script defines a top-level main() (checked without importing it)"""
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+    return any(isinstance(node, ast.FunctionDef) and node.name == ENTRY_FUNCTION for node in tree.body)
+
+
+def starts_process_pools(path, root=None, seen=None):
+    """Whether a script, or any module it imports from its own directory, imports a
+    process pool (checked without importing anything)"""
+    root = root or os.path.dirname(os.path.abspath(path))
+    seen = seen if seen is not None else set()
+    seen.add(os.path.abspath(path))
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            if node.module == "concurrent.futures" and any(alias.name == "ProcessPoolExecutor" for alias in node.names):
+                return True
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            if name.split(".")[0] in POOL_MODULES:
+                return True
+            # Neighbouring modules are importable as `python script.py` allows
+            local = os.path.join(root, *name.split(".")) + ".py"
+            if os.path.isfile(local) and os.path.abspath(local) not in seen:
+                if starts_process_pools(local, root, seen):
+                    return True
+    return False
+
+
+def threads_per_worker(parallelism):
+    """GDAL threads for each of parallelism concurrent rows, sharing out the cores"""
+    return max(1, (os.cpu_count() or 1) // parallelism)
+
+
+def init_worker(gdal_threads):
+    """Share the cores out between workers, unless GDAL_NUM_THREADS is already set"""
+    os.environ.setdefault("GDAL_NUM_THREADS", str(gdal_threads))
+
+
+def load_entry_function(path, gdal_threads):
+    """Import a script as a module (once per worker) and keep its entry function"""
+    global _entry_function
+    init_worker(gdal_threads)
+    # Scripts import their neighbours as `python script.py` would allow
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    # ... and report usage errors under their own name
+    sys.argv = [path]
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered under its real name so that what it defines can be pickled
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    _entry_function = getattr(module, ENTRY_FUNCTION)
+
+
+def run_in_process(indexed_arg_set):
+    """Call the loaded entry function with one row's arguments; never raises.
+
+    The environment is restored afterwards, so settings made by one row (e.g.
+    PLACE_EXIF_CACHE or GDAL options) don't leak into the next."""
+    (idx, arg_set) = indexed_arg_set
+    argv = build_argv(arg_set)
+    environ = dict(os.environ)
+    start = time.perf_counter()
+    try:
+        _entry_function(argv)
+        error = None
+    except SystemExit as e:
+        # argparse errors and sys.exit() calls end the row, not the worker
+        error = None if e.code in (None, 0) else f"exited with status {e.code}"
+    except Exception as e:
+        error = "".join(traceback.format_exception_only(type(e), e)).strip()
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+    return (idx, argv, time.perf_counter() - start, error)
+
+
+def run_subprocess(cli, indexed_arg_set):
+    """Run one row as a shell command; never raises"""
+    (idx, arg_set) = indexed_arg_set
+    start = time.perf_counter()
+    try:
+        execute_cli_command(cli, arg_set)
+        error = None
+    except subprocess.CalledProcessError as e:
+        error = f"exited with status {e.returncode}"
+    return (idx, build_argv(arg_set), time.perf_counter() - start, error)
+
+
 def parse_csv_to_dict(csv_path):
     data = []
 
@@ -32,6 +164,52 @@ def parse_csv_to_dict(csv_path):
     return data
 
 
+def choose_mode(cli, mode):
+    """In-process needs a script with main() that doesn't start process pools; auto
+    falls back to subprocess otherwise"""
+    if mode == MODE_SUBPROCESS:
+        return mode
+    path = script_path(cli)
+    if path is None or not has_entry_function(path):
+        if mode == MODE_IN_PROCESS:
+            raise ValueError(f"In-process mode needs a python script defining {ENTRY_FUNCTION}(argv), got {cli}")
+        return MODE_SUBPROCESS
+    if starts_process_pools(path):
+        if mode == MODE_IN_PROCESS:
+            raise ValueError(f"{path} starts process pools of its own, which workers can't; use subprocess mode")
+        return MODE_SUBPROCESS
+    return MODE_IN_PROCESS
+
+
+def run_all(cli, argument_sets, parallelism, mode=MODE_AUTO):
+    """Run the CLI for every argument set and return (idx, argv, seconds, error) per row"""
+    mode = choose_mode(cli, mode)
+    indexed = list(enumerate(argument_sets))
+    print(f"Running {len(indexed)} rows of {cli} ({mode}, {parallelism} workers)")
+
+    results = []
+    gdal_threads = threads_per_worker(parallelism)
+    if mode == MODE_IN_PROCESS:
+        with multiprocess.Pool(parallelism, initializer=load_entry_function, initargs=(script_path(cli), gdal_threads)) as pool:
+            for result in pool.imap_unordered(run_in_process, indexed):
+                results.append(result)
+    else:
+        # Subprocesses inherit the worker's GDAL_NUM_THREADS
+        with multiprocess.Pool(parallelism, initializer=init_worker, initargs=(gdal_threads,)) as pool:
+            for result in pool.imap_unordered(lambda row: run_subprocess(cli, row), indexed):
+                results.append(result)
+    return sorted(results)
+
+
+def summarize(results):
+    failed = [result for result in results if result[3] is not None]
+    seconds = sum(result[2] for result in results)
+    print(f"Ran {len(results)} rows ({seconds:.1f}s of work), {len(results) - len(failed)} succeeded, {len(failed)} failed")
+    for (idx, argv, _, error) in failed:
+        print(f"  row {idx + 1} ({' '.join(argv)}): {error}")
+    return failed
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run a series of CLI tasks with arguments defined in CSV')
 
@@ -41,12 +219,14 @@ if __name__ == "__main__":
                         help='path to the python script', required=True)
     parser.add_argument('-p', '--parallelism', metavar='PARALLELISM', type=int,
                         help='Desired parallelism', required=False, default=4)
+    parser.add_argument('-m', '--mode', choices=[MODE_AUTO, MODE_IN_PROCESS, MODE_SUBPROCESS], default=MODE_AUTO,
+                        help='in-process imports the script once per worker and calls its main(argv) for each row; '
+                             'subprocess runs a shell command per row (needed for scripts without main() or which '
+                             'start their own process pools). auto uses in-process when the script defines main() and '
+                             'starts no process pools')
     args = parser.parse_args()
 
-    def execute_script(argument_set):
-        return execute_cli_command(args.script, argument_set)
-
     argument_sets = parse_csv_to_dict(args.csv)
     parallelism = min(os.cpu_count(), args.parallelism)
-    with multiprocess.Pool(parallelism) as pool:
-        pool.map(execute_script, argument_sets)
+    failed = summarize(run_all(args.script, argument_sets, parallelism, args.mode))
+    sys.exit(1 if failed else 0)
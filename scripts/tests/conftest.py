@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts import each other as siblings (they are run from the scripts directory)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
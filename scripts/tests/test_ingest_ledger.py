@@ -0,0 +1,179 @@
+import os
+import sqlite3
+
+import orjson
+import pytest
+
+from ingest_directory import ingest_items, prune_stale
+from ingest_ledger import IngestLedger, hash_record
+
+
+class FakeLoader(object):
+    """Records what would be loaded into and deleted from pgstac"""
+
+    def __init__(self):
+        self.added = []
+        self.deleted = []
+
+    def add(self, item):
+        self.added.append((item["collection"], item["id"]))
+
+    def flush(self):
+        pass
+
+    def delete_items(self, keys):
+        self.deleted += keys
+
+
+def _item(item_id, collection="c", **properties):
+    item = {"id": item_id, "properties": properties}
+    if collection is not None:
+        item["collection"] = collection
+    return item
+
+
+def _write_items(path, items, mtime_offset_ns=0):
+    with open(path, "wb") as f:
+        for item in items:
+            f.write(orjson.dumps(item, option=orjson.OPT_APPEND_NEWLINE))
+    # Each rewrite gets a new mtime, however quickly it follows the last one
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + mtime_offset_ns))
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    with IngestLedger(str(tmp_path / "ledger.sqlite")) as ledger:
+        yield ledger
+
+
+def test_hash_record_ignores_key_order():
+    assert hash_record({"a": 1, "b": {"c": 2, "d": 3}}) == hash_record({"b": {"d": 3, "c": 2}, "a": 1})
+    assert hash_record({"a": 1}) != hash_record({"a": 2})
+
+
+def test_only_new_and_changed_items_are_loaded(tmp_path, ledger):
+    _write_items(tmp_path / "items.json", [_item("a"), _item("b")])
+    loader = FakeLoader()
+    assert ingest_items(ledger, loader, str(tmp_path), "items.json", False) == (2, 0, 0)
+    assert loader.added == [("c", "a"), ("c", "b")]
+
+    # Unchanged: skipped on size and mtime alone
+    loader = FakeLoader()
+    assert ingest_items(ledger, loader, str(tmp_path), "items.json", False) == (0, 0, 0)
+
+    _write_items(tmp_path / "items.json", [_item("a"), _item("b", gsd=2), _item("d")], 10**9)
+    loader = FakeLoader()
+    assert ingest_items(ledger, loader, str(tmp_path), "items.json", False) == (2, 0, 0)
+    assert loader.added == [("c", "b"), ("c", "d")]
+
+    # --full reloads everything
+    loader = FakeLoader()
+    assert ingest_items(ledger, loader, str(tmp_path), "items.json", True) == (3, 0, 0)
+
+
+def test_removed_items_stay_stale_until_pruned(tmp_path, ledger):
+    _write_items(tmp_path / "items.json", [_item("a"), _item("b"), _item("z")])
+    ingest_items(ledger, FakeLoader(), str(tmp_path), "items.json", False)
+
+    _write_items(tmp_path / "items.json", [_item("a")], 10**9)
+    assert ingest_items(ledger, FakeLoader(), str(tmp_path), "items.json", False) == (0, 2, 0)
+    assert ledger.stale_items() == [("c", "b"), ("c", "z")]
+    assert ledger.item_hashes("items.json").keys() == {("c", "a")}
+
+    # A run without --prune leaves them stale, even once the file is unchanged
+    assert ingest_items(ledger, FakeLoader(), str(tmp_path), "items.json", False) == (0, 0, 0)
+    _write_items(tmp_path / "items.json", [_item("a"), _item("e")], 2 * 10**9)
+    ingest_items(ledger, FakeLoader(), str(tmp_path), "items.json", False)
+    assert ledger.stale_items() == [("c", "b"), ("c", "z")]
+
+    # A later prune deletes them from pgstac, then forgets them
+    loader = FakeLoader()
+    assert prune_stale(ledger, loader) == 2
+    assert loader.deleted == [("c", "b"), ("c", "z")]
+    assert ledger.stale_items() == []
+    assert prune_stale(ledger, FakeLoader()) == 0
+
+
+def test_readded_item_is_no_longer_stale(tmp_path, ledger):
+    _write_items(tmp_path / "items.json", [_item("a"), _item("b")])
+    ingest_items(ledger, FakeLoader(), str(tmp_path), "items.json", False)
+    _write_items(tmp_path / "items.json", [_item("a")], 10**9)
+    ingest_items(ledger, FakeLoader(), str(tmp_path), "items.json", False)
+    _write_items(tmp_path / "items.json", [_item("a"), _item("b")], 2 * 10**9)
+    ingest_items(ledger, FakeLoader(), str(tmp_path), "items.json", False)
+    assert ledger.stale_items() == []
+
+
+def test_item_moved_between_files_is_not_stale(tmp_path, ledger):
+    _write_items(tmp_path / "a-items.json", [_item("a"), _item("b")])
+    _write_items(tmp_path / "b-items.json", [_item("c")])
+    for name in ("a-items.json", "b-items.json"):
+        ingest_items(ledger, FakeLoader(), str(tmp_path), name, False)
+
+    # b moves to the file ingested after the one it left, and c to the one before
+    _write_items(tmp_path / "a-items.json", [_item("a"), _item("c")], 10**9)
+    _write_items(tmp_path / "b-items.json", [_item("b")], 10**9)
+    for name in ("a-items.json", "b-items.json"):
+        ingest_items(ledger, FakeLoader(), str(tmp_path), name, False)
+    assert ledger.stale_items() == []
+    assert ledger.item_hashes("a-items.json").keys() == {("c", "a"), ("c", "c")}
+
+
+def test_deleted_file_items_are_stale(tmp_path, ledger):
+    _write_items(tmp_path / "items.json", [_item("a"), _item("b")])
+    ingest_items(ledger, FakeLoader(), str(tmp_path), "items.json", False)
+    ledger.forget_file("items.json")
+    assert ledger.files() == []
+    assert ledger.stale_items() == [("c", "a"), ("c", "b")]
+
+
+def test_items_without_a_collection(tmp_path, ledger):
+    _write_items(tmp_path / "items.json", [_item("a"), _item("b", collection=None)])
+    loader = FakeLoader()
+    assert ingest_items(ledger, loader, str(tmp_path), "items.json", False) == (1, 0, 1)
+    assert loader.added == [("c", "a")]
+
+    loader = FakeLoader()
+    assert ingest_items(ledger, loader, str(tmp_path), "items.json", True, default_collection="d") == (2, 0, 0)
+    assert loader.added == [("c", "a"), ("d", "b")]
+
+
+def test_skipped_items_are_loaded_by_a_later_run(tmp_path, ledger):
+    _write_items(tmp_path / "items.json", [_item("a"), _item("b", collection=None)])
+    loader = FakeLoader()
+    assert ingest_items(ledger, loader, str(tmp_path), "items.json", False) == (1, 0, 1)
+
+    # The file is unchanged, but the re-run the warning suggests picks up the skipped item
+    loader = FakeLoader()
+    assert ingest_items(ledger, loader, str(tmp_path), "items.json", False, default_collection="d") == (1, 0, 0)
+    assert loader.added == [("d", "b")]
+
+    # And once nothing is skipped, the unchanged file is passed over again
+    loader = FakeLoader()
+    assert ingest_items(ledger, loader, str(tmp_path), "items.json", False, default_collection="d") == (0, 0, 0)
+    assert loader.added == []
+
+
+def test_touched_file_with_same_content_is_skipped(tmp_path, ledger):
+    _write_items(tmp_path / "items.json", [_item("a")])
+    ingest_items(ledger, FakeLoader(), str(tmp_path), "items.json", False)
+    _write_items(tmp_path / "items.json", [_item("a")], 10**9)
+    loader = FakeLoader()
+    assert ingest_items(ledger, loader, str(tmp_path), "items.json", False) == (0, 0, 0)
+    assert loader.added == []
+    (size, mtime_ns, _) = ledger.file_state("items.json")
+    assert mtime_ns == os.stat(tmp_path / "items.json").st_mtime_ns
+
+
+def test_ledger_without_stale_column(tmp_path):
+    path = str(tmp_path / "old.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE items (collection TEXT NOT NULL, id TEXT NOT NULL, path TEXT NOT NULL, "
+                 "sha256 TEXT NOT NULL, PRIMARY KEY (collection, id))")
+    conn.execute("INSERT INTO items VALUES ('c', 'a', 'items.json', 'sha')")
+    conn.commit()
+    conn.close()
+    with IngestLedger(path) as ledger:
+        assert ledger.item_hashes("items.json") == {("c", "a"): "sha"}
+        assert ledger.stale_items() == []